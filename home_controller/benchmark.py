@@ -0,0 +1,258 @@
+"""Benchmark of the sensor/equipment update pipeline
+
+Runs simulated sensors & equipment against a file-backed SQLite DB and
+reports throughput, latency & resource use as JSON, e.g.::
+
+    python -m home_controller.benchmark --sensors 200 --rate 2 --duration 30
+
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+from collections import deque
+from datetime import datetime
+from time import perf_counter, sleep
+
+import numpy as np
+from sqlalchemy.engine import create_engine
+from sqlalchemy.pool import StaticPool
+
+from home_controller.db import Base, Session, session_factory
+from home_controller.equipment import BinaryEquipment
+from home_controller.sensors import RandomValuesSensor, SineWaveSensor
+from home_controller.storage import WriteBuffer
+from home_controller.tools import configure_pool, shutdown_pools
+
+def _rss_bytes():
+    """Current resident set size, falling back to the peak where /proc isn't
+    available
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+def _db_size(path):
+    return sum(os.path.getsize(p) for p in (path, path + "-wal",
+                                            path + "-journal")
+               if os.path.exists(p))
+
+class _Timed(object):
+    """Wraps a device's driver & persistence callback to measure the time from
+    the start of each read to the end of its `_update_data` call.
+
+    Start times are kept per executor thread, since a call's driver & callback
+    run on the same thread, one call at a time. Calls that never reach the
+    callback (timed out, or unchanged equipment states) are overwritten by
+    the next call rather than matched with it.
+    """
+    def __init__(self, device, driver, latencies):
+        self.device = device
+        self.latencies = latencies
+        self.started = {}
+        self.errors = 0
+        self._driver = getattr(device, driver)
+        self._update_data = device._update_data
+        setattr(device, driver, self.driver)
+        device._update_data = self.update_data
+
+    def driver(self, *args, **kwargs):
+        self.started[threading.get_ident()] = perf_counter()
+        return self._driver(*args, **kwargs)
+
+    def update_data(self, data):
+        started = self.started.pop(threading.get_ident(), None)
+        try:
+            self._update_data(data)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            if started is not None:
+                self.latencies.append(perf_counter() - started)
+
+def make_devices(sensors, equipment, rng=random):
+    """Creates the simulated devices for a run
+
+    :param rng: Random number generator for the device parameters. Pass a
+                seeded `random.Random`, since sensors may reseed the global
+                generator.
+    """
+    devices = []
+    for i in range(sensors):
+        if i % 2:
+            devices.append(RandomValuesSensor(
+                sensor_name="bench_random_{}".format(i)))
+        else:
+            devices.append(SineWaveSensor(
+                sensor_name="bench_sine_{}".format(i),
+                period=rng.uniform(10, 600)))
+    for i in range(equipment):
+        devices.append(BinaryEquipment("state", "bench_equipment_{}".format(i)))
+    return devices
+
+def run_benchmark(sensors=50, equipment=10, rate=1.0, duration=10.0,
+                  workers=None, buffered=False, db_path=None, seed=0):
+    """Drives simulated devices at `rate` updates per second each for
+    `duration` seconds and returns a dict of results.
+
+    :param sensors: Number of simulated sensors (half sine, half random)
+    :param equipment: Number of `BinaryEquipment` devices
+    :param rate: Updates per second per device
+    :param duration: Length of the run in seconds
+    :param workers: Executor pool size. Defaults to the pool default.
+    :param buffered: Write through a `WriteBuffer` instead of committing
+                     every update
+    :param db_path: SQLite file to use, or ":memory:" for an in-memory DB on
+                    one shared connection (run it with a single worker).
+                    Defaults to a temporary file.
+    :param seed: Random seed for the device parameters & equipment states
+    """
+    rng = random.Random(seed)
+    temp_dir = None
+    if db_path is None:
+        temp_dir = tempfile.mkdtemp(prefix="home_controller_bench_")
+        db_path = os.path.join(temp_dir, "bench.db")
+
+    # connections are opened on the executor threads but closed from this one
+    if db_path == ":memory:":
+        # an in-memory DB only exists on its connection, so share just one
+        engine = create_engine("sqlite://", poolclass=StaticPool,
+                               connect_args={"check_same_thread": False})
+    else:
+        engine = create_engine("sqlite:///{}".format(db_path),
+                               connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    previous_bind = session_factory.kw.get("bind")
+    session_factory.configure(bind=engine)
+    shutdown_pools()
+    if workers is not None:
+        configure_pool("default", workers)
+
+    buffer = None
+    if buffered:
+        buffer = WriteBuffer()
+        buffer.start()
+
+    devices = make_devices(sensors, equipment, rng)
+    latencies = deque()
+    timers = []
+    for device in devices:
+        device.write_buffer = buffer
+        timers.append(_Timed(device,
+                             "read" if hasattr(device, "read")
+                             else "update_state",
+                             latencies))
+
+    db_start = _db_size(db_path)
+    rss_start = _rss_bytes()
+    max_threads = threading.active_count()
+    submitted = 0
+
+    start = perf_counter()
+    interval = 1.0 / rate
+    tick = 0
+    while True:
+        due = start + tick * interval
+        now = perf_counter()
+        if now - start >= duration:
+            break
+        if due > now:
+            sleep(due - now)
+        for device in devices:
+            if isinstance(device, BinaryEquipment):
+                device.set(rng.random())
+            else:
+                device.update()
+            submitted += 1
+        max_threads = max(max_threads, threading.active_count())
+        tick += 1
+
+    shutdown_pools(wait=True)
+    if buffer is not None:
+        buffer.stop()
+    elapsed = perf_counter() - start
+
+    Session.remove()
+    session_factory.configure(bind=previous_bind)
+    engine.dispose()
+    db_end = _db_size(db_path)
+    latency = np.array(latencies) * 1000
+    results = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "config": {
+            "sensors": sensors,
+            "equipment": equipment,
+            "rate": rate,
+            "duration": duration,
+            "workers": workers,
+            "buffered": buffered,
+            "seed": seed,
+        },
+        "submitted": submitted,
+        "completed": len(latencies),
+        "errors": sum(t.errors for t in timers),
+        "elapsed_s": elapsed,
+        "readings_per_s": len(latencies) / elapsed,
+        "latency_ms": {
+            "p50": float(np.percentile(latency, 50)) if len(latency) else None,
+            "p99": float(np.percentile(latency, 99)) if len(latency) else None,
+            "max": float(latency.max()) if len(latency) else None,
+        },
+        "max_threads": max_threads,
+        "rss_bytes": { "start": rss_start, "end": _rss_bytes() },
+        "db_bytes": { "start": db_start, "end": db_end,
+                      "growth": db_end - db_start },
+    }
+    if buffer is not None:
+        results["write_buffer"] = buffer.stats()
+
+    if temp_dir is not None:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sensors", type=int, default=50)
+    parser.add_argument("--equipment", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="updates per second per device")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="seconds")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="executor pool size")
+    parser.add_argument("--buffered", action="store_true",
+                        help="write through a WriteBuffer")
+    parser.add_argument("--db", default=None,
+                        help="SQLite file to use (default: temporary)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None,
+                        help="file to write the JSON results to")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(sensors=args.sensors, equipment=args.equipment,
+                            rate=args.rate, duration=args.duration,
+                            workers=args.workers, buffered=args.buffered,
+                            db_path=args.db, seed=args.seed)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
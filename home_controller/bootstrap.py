@@ -0,0 +1,131 @@
+"""Loading of the device inventory at startup
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import perf_counter
+
+from sqlalchemy import event
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import defer
+
+from home_controller.db import session_factory, latest_values
+from home_controller.equipment import Equipment
+from home_controller.log import logger
+from home_controller.sensors import Sensor
+from home_controller.tools import metrics
+
+#: Columns that aren't needed to run a device, and are loaded on first access
+#: instead of at startup when loading into the caller's session
+DEFERRED_COLUMNS = ("attributes", "created_at", "updated_at")
+
+class Bootstrap(object):
+    """Loads every device in a fixed number of queries: one polymorphic query
+    per device base class, plus one per data table for the latest values. No
+    history is read. The device queries are baked, so running a bootstrap
+    again doesn't recompile them.
+
+    By default devices are returned detached from the bootstrap session, with
+    every column loaded, since a detached device can't load the rest later.
+    Their records are written by id, so they can be updated without joining
+    another session. When a session is passed to `run`, the devices are
+    loaded into it and the columns in `deferred` (including the JSON
+    `attributes`) are left unloaded until first accessed. Executor lanes &
+    state aren't set up until a device is first used.
+
+    `timings` holds the seconds spent in each phase of the last run, which
+    are also observed as `bootstrap_seconds`.
+
+    Usage::
+
+        bootstrap = Bootstrap()
+        devices = bootstrap.run()
+        for sensor in devices[Sensor]:
+            scheduler.add(sensor, 30)
+        logger.info("Started in {total:.2f}s".format(**bootstrap.timings))
+    """
+    _bakery = baked.bakery()
+
+    def __init__(self, classes=(Sensor, Equipment), deferred=DEFERRED_COLUMNS,
+                 load_latest=True):
+        """
+        :param classes: Device base classes to load, with all their subclasses
+        :param deferred: Names of columns to leave unloaded when loading into
+                         the caller's session
+        :param load_latest: Whether to populate `latest_values`
+        """
+        self.classes = list(classes)
+        self.deferred = tuple(deferred)
+        self.load_latest = load_latest
+        self.timings = OrderedDict()
+        self.queries = 0
+
+    @property
+    def log(self):
+        return logger
+
+    @contextmanager
+    def _phase(self, name):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - started
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+            metrics.observe("bootstrap_seconds", seconds, phase=name)
+
+    def _count_query(self, *args):
+        self.queries += 1
+
+    def _query(self, cls, deferred):
+        deferred = tuple(name for name in deferred
+                         if name in cls.__mapper__.column_attrs)
+        query = self._bakery(lambda s: s.query(cls).with_polymorphic("*"),
+                             cls, deferred)
+        if deferred:
+            query += lambda q: q.options(*[ defer(name) for name in deferred ])
+        return query
+
+    def run(self, session=None):
+        """Loads the devices.
+
+        :param session: Session to load into, leaving the `deferred` columns
+                        unloaded. Defaults to a new session that is closed
+                        afterwards, leaving the devices detached with every
+                        column loaded.
+        :returns: OrderedDict of {base class: [devices]}
+        """
+        self.timings = OrderedDict()
+        self.queries = 0
+        own_session = session is None
+        deferred = () if own_session else self.deferred
+        devices = OrderedDict()
+
+        with self._phase("total"):
+            with self._phase("connect"):
+                if own_session:
+                    session = session_factory()
+                connection = session.connection()
+            engine = connection.engine
+            event.listen(engine, "before_cursor_execute", self._count_query)
+            try:
+                with self._phase("devices"):
+                    for cls in self.classes:
+                        devices[cls] = self._query(cls, deferred)(
+                            session).all()
+                if self.load_latest:
+                    with self._phase("latest_values"):
+                        latest_values.load(connection, *self.classes)
+            finally:
+                event.remove(engine, "before_cursor_execute",
+                             self._count_query)
+                if own_session:
+                    with self._phase("close"):
+                        session.close()
+
+        self.log.info("Loaded {} devices in {} queries ({:.3f}s)".format(
+            sum(len(d) for d in devices.values()), self.queries,
+            self.timings["total"]))
+        return devices
@@ -0,0 +1,2 @@
+from .engine import ControlEngine
+from .rules import Rule, Thermostat, PID, Schedule
@@ -0,0 +1,134 @@
+"""Event-driven evaluation of control rules
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import threading
+from time import perf_counter
+
+from home_controller.db import HasFloatDataCollection
+from home_controller.log import logger
+from home_controller.tools import metrics
+
+class ControlEngine(object):
+    """Evaluates control rules as soon as their inputs are recorded, rather
+    than polling sensors on a timer.
+
+    The engine is a data listener: each update of a subscribed sensor channel
+    is passed to the rules that use it, and a rule is only evaluated when the
+    value has changed, or its `refresh` asks for it (e.g. when a scheduled
+    setpoint has moved). The engine calls `equipment.set` with the rule's
+    output, which is dropped as a no-op if the equipment is already in that
+    state. The time from the sensor reading to the equipment
+    recording its new state is observed as `control_latency_seconds`.
+
+    Usage::
+
+        engine = ControlEngine()
+        engine.add(Thermostat(sensor, "temperature", furnace, setpoint=20.5))
+        engine.attach()
+    """
+    def __init__(self):
+        self.rules = []
+        self._subscriptions = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @property
+    def log(self):
+        return logger
+
+    def add(self, rule):
+        """Subscribes `rule` to its inputs. Returns the rule.
+        """
+        with self._lock:
+            self.rules.append(rule)
+            for key in rule.inputs:
+                self._subscriptions.setdefault(key, []).append(rule)
+        return rule
+
+    def remove(self, rule):
+        with self._lock:
+            if rule in self.rules:
+                self.rules.remove(rule)
+            for key in rule.inputs:
+                rules = self._subscriptions.get(key, [])
+                if rule in rules:
+                    rules.remove(rule)
+                if not rules:
+                    self._subscriptions.pop(key, None)
+
+    def attach(self):
+        """Starts evaluating rules on data collection updates
+        """
+        HasFloatDataCollection.add_data_listener(self.record)
+
+    def detach(self):
+        HasFloatDataCollection.remove_data_listener(self.record)
+
+    def record(self, device, timestamp, named_values):
+        """Passes an update to the rules subscribed to it. This is the data
+        listener registered by `attach`.
+        """
+        actions = []
+        with self._lock:
+            pending = self._pending.pop(device, None)
+            for channel, value in named_values:
+                for rule in self._subscriptions.get((device, channel), ()):
+                    changed = rule.update(device, channel, value)
+                    changed = rule.refresh(timestamp) or changed
+                    if changed and rule.ready:
+                        action = self._evaluate(rule, timestamp)
+                        if action is not None:
+                            actions.append(action)
+
+        if pending is not None:
+            rule, reading_time = pending
+            metrics.observe("control_latency_seconds",
+                            (timestamp - reading_time).total_seconds(),
+                            rule=rule.name)
+        for rule, output in actions:
+            try:
+                applied = rule.equipment.set(output)
+            except Exception as e:
+                self.log.error("Error applying rule {}: {}".format(
+                    rule.name, e))
+                applied = False
+            if not applied:
+                # the equipment won't record a new state to time
+                with self._lock:
+                    if self._pending.get(rule.equipment, (None,))[0] is rule:
+                        del self._pending[rule.equipment]
+
+    def _evaluate(self, rule, timestamp):
+        """Evaluates `rule`, returning (rule, output) unless it leaves the
+        equipment alone. Must be called holding the engine lock.
+        """
+        started = perf_counter()
+        try:
+            output = rule.evaluate(timestamp)
+        except Exception as e:
+            self.log.error("Error evaluating rule {}: {}".format(rule.name, e))
+            metrics.increment("control_errors_total", rule=rule.name)
+            return None
+        finally:
+            rule.evaluations += 1
+            metrics.observe("control_evaluation_seconds",
+                            perf_counter() - started, rule=rule.name)
+
+        if output is None:
+            return None
+        # a repeated output is still sent: the equipment drops it as a no-op
+        # if it's in that state, but retries it if an earlier command failed
+        rule.output = output
+        self._pending[rule.equipment] = (rule, timestamp)
+        return rule, output
+
+    def stats(self):
+        return {
+            rule.name: {
+                "evaluations": rule.evaluations,
+                "output": rule.output,
+            }
+            for rule in self.rules
+        }
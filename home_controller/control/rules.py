@@ -0,0 +1,168 @@
+"""Control rules mapping sensor readings to equipment states
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from bisect import bisect_right
+
+from home_controller.db import EpochDateTime
+
+class Rule(object):
+    """Base class for control rules. A rule subscribes to sensor channels,
+    and is evaluated by a `ControlEngine` whenever one of them changes value,
+    or `refresh` reports that something else it depends on has changed.
+
+    :param equipment: Equipment the rule sets
+    :param inputs: List of (sensor, channel) tuples the rule depends on
+    :param name: Name used in logs & metrics. Defaults to the class name.
+    """
+    def __init__(self, equipment, inputs, name=None):
+        self.equipment = equipment
+        self.inputs = list(inputs)
+        self.name = name or self.__class__.__name__
+        self.values = {}
+        self.output = None
+        self.evaluations = 0
+
+    def update(self, sensor, channel, value):
+        """Stores a new input value. Returns False if it hasn't changed.
+        """
+        key = (sensor, channel)
+        if key in self.values and self.values[key] == value:
+            return False
+        self.values[key] = value
+        return True
+
+    def refresh(self, timestamp):
+        """Inherit this method to have the rule re-evaluated when something
+        other than its inputs changes, e.g. a scheduled setpoint. Called on
+        every update of the rule's inputs.
+
+        :returns: True if the rule should be evaluated at `timestamp` even if
+                  its inputs haven't changed
+        """
+        return False
+
+    @property
+    def ready(self):
+        return len(self.values) == len(self.inputs)
+
+    def evaluate(self, timestamp):
+        """Inherit this method to compute the equipment state from `values`.
+
+        :param timestamp: Time of the reading that triggered the evaluation
+        :returns: The new equipment state, or None to leave it alone
+        """
+        raise NotImplementedError("A rule must implement evaluate")
+
+class _SetpointRule(Rule):
+    """Base class for rules controlling one sensor channel to a setpoint,
+    which is re-evaluated whenever the setpoint changes
+    """
+    def __init__(self, sensor, channel, equipment, setpoint, **kwargs):
+        super(_SetpointRule, self).__init__(equipment, [(sensor, channel)],
+                                            **kwargs)
+        self.setpoint = setpoint
+        self._last_setpoint = None
+
+    def setpoint_at(self, timestamp):
+        return self.setpoint(timestamp) if callable(self.setpoint) \
+            else self.setpoint
+
+    def refresh(self, timestamp):
+        setpoint = self.setpoint_at(timestamp)
+        changed = setpoint != self._last_setpoint
+        self._last_setpoint = setpoint
+        return changed
+
+class Thermostat(_SetpointRule):
+    """On/off control with hysteresis. When heating, the equipment is turned
+    on below `setpoint - band / 2` and off above `setpoint + band / 2`;
+    cooling is the reverse. In between, the equipment is left alone.
+
+    `setpoint` may be a number or a callable taking the reading's timestamp,
+    such as a `Schedule`.
+    """
+    def __init__(self, sensor, channel, equipment, setpoint, band=1.0,
+                 cooling=False, **kwargs):
+        super(Thermostat, self).__init__(sensor, channel, equipment, setpoint,
+                                         **kwargs)
+        self.band = band
+        self.cooling = cooling
+
+    def evaluate(self, timestamp):
+        value, = self.values.values()
+        if value is None:
+            return None
+        setpoint = self.setpoint_at(timestamp)
+        if value < setpoint - self.band / 2:
+            return 0.0 if self.cooling else 1.0
+        if value > setpoint + self.band / 2:
+            return 1.0 if self.cooling else 0.0
+        return None
+
+class PID(_SetpointRule):
+    """Proportional-integral-derivative control of a continuous output. The
+    derivative term acts on the measurement, and the integral is clamped to
+    `output_limits` to prevent windup.
+
+    `setpoint` may be a number or a callable taking the reading's timestamp.
+    """
+    def __init__(self, sensor, channel, equipment, setpoint, kp, ki=0.0,
+                 kd=0.0, output_limits=(0.0, 1.0), **kwargs):
+        super(PID, self).__init__(sensor, channel, equipment, setpoint,
+                                  **kwargs)
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.output_limits = output_limits
+        self.integral = 0.0
+        self._last = None
+
+    def refresh(self, timestamp):
+        """The integral keeps growing while the error holds steady, so a PID is
+        evaluated on every reading, not just when the value changes
+        """
+        super(PID, self).refresh(timestamp)
+        return True
+
+    def _clamp(self, value):
+        low, high = self.output_limits
+        return max(low, min(high, value))
+
+    def evaluate(self, timestamp):
+        value, = self.values.values()
+        if value is None:
+            return None
+        seconds = (timestamp - EpochDateTime.epoch).total_seconds()
+        error = self.setpoint_at(timestamp) - value
+
+        derivative = 0.0
+        if self._last is not None:
+            dt = seconds - self._last[0]
+            if dt > 0:
+                self.integral = self._clamp(self.integral +
+                                            self.ki * error * dt)
+                derivative = -(value - self._last[1]) / dt
+        self._last = (seconds, value)
+        return self._clamp(self.kp * error + self.integral +
+                           self.kd * derivative)
+
+class Schedule(object):
+    """Piecewise constant daily schedule, e.g. a thermostat setpoint::
+
+        Schedule([(time(6, 30), 21.0), (time(22, 0), 17.0)])
+
+    Calling it with a timestamp returns the value of the latest entry at or
+    before that time of day, wrapping around midnight.
+    """
+    def __init__(self, entries):
+        if not entries:
+            raise ValueError("A schedule needs at least one entry")
+        entries = sorted(entries)
+        self.times = [ t for t, _ in entries ]
+        self.values = [ v for _, v in entries ]
+
+    def __call__(self, timestamp):
+        i = bisect_right(self.times, timestamp.time()) - 1
+        return self.values[i]
@@ -3,18 +3,29 @@
 
 # Ben Peters (bencpeters@gmail.com)
 
+import heapq
 import json
-from datetime import datetime
-
-from sqlalchemy.types import TypeDecorator, VARCHAR
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+from itertools import islice
+from operator import itemgetter
+from time import time, perf_counter
+
+import numpy as np
+from sqlalchemy.types import TypeDecorator, VARCHAR, BigInteger
 from sqlalchemy.orm import sessionmaker, scoped_session, relationship
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy import (
-    ForeignKey, Column, DateTime, Integer, Float, Unicode
+    ForeignKey, Column, DateTime, Integer, Float, Unicode, Index, select,
+    cast, extract, literal
 )
 from sqlalchemy.sql.expression import func
 
 from home_controller.log import logger
+from home_controller.tools.clock import get_clock
+from home_controller.tools.ringbuffer import RingBuffer
+from home_controller.tools.instrumentation import metrics, device_labels
 
 
 class Base(object):
@@ -60,6 +71,65 @@ class JSONEncodedDict(TypeDecorator):
             value = json.loads(value)
         return value
 
+class EpochDateTime(TypeDecorator):
+    """Stores a naive UTC datetime as integer microseconds since the epoch,
+    which takes a fraction of the space of SQLite's text datetimes.
+    """
+    impl = BigInteger
+    epoch = datetime(1970, 1, 1)
+
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            value = (value - self.epoch) // timedelta(microseconds=1)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = self.epoch + timedelta(microseconds=value)
+        return value
+
+#: Aggregates that `HasFloatDataCollection.aggregate` can compute
+AGGREGATES = ("mean", "min", "max", "count", "sum")
+
+#: Result of `HasFloatDataCollection.aggregate`. `buckets` is an array of
+#: bucket start times (datetime64[us]), and `values` a dict of {aggregate:
+#: array} with one entry per bucket.
+Aggregation = namedtuple("Aggregation", ["buckets", "values"])
+
+def bucket_seconds(bucket):
+    """Returns an aggregation bucket width, given as a timedelta or seconds,
+    as whole seconds. None (a single bucket) is passed through.
+    """
+    if bucket is None:
+        return None
+    if isinstance(bucket, timedelta):
+        bucket = bucket.total_seconds()
+    if bucket < 1 or bucket != int(bucket):
+        raise ValueError("Bucket width must be a whole number of seconds, "
+                         "got {}".format(bucket))
+    return int(bucket)
+
+def epoch_seconds(column, dialect):
+    """SQL expression for a datetime column as whole seconds since the epoch
+    """
+    if dialect.name == "sqlite":
+        return cast(func.strftime("%s", column), Integer)
+    return cast(extract("epoch", column), Integer)
+
+def _combine_partials(index, count, total, minimum, maximum):
+    """Merges partial aggregates that share a bucket index. Returns the same
+    arrays with one entry per distinct index, in index order.
+    """
+    keys, inverse = np.unique(index, return_inverse=True)
+    size = len(keys)
+    mins = np.full(size, np.inf)
+    maxs = np.full(size, -np.inf)
+    np.minimum.at(mins, inverse, minimum)
+    np.maximum.at(maxs, inverse, maximum)
+    return (keys,
+            np.bincount(inverse, count, size).astype(np.int64),
+            np.bincount(inverse, total, size), mins, maxs)
+
 session_factory = sessionmaker()
 Session = scoped_session(session_factory)
 
@@ -112,6 +182,82 @@ class _DataCollectionValues(UniqueId):
         self.name = name
         self.record = record
 
+LatestValue = namedtuple("LatestValue", ["timestamp", "values", "scalar"])
+
+class LatestValues(object):
+    """Process-wide registry of the most recent values of every data
+    collection object, keyed by (data table name, id).
+
+    Entries are written by `HasFloatDataCollection._update_data`; `load`
+    pre-populates the registry from the DB at startup.
+    """
+    def __init__(self):
+        self._values = {}
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(device):
+        return (device.data_table_name, device.id)
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, device):
+        """Returns the `LatestValue` for `device`, or None
+        """
+        return self._values.get(self.key(device))
+
+    def set(self, device, timestamp, named_values, scalar=False):
+        """Stores the latest values for `device`, unless newer values are
+        already stored.
+        """
+        self._put(self.key(device), timestamp, named_values, scalar)
+
+    def _put(self, key, timestamp, named_values, scalar):
+        with self._lock:
+            current = self._values.get(key)
+            if current is None or current.timestamp is None or \
+                    (timestamp is not None and timestamp >= current.timestamp):
+                self._values[key] = LatestValue(timestamp, dict(named_values),
+                                                scalar)
+
+    def snapshot(self, data_table_name=None):
+        """Returns a dict of {(data table name, id): LatestValue} for every
+        device, or only for devices stored in `data_table_name`
+        """
+        with self._lock:
+            if data_table_name is None:
+                return dict(self._values)
+            return { k: v for k, v in self._values.items()
+                     if k[0] == data_table_name }
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def load(self, connection, *classes):
+        """Populates the registry with the newest record of every device of
+        the given data collection classes, using one query per data table.
+        """
+        connection = connection.execution_options(
+            compiled_cache=self._compiled)
+        loaded = set()
+        for cls in classes:
+            if cls.data_table_name in loaded:
+                continue
+            loaded.add(cls.data_table_name)
+            for parent_id, timestamp, named_values in \
+                    cls._latest_records(connection):
+                self._put((cls.data_table_name, parent_id), timestamp,
+                          named_values,
+                          cls.scalar_data and len(named_values) == 1)
+
+latest_values = LatestValues()
+
+#: Statements built by `HasFloatDataCollection._latest_query`, by record type
+_latest_queries = {}
+
 class HasFloatDataCollection(object):
     """Mixin to add data collection tables & relationships.
     """
@@ -123,6 +269,10 @@ class HasFloatDataCollection(object):
         collection = type(make_cls_name("Collection"),
             (_DataCollection, Base), {
             "__tablename__": cls.data_table_name,
+            "__table_args__": (
+                Index("ix_{}_parent_timestamp".format(cls.data_table_name),
+                      "parent_id", "timestamp"),
+            ),
             "values": relationship(make_cls_name("CollectionValues"),
                                    backref="record"),
             "parent_id": Column(Integer,
@@ -135,29 +285,597 @@ class HasFloatDataCollection(object):
             "__tablename__": cls.data_table_name + "_values",
             "record_id": Column(Integer,
                                 ForeignKey("{}.id".format(cls.data_table_name)),
-                                nullable=False),
+                                nullable=False, index=True),
         })
 
         cls.record_type = collection
         cls.value_type = values
 
-        return relationship(collection, backref="parent")
+        # dynamic so that the full history is never loaded by accident; use
+        # `history` to read records
+        return relationship(collection, backref="parent", lazy="dynamic")
 
-    def _update_data(self, data):
-        """Helper function to update the DB with new data values
+    #: Optional `home_controller.storage.WriteBuffer` used to group-commit
+    #: records instead of committing every update on its own
+    write_buffer = None
+
+    #: Optional `home_controller.storage.Compressor` that decides which
+    #: updates are written to the DB
+    compression = None
+
+    #: Optional `home_controller.storage.Archive` holding records that have
+    #: been moved out of the DB. Set by `Archive.attach`.
+    archive = None
 
-        Create our own session so that we're threadsafe
+    #: Number of recent samples to keep in memory per channel, or None to
+    #: keep none. See `recent`.
+    recent_capacity = None
+
+    #: Whether a single-channel value loaded from the DB is reported as a bare
+    #: value rather than a dict by `_current_data`
+    scalar_data = False
+
+    #: Callables run as `listener(device, timestamp, named_values)` after
+    #: every update of any data collection object. `named_values` is a list
+    #: of (name, value) tuples.
+    data_listeners = []
+
+    @staticmethod
+    def add_data_listener(listener):
+        HasFloatDataCollection.data_listeners.append(listener)
+
+    @staticmethod
+    def remove_data_listener(listener):
+        try:
+            HasFloatDataCollection.data_listeners.remove(listener)
+        except ValueError:
+            pass
+
+    @staticmethod
+    def _named_values(data):
+        """Returns a list of (name, value) tuples for a single value object or
+        a list of value objects
+        """
+        try:
+            return [ (v.name, v.value) for v in data ]
+        except TypeError:
+            return [ (data.name, data.value) ]
+
+    @classmethod
+    def _insert_records(cls, connection, records):
+        """Inserts records using Core statements rather than the unit of work.
+
+        :param connection: Connection to execute the inserts on
+        :param records: Iterable of (parent_id, timestamp, [(name, value)])
+                        tuples
+        """
+        records = list(records)
+        if not records:
+            return
+        record_table = cls.record_type.__table__
+        values_table = cls.value_type.__table__
+
+        parent_id, timestamp, _ = records[0]
+        first_id = connection.execute(record_table.insert(),
+                                      parent_id=parent_id,
+                                      timestamp=timestamp). \
+            inserted_primary_key[0]
+        if connection.dialect.name == "sqlite" and \
+                connection.in_transaction():
+            # SQLite holds the write lock from the first insert until the
+            # transaction ends, so the ids following it can't be taken by
+            # another writer & the rest can be inserted in one statement
+            record_ids = list(range(first_id, first_id + len(records)))
+            if len(records) > 1:
+                connection.execute(record_table.insert(), [
+                    { "id": record_id, "parent_id": parent_id,
+                      "timestamp": timestamp }
+                    for record_id, (parent_id, timestamp, _)
+                    in zip(record_ids[1:], records[1:]) ])
+        else:
+            record_ids = [first_id] + [
+                connection.execute(record_table.insert(),
+                                   parent_id=parent_id,
+                                   timestamp=timestamp).inserted_primary_key[0]
+                for parent_id, timestamp, _ in records[1:] ]
+
+        values = [ { "record_id": record_id, "name": name, "value": value }
+                   for record_id, (_, _, named_values)
+                   in zip(record_ids, records)
+                   for name, value in named_values ]
+        if values:
+            connection.execute(values_table.insert(), values)
+
+    @classmethod
+    def _advance_last_update(cls, connection, newest):
+        """Moves `last_update` forward to each device's newest reading
+
+        :param newest: Dict of {parent_id: (timestamp, [(name, value)])}
+        """
+        table = cls.__table__
+        if "last_update" not in table.c:
+            return
+        for parent_id, (timestamp, _) in newest.items():
+            connection.execute(table.update().where(
+                (table.c.id == parent_id) &
+                ((table.c.last_update == None) |
+                 (table.c.last_update < timestamp))).
+                values(last_update=timestamp))
+
+    @classmethod
+    def _put_latest(cls, newest, devices=None):
+        """Records each device's newest reading in `latest_values`, and as the
+        `last_update` of any of their objects in `devices`, once written
+
+        :param newest: Dict of {parent_id: (timestamp, [(name, value)])}
+        :param devices: Dict of {parent_id: device}
+        """
+        devices = devices or {}
+        for parent_id, (timestamp, named_values) in newest.items():
+            device = devices.get(parent_id)
+            if device is not None and (device.last_update is None or
+                                       timestamp > device.last_update):
+                device.last_update = timestamp
+            latest_values._put((cls.data_table_name, parent_id), timestamp,
+                               named_values,
+                               cls.scalar_data and len(named_values) == 1)
+
+    @classmethod
+    def bulk_ingest(cls, readings, chunk_size=1000):
+        """Writes many readings through Core inserts, committing once per
+        chunk, then updates `last_update` & the latest values of every device
+        involved.
+
+        :param readings: Iterable of (device, timestamp, {name: value}).
+                         `device` is an object of this class or its id, and
+                         `timestamp` a naive UTC datetime or seconds since the
+                         epoch.
+        :param chunk_size: Number of readings per transaction
+        :returns: Dict of ingest statistics, including records per second
+        """
+        start = time()
+        records_written = values_written = 0
+        newest = {}
+        devices = {}
+        session = Session()
+        try:
+            chunk = []
+            for device, timestamp, named_values in readings:
+                if isinstance(device, cls):
+                    if getattr(device, "id", None) is None:
+                        session.add(device)
+                        session.flush()
+                    parent_id = device.id
+                    devices[parent_id] = device
+                else:
+                    parent_id = device
+                if not isinstance(timestamp, datetime):
+                    timestamp = datetime.utcfromtimestamp(timestamp)
+                named_values = list(named_values.items())
+                chunk.append((parent_id, timestamp, named_values))
+
+                if parent_id not in newest or timestamp >= newest[parent_id][0]:
+                    newest[parent_id] = (timestamp, named_values)
+                values_written += len(named_values)
+                if len(chunk) >= chunk_size:
+                    cls._insert_records(session.connection(), chunk)
+                    session.commit()
+                    records_written += len(chunk)
+                    chunk = []
+            if chunk:
+                cls._insert_records(session.connection(), chunk)
+                records_written += len(chunk)
+            cls._advance_last_update(session.connection(), newest)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        cls._put_latest(newest, devices)
+
+        elapsed = time() - start
+        stats = {
+            "records": records_written,
+            "values": values_written,
+            "devices": len(newest),
+            "seconds": elapsed,
+            "records_per_second": records_written / elapsed if elapsed else 0.0,
+            "values_per_second": values_written / elapsed if elapsed else 0.0,
+        }
+        logger.debug("Ingested {records} records into {table} at "
+                     "{records_per_second:.0f} records/s".format(
+                         table=cls.data_table_name, **stats))
+        return stats
+
+    def store_arrays(self, timestamps, channels, chunk_size=1000):
+        """Bulk writes readings held in arrays with `bulk_ingest`, without
+        building a model object per value.
+
+        :param timestamps: Array of times, in seconds since the epoch
+        :param channels: Dict of {name: values array}, each the same length
+                         as `timestamps`
+        :param chunk_size: Number of records per insert batch
+        :returns: Number of records written
+        """
+        timestamps = (np.asarray(timestamps, dtype=np.float64) * 1e6). \
+            astype("datetime64[us]").tolist()
+        names = list(channels)
+        columns = [ np.asarray(channels[name], dtype=np.float64).tolist()
+                    for name in names ]
+        readings = ( (self, timestamp, dict(zip(names, values)))
+                     for timestamp, values in zip(timestamps, zip(*columns)) )
+        return type(self).bulk_ingest(readings, chunk_size)["records"]
+
+    @classmethod
+    def _delete_records_before(cls, connection, cutoff):
+        """Deletes all records (and their values) older than `cutoff`. Returns
+        the number of records deleted.
+        """
+        records = cls.record_type.__table__
+        values = cls.value_type.__table__
+        old_ids = select([records.c.id]).where(records.c.timestamp < cutoff)
+        connection.execute(values.delete().where(
+            values.c.record_id.in_(old_ids)))
+        return connection.execute(records.delete().where(
+            records.c.timestamp < cutoff)).rowcount
+
+    @classmethod
+    def _latest_query(cls):
+        """Returns the statement used by `_latest_records`. It's built once per
+        data table, so that its compiled form can be cached.
+        """
+        query = _latest_queries.get(cls.record_type)
+        if query is not None:
+            return query
+
+        records = cls.record_type.__table__
+        values = cls.value_type.__table__
+        newest = select([records.c.parent_id,
+                         func.max(records.c.timestamp).label("timestamp")]). \
+            group_by(records.c.parent_id).alias()
+        query = select([records.c.id, records.c.parent_id, records.c.timestamp,
+                        values.c.name, values.c.value]). \
+            select_from(records.join(newest, (newest.c.parent_id ==
+                                              records.c.parent_id) &
+                                             (newest.c.timestamp ==
+                                              records.c.timestamp)).
+                        join(values, values.c.record_id == records.c.id)). \
+            order_by(records.c.parent_id, records.c.id, values.c.id)
+        _latest_queries[cls.record_type] = query
+        return query
+
+    @classmethod
+    def _latest_records(cls, connection):
+        """Yields (parent_id, timestamp, [(name, value)]) for the newest record
+        of every parent, in a single query
+        """
+        latest = {}
+        for row in connection.execute(cls._latest_query()):
+            record_id, timestamp, named_values = latest.get(
+                row.parent_id, (None, None, None))
+            if record_id != row.id:
+                named_values = []
+                latest[row.parent_id] = (row.id, row.timestamp, named_values)
+            named_values.append((row.name, row.value))
+        for parent_id, (_, timestamp, named_values) in latest.items():
+            yield parent_id, timestamp, named_values
+
+    @classmethod
+    def _records_before(cls, connection, cutoff, limit):
+        """Returns up to `limit` of the oldest records older than `cutoff`, as
+        a list of (record_id, parent_id, timestamp, [(name, value)]) tuples in
+        time order
+        """
+        records = cls.record_type.__table__
+        values = cls.value_type.__table__
+        oldest = select([records.c.id, records.c.parent_id,
+                         records.c.timestamp]). \
+            where(records.c.timestamp < cutoff). \
+            order_by(records.c.timestamp, records.c.id).limit(limit).alias()
+        query = select([oldest.c.id, oldest.c.parent_id, oldest.c.timestamp,
+                        values.c.name, values.c.value]). \
+            select_from(oldest.join(values, values.c.record_id == oldest.c.id)). \
+            order_by(oldest.c.timestamp, oldest.c.id, values.c.id)
+
+        found = []
+        for row in connection.execute(query):
+            if not found or found[-1][0] != row.id:
+                found.append((row.id, row.parent_id, row.timestamp, []))
+            found[-1][3].append((row.name, row.value))
+        return found
+
+    @classmethod
+    def _delete_records(cls, connection, record_ids):
+        """Deletes the records (and their values) with the given ids
+        """
+        records = cls.record_type.__table__
+        values = cls.value_type.__table__
+        connection.execute(values.delete().where(
+            values.c.record_id.in_(record_ids)))
+        connection.execute(records.delete().where(
+            records.c.id.in_(record_ids)))
+
+    @classmethod
+    def _aggregate_query(cls, connection, parent_id, channel, start, end,
+                         seconds):
+        """Returns a statement selecting (bucket index, count, sum, min, max)
+        rows for one channel of one parent, grouped by `seconds` wide buckets
+        (or a single group if None). Returns None if there can't be any rows.
+        """
+        records = cls.record_type.__table__
+        values = cls.value_type.__table__
+        query = select([values.c.value]). \
+            select_from(records.join(values,
+                                     values.c.record_id == records.c.id)). \
+            where((records.c.parent_id == parent_id) &
+                  (values.c.name == channel) &
+                  (records.c.timestamp >= start) &
+                  (records.c.timestamp < end))
+        if seconds is None:
+            bucket = literal(0)
+        else:
+            bucket = epoch_seconds(records.c.timestamp,
+                                   connection.dialect) / seconds
+            query = query.group_by(bucket).order_by(bucket)
+        return query.with_only_columns([
+            bucket, func.count(values.c.value), func.sum(values.c.value),
+            func.min(values.c.value), func.max(values.c.value)])
+
+    def aggregate(self, channel, start, end, bucket=None, fns=AGGREGATES):
+        """Aggregates one channel over time buckets in a single grouped query,
+        without loading any records. Archived records are included.
+
+        Buckets are aligned to multiples of their width since the epoch, so
+        hourly buckets start on the hour, and buckets without readings are
+        left out.
+
+        :param channel: Name of the channel to aggregate
+        :param start: Start of the range (inclusive)
+        :param end: End of the range (exclusive)
+        :param bucket: Bucket width as a timedelta or whole seconds, or None
+                       to aggregate the whole range
+        :param fns: Aggregates to compute, from `AGGREGATES`
+        :returns: `Aggregation` of the bucket starts & {aggregate: array}
+        """
+        fns = list(fns)
+        unknown = set(fns) - set(AGGREGATES)
+        if unknown:
+            raise ValueError("Unknown aggregates: {}".format(
+                ", ".join(sorted(unknown))))
+        seconds = bucket_seconds(bucket)
+        started = perf_counter()
+
+        parts = []
+        if getattr(self, "id", None) is not None:
+            connection = Session().connection()
+            query = self._aggregate_query(connection, self.id, channel, start,
+                                          end, seconds)
+            if query is not None:
+                rows = [ row for row in connection.execute(query) if row[1] ]
+                if rows:
+                    index, count, total, minimum, maximum = \
+                        np.array(rows, dtype=np.float64).T
+                    parts.append((index.astype(np.int64), count, total,
+                                  minimum, maximum))
+
+            if self.archive is not None:
+                timestamps, columns = self.archive.read(self, start, end,
+                                                        [channel])
+                found = columns.get(channel, np.empty(0))
+                keep = ~np.isnan(found)
+                found = found[keep].astype(np.float64)
+                if seconds is None:
+                    index = np.zeros(len(found), dtype=np.int64)
+                else:
+                    index = timestamps[keep] // (seconds * 1000000)
+                parts.append((index, np.ones(len(found)), found, found, found))
+
+        if parts:
+            keys, count, total, minimum, maximum = _combine_partials(
+                *[ np.concatenate(arrays) for arrays in zip(*parts) ])
+        else:
+            keys = count = np.empty(0, dtype=np.int64)
+            total = minimum = maximum = np.empty(0)
+
+        if seconds is None:
+            buckets = np.array([start] * len(keys), dtype="datetime64[us]")
+        else:
+            buckets = (keys * seconds * 1000000).astype("datetime64[us]")
+        computed = {
+            "mean": total / np.maximum(count, 1),
+            "min": minimum,
+            "max": maximum,
+            "count": count,
+            "sum": total,
+        }
+        metrics.observe("data_aggregate_seconds", perf_counter() - started,
+                        **device_labels(self))
+        return Aggregation(buckets, { fn: computed[fn] for fn in fns })
+
+    def history(self, start=None, end=None, channels=None, limit=None):
+        """Generator over this object's records in time order. Records moved
+        to the `archive` are read from its segment files, and the rest in a
+        single streamed query.
+
+        :param start: Earliest timestamp (inclusive) to return
+        :param end: Latest timestamp (exclusive) to return
+        :param channels: Optional list of channel names to return
+        :param limit: Maximum number of records to return
+        :returns: Generator of (timestamp, {name: value}) tuples
+        """
+        records = self._db_history(start, end, channels, limit)
+        if self.archive is not None and getattr(self, "id", None) is not None:
+            records = islice(heapq.merge(
+                self.archive.history(self, start, end, channels), records,
+                key=itemgetter(0)), limit)
+        yield from records
+
+    def _db_history(self, start=None, end=None, channels=None, limit=None,
+                    newest_first=False):
+        """Generator over the records held in the DB. See `history`.
+        `newest_first` reverses the order.
+        """
+        if getattr(self, "id", None) is None:
+            return
+
+        records = self.record_type.__table__
+        values = self.value_type.__table__
+
+        query = select([records.c.id, records.c.timestamp]). \
+            where(records.c.parent_id == self.id)
+        if start is not None:
+            query = query.where(records.c.timestamp >= start)
+        if end is not None:
+            query = query.where(records.c.timestamp < end)
+        order = [records.c.timestamp, records.c.id]
+        if newest_first:
+            order = [ column.desc() for column in order ]
+        query = query.order_by(*order)
+        if limit is not None:
+            query = query.limit(limit)
+        query = query.alias()
+
+        order = [query.c.timestamp, query.c.id]
+        if newest_first:
+            order = [ column.desc() for column in order ]
+        joined = select([query.c.id, query.c.timestamp, values.c.name,
+                         values.c.value]). \
+            select_from(query.join(values, values.c.record_id == query.c.id)). \
+            order_by(*order)
+        if channels is not None:
+            joined = joined.where(values.c.name.in_(channels))
+
+        result = Session().connection(). \
+            execution_options(stream_results=True).execute(joined)
+        record_id, timestamp, named_values = None, None, {}
+        for row in result:
+            if row.id != record_id:
+                if record_id is not None:
+                    yield timestamp, named_values
+                record_id, timestamp, named_values = row.id, row.timestamp, {}
+            named_values[row.name] = row.value
+        if record_id is not None:
+            yield timestamp, named_values
+
+    def _persist_data(self, timestamp, data, commit=True):
+        """Writes a single record to the DB and commits it, unless `commit` is
+        False.
+
+        Saved objects are written by id through Core inserts, so they don't
+        have to belong to this thread's session (e.g. after their executor
+        lane's worker has been replaced).
         """
         session = Session()
-        session.add(self.record_type(self, data))
+        if getattr(self, "id", None) is None:
+            session.add(self)
+            session.flush()
+        connection = session.connection()
+        self._insert_records(connection,
+                             [(self.id, timestamp, self._named_values(data))])
+        table = self.__table__
+        if self not in session and "last_update" in table.c:
+            connection.execute(table.update().where(table.c.id == self.id).
+                               values(last_update=timestamp))
+        if commit:
+            session.commit()
+
+    def recent(self, channel):
+        """Returns the `RingBuffer` of recent samples for `channel`, or None if
+        `recent_capacity` isn't set or the channel hasn't been seen
+        """
+        return getattr(self, "_recent", {}).get(channel)
+
+    def _record_recent(self, timestamp, named_values):
+        buffers = getattr(self, "_recent", None)
+        if buffers is None:
+            buffers = self._recent = {}
+        seconds = (timestamp - EpochDateTime.epoch).total_seconds()
+        for name, value in named_values:
+            buffer = buffers.get(name)
+            if buffer is None:
+                buffer = buffers[name] = RingBuffer(self.recent_capacity)
+            buffer.append(seconds, value)
+
+    def _current_data(self):
+        """Returns the latest values as a {name: value} dict, or a bare value
+        for scalar data. Served from `latest_values`, falling back to this
+        instance's own data for objects that haven't been saved.
+        """
+        latest = latest_values.get(self) if getattr(self, "id", None) \
+            is not None else None
+        if latest is None:
+            if getattr(self, "_latest_data", None) is None:
+                return None
+            try:
+                return { v.name: v.value for v in self._latest_data }
+            except TypeError:
+                return self._latest_data.value
+        if latest.scalar:
+            return next(iter(latest.values.values()))
+        return dict(latest.values)
+
+    def _notify_listeners(self, timestamp, named_values):
+        for listener in list(self.data_listeners):
+            try:
+                listener(self, timestamp, named_values)
+            except Exception as e:
+                self.log.error("Error in data listener {}: {}".format(
+                    listener, e))
+
+    def _store_data(self, timestamp, data, batch=None):
+        """Writes a record, through the `write_buffer` if there is one, or
+        appends it to `batch` for the caller to write. Records for objects
+        that haven't been saved yet are always written directly so that they
+        get an id (but not committed when batching).
+        """
+        started = perf_counter()
+        saved = getattr(self, "id", None)
+        if self.write_buffer is not None and saved:
+            self.write_buffer.put(self, timestamp, data)
+        elif batch is not None and saved:
+            batch.append((type(self), self.id, timestamp,
+                          self._named_values(data)))
+        else:
+            self._persist_data(timestamp, data, batch is None)
+        metrics.observe("data_persist_seconds", perf_counter() - started,
+                        **device_labels(self))
+
+    def _update_data(self, data, batch=None):
+        """Helper function to update the DB with new data values
+
+        Create our own session so that we're threadsafe. If `compression` is
+        set, only the records it selects are written, but the latest values,
+        recent buffers & listeners still see every update.
 
+        :param batch: List to append (class, id, timestamp, named values)
+                      records to instead of writing them, so the caller can
+                      write many devices' records together. The caller must
+                      also commit the session.
+        """
+        started = perf_counter()
+        timestamp = get_clock().utcnow()
         try:
-            self.last_update = datetime.utcnow()
+            self.last_update = timestamp
         except AttributeError:
             pass
 
-        session.commit()
+        named_values = self._named_values(data)
+        if self.compression is None:
+            self._store_data(timestamp, data, batch)
+        else:
+            for record_time, record_values in self.compression.offer(
+                    self, timestamp, named_values):
+                self._store_data(record_time, [ self.value_type(value, name)
+                                  for name, value in record_values ], batch)
+
         self._latest_data = data
+        if self.recent_capacity:
+            self._record_recent(timestamp, named_values)
+        if getattr(self, "id", None) is not None:
+            latest_values.set(self, timestamp, named_values,
+                              not isinstance(data, (list, tuple)))
+        self._notify_listeners(timestamp, named_values)
+        metrics.observe("data_update_seconds", perf_counter() - started,
+                        **device_labels(self))
         try:
             self.log.debug("Updated data for {cls_name} {name}".format(
                 cls_name=self.__class__.__name__,
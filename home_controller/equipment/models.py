@@ -3,27 +3,104 @@
 
 # Ben Peters (bencpeters@gmail.com)
 
+import asyncio
+import threading
 from enum import Enum
+from functools import partial
 
+import numpy as np
 from sqlalchemy import (
-    Column, Integer, Float, Unicode, Boolean, DateTime
+    Column, Integer, Float, Unicode, Boolean, DateTime, select
 )
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.expression import func
 
 from home_controller.db import (
-    Base, Timestamps, UniqueId, BaseType, Session, HasFloatDataCollection
+    Base, Timestamps, UniqueId, BaseType, Session, HasFloatDataCollection,
+    EpochDateTime, Aggregation, bucket_seconds
 )
-from home_controller.tools import ThreadedExecutor
+from home_controller.tools import ThreadedExecutor, get_clock, metrics
+from home_controller.tools.instrumentation import device_labels
 
 class EquipmentTypes(Enum):
     BINARY = 0
 
+class _CommandState(object):
+    """Requested & applied state of a piece of equipment
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requested = None
+        self.applied = None
+        self.changed_at = None
+        self.busy = False
+        self.timer = None
+        self.commands = 0
+        self.actuations = 0
+        self.noops = 0
+        self.coalesced = 0
+        self.deferred = 0
+
+_commands_lock = threading.Lock()
+
+async def _sleep(seconds):
+    """Sleeps for `seconds` on the active clock, so a `VirtualClock` wakes the
+    sleeper as it's advanced rather than after real time passes
+    """
+    loop = asyncio.get_event_loop()
+    woken = loop.create_future()
+
+    def wake():
+        if not woken.done():
+            woken.set_result(None)
+    timer = get_clock().call_later(seconds, loop.call_soon_threadsafe, wake)
+    try:
+        await woken
+    finally:
+        timer.cancel()
+
+def _seconds(timestamp):
+    return (timestamp - EpochDateTime.epoch).total_seconds()
+
+def _bucket_edges(start, end, bucket):
+    """Returns (bucket starts, edges) covering `start` to `end` (in seconds
+    since the epoch) with buckets aligned to multiples of their width. The
+    edges are clipped to the range.
+    """
+    seconds = bucket_seconds(bucket)
+    if seconds is None:
+        starts = np.array([start])
+    else:
+        starts = np.arange(start - start % seconds, end, seconds)
+    edges = np.clip(np.append(starts, end), start, end)
+    return np.round(starts * 1e6).astype("datetime64[us]"), edges
+
+def _seconds_in(times, mask, edges):
+    """Seconds between each pair of `edges` spent in segments where `mask` is
+    true, segment i running from `times[i]` to `times[i + 1]`
+    """
+    spent = np.concatenate([[0.0], np.cumsum(np.diff(times) * mask)])
+    return np.diff(np.interp(edges, times, spent))
+
 class Equipment(ThreadedExecutor, Timestamps, UniqueId, BaseType,
                 HasFloatDataCollection, Base):
     """Base class for generic implementation of interacting with equipment.
+
+    Commands given to `set` go through a small pipeline before reaching
+    `update_state`: commands for the state the equipment is already in are
+    dropped, a burst of commands arriving while one is being applied collapses
+    to the latest, and switching on or off waits until the equipment has been
+    off for `min_off_time` or on for `min_on_time` seconds. Only actual state
+    changes are written to the DB.
     """
     __tablename__ = 'equipment'
     data_table_name = 'equipment_data'
     types = EquipmentTypes
+    scalar_data = True
+    #: Minimum seconds to stay on (non-zero) before switching off
+    min_on_time = None
+    #: Minimum seconds to stay off (zero) before switching on
+    min_off_time = None
     name = Column(Unicode, nullable=False)
     last_update = Column(DateTime)
 
@@ -33,11 +110,7 @@ class Equipment(ThreadedExecutor, Timestamps, UniqueId, BaseType,
 
     @property
     def current_state(self):
-        if getattr(self, "_latest_data", None) is not None:
-            try:
-                return { v.name: v.value for v in self._latest_data }
-            except TypeError:
-                return self._latest_data.value
+        return self._current_data()
 
     def update_state(self, new_state, *args, **kwargs):
         """Inherit this method to update the state of the equipment
@@ -48,17 +121,292 @@ class Equipment(ThreadedExecutor, Timestamps, UniqueId, BaseType,
         raise NotImplementedError("An equipment definition must implement "
                                   "update_state")
 
+    @property
+    def _commands(self):
+        commands = getattr(self, "_command_state", None)
+        if commands is None:
+            with _commands_lock:
+                commands = getattr(self, "_command_state", None)
+                if commands is None:
+                    commands = self._command_state = _CommandState()
+        return commands
+
+    def command_stats(self):
+        """Returns counts of the commands given & what became of them
+        """
+        commands = self._commands
+        with commands.lock:
+            return {
+                "commands": commands.commands,
+                "actuations": commands.actuations,
+                "noops": commands.noops,
+                "coalesced": commands.coalesced,
+                "deferred": commands.deferred,
+                "pending": commands.requested is not None,
+            }
+
+    def _db_states(self, start, end, channel=None):
+        """Returns (times, states) arrays of the recorded states of one channel
+        from the last change before `start` up to `end`, read in a single
+        query. Times are in seconds since the epoch. Without a `channel`, each
+        record's first value is its state.
+        """
+        if getattr(self, "id", None) is None:
+            return np.empty(0), np.empty(0)
+
+        records = self.record_type.__table__
+        values = self.value_type.__table__
+        joined = records.join(values, values.c.record_id == records.c.id)
+        if channel is not None:
+            matches = values.c.name == channel
+        else:
+            first = aliased(values)
+            matches = values.c.id == select([func.min(first.c.id)]). \
+                where(first.c.record_id == records.c.id).as_scalar()
+        in_device = (records.c.parent_id == self.id) & matches
+        before = select([func.max(records.c.timestamp)]). \
+            select_from(joined). \
+            where(in_device & (records.c.timestamp < start)).as_scalar()
+        query = select([records.c.timestamp, values.c.value]). \
+            select_from(joined). \
+            where(in_device &
+                  (records.c.timestamp >= func.coalesce(before, start)) &
+                  (records.c.timestamp < end)). \
+            order_by(records.c.timestamp, records.c.id)
+
+        rows = Session().connection().execute(query).fetchall()
+        return np.array([ _seconds(row.timestamp) for row in rows ]), \
+            np.array([ np.nan if row.value is None else row.value
+                       for row in rows ], dtype=np.float64)
+
+    def _archived_states(self, start, end, channel=None):
+        """Returns (times, states) arrays of the archived states of one
+        channel, from the last one before `start` up to `end`. See
+        `_db_states`.
+        """
+        if self.archive is None or getattr(self, "id", None) is None:
+            return np.empty(0), np.empty(0)
+
+        channels = None if channel is None else [channel]
+        parts = []
+        for timestamps, columns in (
+                self.archive.read(self, end=start, channels=channels),
+                self.archive.read(self, start, end, channels)):
+            found = next(iter(columns.values()), np.empty(0))
+            keep = ~np.isnan(found)
+            parts.append((timestamps[keep] / 1e6, found[keep]))
+        # only the last state before the range is needed
+        (times, states), (window_times, window_states) = parts
+        return np.concatenate([times[-1:], window_times]), \
+            np.concatenate([states[-1:], window_states])
+
+    def _state_changes(self, start, end, channel=None):
+        """Returns (times, states) arrays: the edges of each period of constant
+        state from `start` to `end`, in seconds since the epoch, and the state
+        during each period. States are NaN while unknown.
+        """
+        db_times, db_states = self._db_states(start, end, channel)
+        archived_times, archived_states = self._archived_states(start, end,
+                                                                channel)
+        times = np.concatenate([archived_times, db_times])
+        states = np.concatenate([archived_states, db_states])
+        order = np.argsort(times, kind="stable")
+        times, states = times[order], states[order]
+
+        first, last = _seconds(start), _seconds(end)
+        before = times < first
+        state = states[before][-1] if before.any() else np.nan
+        return np.concatenate([[first], times[~before], [last]]), \
+            np.concatenate([[state], states[~before]])
+
+    def time_in_state(self, start, end, bucket=None, channel=None):
+        """Returns the seconds spent in each state, per bucket, from the
+        recorded state changes. Time before the first known state isn't
+        counted.
+
+        :param start: Start of the range (inclusive)
+        :param end: End of the range (exclusive)
+        :param bucket: Bucket width as a timedelta or whole seconds, or None
+                       for the whole range. Buckets are aligned to multiples
+                       of their width since the epoch.
+        :param channel: Channel holding the state, for equipment recording
+                        several values
+        :returns: `Aggregation` of the bucket starts & {state: seconds array}
+        """
+        times, states = self._state_changes(start, end, channel)
+        buckets, edges = _bucket_edges(times[0], times[-1], bucket)
+        known = states[~np.isnan(states)]
+        return Aggregation(buckets, {
+            float(state): _seconds_in(times, states == state, edges)
+            for state in np.unique(known) })
+
+    def duty_cycle(self, start, end, bucket=None, channel=None):
+        """Returns the fraction of time the equipment was on (in a non-zero
+        state) per bucket, out of the time its state is known. See
+        `time_in_state`.
+
+        :returns: `Aggregation` of the bucket starts & {"duty_cycle": array,
+                  "on_seconds": array}. The duty cycle is NaN for buckets
+                  without a known state.
+        """
+        times, states = self._state_changes(start, end, channel)
+        buckets, edges = _bucket_edges(times[0], times[-1], bucket)
+        known = ~np.isnan(states)
+        on = _seconds_in(times, known & (states != 0), edges)
+        total = _seconds_in(times, known, edges)
+        duty = np.full(len(on), np.nan)
+        np.divide(on, total, out=duty, where=total > 0)
+        return Aggregation(buckets, { "duty_cycle": duty, "on_seconds": on })
+
+    def command_value(self, new_state):
+        """Returns the state `new_state` would put the equipment in, used to
+        spot no-op commands. Inherit this method if `update_state` coerces its
+        input.
+        """
+        return new_state
+
     def set(self, new_state, *args, **kwargs):
+        """Requests a new state. Returns immediately; the command is applied on
+        the executor unless it's dropped as a no-op or superseded by a later
+        command.
+
+        :returns: False if the command was dropped straight away (e.g. as a
+                  no-op), otherwise True
+        """
+        commands = self._commands
+        with commands.lock:
+            commands.commands += 1
+            if commands.requested is not None:
+                commands.coalesced += 1
+                metrics.increment("equipment_coalesced_total",
+                                  **device_labels(self))
+            commands.requested = (self.command_value(new_state), new_state,
+                                  args, kwargs)
+            if commands.busy:
+                return True
+            commands.busy = True
+        return self._dispatch()
+
+    async def set_async(self, new_state, *args, **kwargs):
+        """Awaitable version of `set`, to be run on the IOLoop. Waits out any
+        minimum on/off time rather than deferring the command.
+
+        :returns: The value(s) returned by `update_state`, or None if the
+                  command was dropped as a no-op
+        """
+        commands = self._commands
+        state = self.command_value(new_state)
+        with commands.lock:
+            commands.commands += 1
+        while True:
+            with commands.lock:
+                if state == commands.applied:
+                    self._drop_noop(commands)
+                    return None
+                wait = self._hold_remaining(commands, state)
+                if wait <= 0:
+                    commands.actuations += 1
+                    break
+            await _sleep(wait)
+
         args = (new_state,) + args
+        try:
+            return await self.execute_async(self.update_state,
+                                            self._apply_state, *args, **kwargs)
+        except Exception as e:
+            self.log.error("Error setting equipment {} to {}: {}".format(
+                self.name,
+                new_state,
+                e
+            ))
+            raise
+
+    def _hold_remaining(self, commands, state):
+        """Seconds until switching to `state` is allowed by the minimum on/off
+        times. Must be called holding `commands.lock`.
+        """
+        if commands.changed_at is None or \
+                bool(state) == bool(commands.applied):
+            return 0.0
+        hold = self.min_on_time if commands.applied else self.min_off_time
+        if not hold:
+            return 0.0
+        return commands.changed_at + hold - get_clock().monotonic()
+
+    def _drop_noop(self, commands):
+        commands.noops += 1
+        metrics.increment("equipment_noops_total", **device_labels(self))
+
+    def _dispatch(self, blocking=True):
+        """Applies the latest requested command, if there is one.
+
+        :param blocking: False when dispatching from the executor (or a
+                         timer), where waiting for the command with `run_sync`
+                         would deadlock, so it's ignored
+        :returns: False if no command was applied or deferred
+        """
+        commands = self._commands
+        with commands.lock:
+            commands.timer = None
+            if commands.requested is None:
+                commands.busy = False
+                return False
+            state, new_state, args, kwargs = commands.requested
+            if state == commands.applied:
+                commands.requested = None
+                commands.busy = False
+                self._drop_noop(commands)
+                return False
+            wait = self._hold_remaining(commands, state)
+            if wait > 0:
+                commands.deferred += 1
+                commands.timer = get_clock().call_later(
+                    wait, partial(self._dispatch, False))
+                return True
+            commands.requested = None
+            commands.actuations += 1
+        if not blocking:
+            kwargs = { k: v for k, v in kwargs.items() if k != "run_sync" }
 
         try:
-            self.execute(self.update_state, self._update_data, *args, **kwargs)
+            future = self.execute(self.update_state, self._apply_state,
+                                  *((new_state,) + args), **kwargs)
         except Exception as e:
             self.log.error("Error setting equipment {} to {}: {}".format(
                 self.name,
                 new_state,
                 e
             ))
+            with commands.lock:
+                commands.busy = False
+            return False
+        future.add_done_callback(self._command_done)
+        return True
+
+    def _command_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.log.error("Error setting equipment {}: {}".format(
+                self.name, future.exception()))
+        self._dispatch(False)
+
+    def _apply_state(self, values):
+        """Records the state reported by `update_state`, writing it to the DB
+        only if it changed
+        """
+        named_values = self._named_values(values)
+        state = named_values[0][1] if len(named_values) == 1 \
+            else tuple(v for _, v in named_values)
+        commands = self._commands
+        with commands.lock:
+            previous = commands.applied
+            changed = previous is None or state != previous
+            if changed:
+                commands.applied = state
+                if commands.changed_at is None or \
+                        bool(state) != bool(previous):
+                    commands.changed_at = get_clock().monotonic()
+        if changed:
+            self._update_data(values)
 
 class BinaryEquipment(Equipment):
     """Basic equipment class that can be either on (1) or off (0)
@@ -78,11 +426,10 @@ class BinaryEquipment(Equipment):
         self.type_ = Equipment.types.BINARY.value
         super(BinaryEquipment, self).__init__(*args, **kwargs)
 
+    def command_value(self, new_state):
+        return 1.0 if new_state > 0.5 else 0.0
+
     def update_state(self, new_state, *args, **kwargs):
         """Update mechanism enforces binary state
         """
-        if (new_state > 0.5):
-            new_state = 1.0
-        else:
-            new_state = 0.0
-        return self.value_type(new_state, self.state_name)
+        return self.value_type(self.command_value(new_state), self.state_name)
@@ -0,0 +1,252 @@
+"""In-process publish/subscribe stream of data collection changes
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import threading
+from collections import deque, namedtuple, OrderedDict
+
+from tornado.ioloop import IOLoop
+
+from home_controller.db import HasFloatDataCollection
+from home_controller.log import logger
+from home_controller.tools import metrics
+from home_controller.tools.instrumentation import device_labels
+
+#: A device update. `key` is (data table name, device id), as used by
+#: `latest_values`, and `values` is a {name: value} dict.
+Change = namedtuple("Change", ["key", "device_type", "name", "timestamp",
+                               "values"])
+
+DROP_OLDEST = "drop_oldest"
+LATEST_ONLY = "latest_only"
+
+class Subscription(object):
+    """A subscriber's filter & queue of undelivered changes. Created by
+    `ChangeHub.subscribe`.
+    """
+    def __init__(self, hub, callback, devices=None, types=None, max_queue=100,
+                 policy=DROP_OLDEST):
+        if policy not in (DROP_OLDEST, LATEST_ONLY):
+            raise ValueError("Unknown queue policy {}".format(policy))
+        self.hub = hub
+        self.callback = callback
+        self.devices = devices
+        self.types = types
+        self.max_queue = max_queue
+        self.policy = policy
+        self.delivered = 0
+        self.dropped = 0
+        self.batches = 0
+        self._lock = threading.Lock()
+        if policy == LATEST_ONLY:
+            self._queue = OrderedDict()
+        else:
+            self._queue = deque()
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    def offer(self, change):
+        """Queues `change`, applying the queue policy. Returns True if an
+        older change was dropped to make room.
+        """
+        dropped = False
+        with self._lock:
+            if self.policy == LATEST_ONLY:
+                dropped = self._queue.pop(change.key, None) is not None
+                self._queue[change.key] = change
+            else:
+                if len(self._queue) >= self.max_queue:
+                    self._queue.popleft()
+                    dropped = True
+                self._queue.append(change)
+            if dropped:
+                self.dropped += 1
+        return dropped
+
+    def take(self):
+        """Removes & returns every queued change, oldest first
+        """
+        with self._lock:
+            if self.policy == LATEST_ONLY:
+                changes = list(self._queue.values())
+            else:
+                changes = list(self._queue)
+            self._queue.clear()
+        return changes
+
+    def cancel(self):
+        self.hub.unsubscribe(self)
+
+    def stats(self):
+        return {
+            "policy": self.policy,
+            "queue_depth": self.queue_depth,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "batches": self.batches,
+        }
+
+class ChangeHub(object):
+    """Fans device updates out to subscribers on the IOLoop.
+
+    Updates are taken from the data collection update path (sensor readings
+    and equipment state changes alike) and queued per subscriber without
+    touching the DB. Publishing only appends to the matching subscribers'
+    bounded queues, so it never waits on a subscriber. Every `batch_interval`
+    seconds the queued changes are delivered on the IOLoop, one
+    `callback(changes)` call per subscriber.
+
+    Usage::
+
+        hub = ChangeHub()
+        hub.attach()
+        hub.subscribe(websocket.send_changes, types=[Sensor],
+                      policy=LATEST_ONLY)
+    """
+    def __init__(self, batch_interval=0.1, io_loop=None):
+        self.batch_interval = batch_interval
+        self.io_loop = io_loop
+        self.published = 0
+        self._by_device = {}
+        self._by_type = {}
+        self._unfiltered = []
+        self._dirty = set()
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    @property
+    def log(self):
+        return logger
+
+    @property
+    def subscriptions(self):
+        with self._lock:
+            subs = list(self._unfiltered)
+            for index in (self._by_device, self._by_type):
+                for group in index.values():
+                    subs.extend(s for s in group if s not in subs)
+        return subs
+
+    def attach(self):
+        """Starts publishing data collection updates. Must be called on the
+        IOLoop thread, or with `io_loop` given.
+        """
+        if self.io_loop is None:
+            self.io_loop = IOLoop.current()
+        HasFloatDataCollection.add_data_listener(self.publish_update)
+
+    def detach(self):
+        HasFloatDataCollection.remove_data_listener(self.publish_update)
+
+    def subscribe(self, callback, devices=None, types=None, max_queue=100,
+                  policy=DROP_OLDEST):
+        """Registers `callback` to receive lists of `Change` tuples.
+
+        :param devices: Devices (or (data table name, id) keys) to receive
+                        changes for. Defaults to all.
+        :param types: Device classes (including subclasses) to receive changes
+                      for. Defaults to all.
+        :param max_queue: Most changes held for the subscriber between
+                          deliveries, with the `DROP_OLDEST` policy
+        :param policy: `DROP_OLDEST` drops the oldest queued change when the
+                       queue is full; `LATEST_ONLY` keeps only the newest
+                       change per device.
+        :returns: The `Subscription`
+        """
+        sub = Subscription(self, callback, devices, types, max_queue, policy)
+        with self._lock:
+            if devices is None and types is None:
+                self._unfiltered.append(sub)
+            for device in devices or ():
+                self._by_device.setdefault(self._key(device), []).append(sub)
+            for cls in types or ():
+                self._by_type.setdefault(cls, []).append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            if sub in self._unfiltered:
+                self._unfiltered.remove(sub)
+            for index in (self._by_device, self._by_type):
+                for key in list(index):
+                    if sub in index[key]:
+                        index[key].remove(sub)
+                    if not index[key]:
+                        del index[key]
+            self._dirty.discard(sub)
+
+    @staticmethod
+    def _key(device):
+        if isinstance(device, tuple):
+            return device
+        return (device.data_table_name, device.id)
+
+    def _matching(self, key, device_type):
+        """Subscriptions whose filters match. Must be called holding the
+        lock.
+        """
+        subs = list(self._unfiltered)
+        for sub in self._by_device.get(key, ()):
+            if sub.types is None or issubclass(device_type, tuple(sub.types)):
+                subs.append(sub)
+        for cls in device_type.__mro__:
+            for sub in self._by_type.get(cls, ()):
+                if sub.devices is None and sub not in subs:
+                    subs.append(sub)
+        return subs
+
+    def publish_update(self, device, timestamp, named_values):
+        """Data listener registered by `attach`
+        """
+        self.publish(Change(self._key(device), type(device).__name__,
+                            device_labels(device)["device"], timestamp,
+                            dict(named_values)), type(device))
+
+    def publish(self, change, device_type):
+        """Queues `change` for the matching subscribers. Safe to call from any
+        thread.
+        """
+        schedule = False
+        with self._lock:
+            self.published += 1
+            for sub in self._matching(change.key, device_type):
+                if sub.offer(change):
+                    metrics.increment("pubsub_dropped_total",
+                                      policy=sub.policy)
+                self._dirty.add(sub)
+            if self._dirty and not self._scheduled and \
+                    self.io_loop is not None:
+                self._scheduled = schedule = True
+        if schedule:
+            self.io_loop.add_callback(self.io_loop.call_later,
+                                      self.batch_interval, self.deliver)
+
+    def deliver(self):
+        """Delivers every queued change. Runs on the IOLoop.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            self._scheduled = False
+        for sub in dirty:
+            changes = sub.take()
+            if not changes:
+                continue
+            sub.batches += 1
+            sub.delivered += len(changes)
+            try:
+                sub.callback(changes)
+            except Exception as e:
+                self.log.error("Error delivering changes to {}: {}".format(
+                    sub.callback, e))
+
+    def stats(self):
+        subs = self.subscriptions
+        return {
+            "published": self.published,
+            "subscriptions": len(subs),
+            "queued": sum(s.queue_depth for s in subs),
+            "dropped": sum(s.dropped for s in subs),
+        }
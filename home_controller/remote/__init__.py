@@ -0,0 +1,3 @@
+from .protocol import Batch, encode_batch, decode_batch
+from .node import Node
+from .ingest import IngestServer, IngestHandler, IngestedBatch
@@ -0,0 +1,204 @@
+"""Controller endpoint receiving readings from remote nodes
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import Column, Integer, Unicode
+from tornado.ioloop import IOLoop
+from tornado.web import Application, RequestHandler
+
+from home_controller.db import Base, Session
+from home_controller.log import logger
+from home_controller.sensors import Sensor
+from home_controller.tools import metrics
+from .protocol import decode_batch
+
+class IngestedBatch(Base):
+    """Sequence number of the last batch written from each node process, so
+    that resent batches are recognised after the controller restarts
+    """
+    __tablename__ = "ingested_batches"
+    node = Column(Unicode, primary_key=True)
+    boot = Column(Unicode, primary_key=True)
+    seq = Column(Integer, nullable=False)
+
+class IngestHandler(RequestHandler):
+    """Accepts a batch POSTed by a `Node` and replies with its
+    acknowledgement
+    """
+    def initialize(self, server):
+        self.server = server
+
+    async def post(self):
+        try:
+            batch = decode_batch(self.request.body)
+        except ValueError as e:
+            self.set_status(400)
+            self.write({ "error": str(e) })
+            return
+        try:
+            ack = await self.server.ingest(batch)
+        except Exception as e:
+            self.server.log.error("Error ingesting batch {} from {}: {}".format(
+                batch.seq, batch.node, e))
+            self.set_status(500)
+            self.write({ "error": str(e) })
+            return
+        self.write(ack)
+
+class IngestServer(object):
+    """Writes the readings shipped by remote nodes.
+
+    Each batch is written in a single transaction, with Core inserts, on a
+    dedicated thread (so the writes use a single DB session and don't block
+    the IOLoop). Data listeners then see every reading, as if the devices were
+    local. A batch is acknowledged once it's committed. Nodes resend
+    unacknowledged batches, so the node, boot & sequence number of the last
+    batch from each node process are committed along with its readings (as
+    an `IngestedBatch`), and batches already written are only acknowledged
+    again, even after a failed write or a restart.
+
+    Device keys sent by nodes are mapped to devices registered with
+    `register`, or else looked up by name among `lookup_class` objects.
+    Readings for unknown keys are skipped and reported in the
+    acknowledgement.
+
+    Usage::
+
+        server = IngestServer()
+        server.listen(8888)
+    """
+    def __init__(self, lookup_class=Sensor):
+        self.lookup_class = lookup_class
+        self.batches = 0
+        self.records = 0
+        self.duplicates = 0
+        self._devices = {}
+        self._received = {}
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="ingest")
+
+    @property
+    def log(self):
+        return logger
+
+    def register(self, device, key=None):
+        """Maps readings sent under `key` (defaults to the device's name) to
+        `device`, which must already be saved
+        """
+        key = key if key is not None else device.name
+        with self._lock:
+            self._devices[key] = (type(device), device.id, device)
+
+    def application(self, path="/ingest", **settings):
+        """Returns a tornado `Application` serving the ingest endpoint
+        """
+        return Application([ (path, IngestHandler, { "server": self }) ],
+                           **settings)
+
+    def listen(self, port, address="", path="/ingest"):
+        """Serves the ingest endpoint on `port`. Returns the HTTP server.
+        """
+        return self.application(path).listen(port, address)
+
+    async def ingest(self, batch):
+        """Writes a decoded batch, unless it was already written. Returns the
+        acknowledgement.
+        """
+        return await IOLoop.current().run_in_executor(self._writer,
+                                                      self._write, batch)
+
+    def _resolve(self, key):
+        with self._lock:
+            entry = self._devices.get(key)
+        if entry is None and self.lookup_class is not None:
+            device = Session().query(self.lookup_class). \
+                filter_by(name=key).first()
+            if device is not None:
+                entry = (type(device), device.id, device)
+                with self._lock:
+                    self._devices[key] = entry
+        return entry
+
+    def _written_seq(self, session, source):
+        """Returns the sequence number of the last batch written from `source`
+        """
+        seq = self._received.get(source)
+        if seq is None:
+            node, boot = source
+            seq = session.query(IngestedBatch.seq). \
+                filter_by(node=node, boot=boot).scalar() or 0
+            self._received[source] = seq
+        return seq
+
+    def _write(self, batch):
+        """Runs on the writer thread
+        """
+        ack = { "node": batch.node, "boot": batch.boot, "seq": batch.seq,
+                "records": 0, "duplicate": False, "unknown": [] }
+        source = (batch.node, batch.boot)
+        session = Session()
+        try:
+            if self._written_seq(session, source) >= batch.seq:
+                session.rollback()
+                self.duplicates += 1
+                ack["duplicate"] = True
+                return ack
+
+            by_class = OrderedDict()
+            for key, timestamp, named_values in batch.readings:
+                entry = self._resolve(key)
+                if entry is None:
+                    if key not in ack["unknown"]:
+                        ack["unknown"].append(key)
+                    continue
+                cls, device_id, device = entry
+                by_class.setdefault(cls, []).append(
+                    (device, device_id, timestamp, list(named_values.items())))
+
+            connection = session.connection()
+            newest = OrderedDict()
+            for cls, readings in by_class.items():
+                cls._insert_records(connection, [
+                    (device_id, timestamp, named_values)
+                    for _, device_id, timestamp, named_values in readings ])
+                latest = newest[cls] = {}
+                for _, device_id, timestamp, named_values in readings:
+                    if device_id not in latest or \
+                            timestamp >= latest[device_id][0]:
+                        latest[device_id] = (timestamp, named_values)
+                cls._advance_last_update(connection, latest)
+            session.merge(IngestedBatch(node=batch.node, boot=batch.boot,
+                                        seq=batch.seq))
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        self._received[source] = batch.seq
+
+        for cls, readings in by_class.items():
+            cls._put_latest(newest[cls])
+            for device, _, timestamp, named_values in readings:
+                device._notify_listeners(timestamp, named_values)
+            ack["records"] += len(readings)
+
+        self.batches += 1
+        self.records += ack["records"]
+        metrics.increment("ingest_batches_total", node=batch.node)
+        if ack["unknown"]:
+            self.log.warning("Skipped readings from {} for unknown devices: "
+                             "{}".format(batch.node, ", ".join(
+                                 str(k) for k in ack["unknown"])))
+        return ack
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "records": self.records,
+            "duplicates": self.duplicates,
+            "nodes": len({ node for node, _ in self._received }),
+        }
@@ -0,0 +1,287 @@
+"""Remote sensor node, shipping readings to a central controller
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import json
+import os
+import threading
+from collections import deque
+from functools import partial
+from time import time
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.locks import Event
+
+from home_controller.db import HasFloatDataCollection
+from home_controller.log import logger
+from home_controller.tools import PollingScheduler, get_clock
+from .protocol import encode_batch, decode_batch, CONTENT_TYPE
+
+class _Outgoing(object):
+    __slots__ = ("boot", "seq", "data", "records", "path")
+
+    def __init__(self, boot, seq, data, records, path=None):
+        self.boot = boot
+        self.seq = seq
+        self.data = data
+        self.records = records
+        self.path = path
+
+class Node(object):
+    """Runs sensors on a remote machine without a DB, and ships their
+    readings to the controller's `IngestServer`.
+
+    Sensors are read on their executors as usual, polled by a
+    `PollingScheduler`. Readings are buffered and sealed into a compressed
+    batch every `flush_interval` seconds, or sooner once `batch_size` have
+    accumulated. Batches are posted to the controller one at a time, in order,
+    and dropped only once the controller has acknowledged them. While the
+    controller can't be reached, batches are kept (up to `max_batches`) and
+    retried with exponential backoff.
+
+    With a `spool_directory`, every batch is also written to disk until it's
+    acknowledged, so readings survive a restart of the node.
+
+    Usage::
+
+        node = Node("garage", "http://controller:8888/ingest",
+                    spool_directory="/var/spool/home_controller")
+        node.add(SineWaveSensor(sensor_name="garage temperature"), 30)
+        node.start()
+        IOLoop.current().start()
+    """
+    def __init__(self, name, url, spool_directory=None, batch_size=500,
+                 flush_interval=1.0, max_batches=10000, retry_interval=1.0,
+                 max_retry_interval=60.0, request_timeout=10.0, io_loop=None):
+        """
+        :param name: Name of the node, reported to the controller
+        :param url: URL of the controller's ingest endpoint
+        :param spool_directory: Directory to keep unacknowledged batches in
+        :param batch_size: Readings that trigger sealing a batch early
+        :param flush_interval: Seconds between sealing batches
+        :param max_batches: Most unacknowledged batches kept. The oldest are
+                            dropped beyond this.
+        :param retry_interval: Initial delay before resending a batch
+        :param max_retry_interval: Longest delay between resends
+        :param request_timeout: Seconds to wait for the controller
+        :param io_loop: IOLoop to run on. Defaults to the current IOLoop when
+                        `start` is called.
+        """
+        self.name = name
+        self.url = url
+        self.spool_directory = spool_directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_batches = max_batches
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.request_timeout = request_timeout
+        self.io_loop = io_loop
+        self.scheduler = PollingScheduler(io_loop)
+        self.boot = "{}-{}".format(int(time() * 1e6), os.getpid())
+        self.sent = 0
+        self.sent_records = 0
+        self.sent_bytes = 0
+        self.retries = 0
+        self.dropped = 0
+        self._seq = 0
+        self._readings = []
+        self._outgoing = deque()
+        self._lock = threading.Lock()
+        self._wake = Event()
+        self._flusher = None
+        self._running = False
+
+        if spool_directory is not None:
+            os.makedirs(spool_directory, exist_ok=True)
+            self._load_spool()
+
+    @property
+    def log(self):
+        return logger
+
+    @property
+    def pending(self):
+        """Number of sealed batches awaiting acknowledgement
+        """
+        return len(self._outgoing)
+
+    def add(self, sensor, interval, key=None, **kwargs):
+        """Polls `sensor` every `interval` seconds, shipping its readings under
+        `key` (defaults to the sensor's name), which the controller maps to
+        its own device. Other arguments are passed to `PollingScheduler.add`.
+        """
+        key = key if key is not None else sensor.name
+        return self.scheduler.add(sensor, interval,
+                                  task=partial(self.update, sensor, key),
+                                  **kwargs)
+
+    async def update(self, sensor, key):
+        """Reads `sensor` on its executor and buffers the reading
+        """
+        try:
+            await sensor.execute_async(sensor.read,
+                                       partial(self._record_data, key))
+        except Exception as e:
+            self.log.error("Error reading sensor {}: {}".format(key, e))
+            raise
+
+    def _record_data(self, key, data):
+        self.record(key, get_clock().utcnow(),
+                    HasFloatDataCollection._named_values(data))
+
+    def record(self, key, timestamp, named_values):
+        """Buffers a reading for shipping. Safe to call from any thread.
+
+        :param named_values: List of (name, value) tuples
+        """
+        with self._lock:
+            self._readings.append((key, timestamp, list(named_values)))
+            full = len(self._readings) >= self.batch_size
+        if full and self.io_loop is not None:
+            self.io_loop.add_callback(self.flush)
+
+    def flush(self):
+        """Seals the buffered readings into a batch and wakes the sender
+        """
+        with self._lock:
+            readings, self._readings = self._readings, []
+        if readings:
+            self._seq += 1
+            batch = _Outgoing(self.boot, self._seq, encode_batch(
+                self.name, self.boot, self._seq, readings), len(readings))
+            self._spool(batch)
+            self._outgoing.append(batch)
+            while len(self._outgoing) > self.max_batches:
+                self._unspool(self._outgoing.popleft())
+                self.dropped += 1
+        if self._outgoing:
+            self._wake.set()
+
+    def _spool(self, batch):
+        if self.spool_directory is None:
+            return
+        name = "{}-{:010d}.batch".format(self.boot, batch.seq)
+        batch.path = os.path.join(self.spool_directory, name)
+        temp = batch.path + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(batch.data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, batch.path)
+
+    def _unspool(self, batch):
+        if batch.path is not None:
+            try:
+                os.remove(batch.path)
+            except FileNotFoundError:
+                pass
+
+    def _load_spool(self):
+        """Queues the batches left unacknowledged by a previous run
+        """
+        for name in sorted(os.listdir(self.spool_directory)):
+            if not name.endswith(".batch"):
+                continue
+            path = os.path.join(self.spool_directory, name)
+            with open(path, "rb") as f:
+                data = f.read()
+            try:
+                batch = decode_batch(data)
+            except ValueError as e:
+                self.log.error("Dropping spooled batch {}: {}".format(name, e))
+                os.remove(path)
+                continue
+            self._outgoing.append(_Outgoing(batch.boot, batch.seq, data,
+                                            len(batch.readings), path))
+        if self._outgoing:
+            self.log.info("Resending {} spooled batches".format(
+                len(self._outgoing)))
+
+    def start(self):
+        if self._running:
+            return
+        if self.io_loop is None:
+            self.io_loop = IOLoop.current()
+        self.scheduler.io_loop = self.io_loop
+        self._running = True
+        self.scheduler.start()
+        self._flusher = PeriodicCallback(self.flush,
+                                         self.flush_interval * 1000)
+        self._flusher.start()
+        self.io_loop.add_callback(self._send_loop)
+
+    def stop(self):
+        """Stops polling & sending. Unsent readings are sealed (and spooled)
+        first.
+        """
+        self.scheduler.stop()
+        if self._flusher is not None:
+            self._flusher.stop()
+            self._flusher = None
+        self.flush()
+        self._running = False
+        self._wake.set()
+
+    async def drain(self, timeout=None):
+        """Seals the buffered readings and waits until every batch has been
+        acknowledged. Returns False if `timeout` seconds pass first.
+        """
+        self.flush()
+        deadline = None if timeout is None else self.io_loop.time() + timeout
+        while self._outgoing:
+            if deadline is not None and self.io_loop.time() >= deadline:
+                return False
+            await gen.sleep(0.01)
+        return True
+
+    async def _send_loop(self):
+        client = AsyncHTTPClient()
+        delay = self.retry_interval
+        while self._running:
+            if not self._outgoing:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+
+            batch = self._outgoing[0]
+            try:
+                response = await client.fetch(
+                    self.url, method="POST", body=batch.data,
+                    headers={ "Content-Type": CONTENT_TYPE },
+                    request_timeout=self.request_timeout)
+                ack = json.loads(response.body.decode("utf-8"))
+                if (ack.get("boot"), ack.get("seq")) != \
+                        (batch.boot, batch.seq):
+                    raise ValueError("Unexpected acknowledgement {}".format(
+                                     ack))
+            except (HTTPClientError, OSError, ValueError) as e:
+                self.retries += 1
+                self.log.warning("Error sending batch {} to {}, retrying in "
+                                 "{:.1f}s: {}".format(batch.seq, self.url,
+                                                      delay, e))
+                await gen.sleep(delay)
+                delay = min(delay * 2, self.max_retry_interval)
+                continue
+
+            delay = self.retry_interval
+            if self._outgoing and self._outgoing[0] is batch:
+                self._outgoing.popleft()
+            self._unspool(batch)
+            self.sent += 1
+            self.sent_records += batch.records
+            self.sent_bytes += len(batch.data)
+
+    def stats(self):
+        return {
+            "buffered": len(self._readings),
+            "pending": self.pending,
+            "sent": self.sent,
+            "sent_records": self.sent_records,
+            "sent_bytes": self.sent_bytes,
+            "retries": self.retries,
+            "dropped": self.dropped,
+        }
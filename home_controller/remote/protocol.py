@@ -0,0 +1,104 @@
+"""Binary batch format used between remote nodes and the controller
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import json
+import struct
+import zlib
+from collections import namedtuple, OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+
+MAGIC = b"HCB1"
+CONTENT_TYPE = "application/x-home-controller-batch"
+
+EPOCH = datetime(1970, 1, 1)
+_HEADER_LENGTH = struct.Struct("<I")
+
+#: A decoded batch. `readings` is a list of (device key, timestamp,
+#: {name: value}) tuples.
+Batch = namedtuple("Batch", ["node", "boot", "seq", "readings"])
+
+def encode_batch(node, boot, seq, readings, level=6):
+    """Packs readings into a compressed batch.
+
+    Readings are grouped by device, and each device's timestamps (delta
+    encoded microseconds) and channels are written as fixed-width columns,
+    with NaN for channels missing from a reading. The whole batch is then
+    deflated.
+
+    :param node: Name of the sending node
+    :param boot: Identifier of the node process, so that sequence numbers
+                 restarting from 0 aren't taken for duplicates
+    :param seq: Sequence number of the batch
+    :param readings: Iterable of (device key, timestamp, [(name, value)])
+    :param level: zlib compression level
+    :returns: The batch as bytes
+    """
+    devices = OrderedDict()
+    for key, timestamp, named_values in readings:
+        devices.setdefault(key, []).append((timestamp, named_values))
+
+    groups, body = [], []
+    for key, entries in devices.items():
+        entries.sort(key=lambda entry: entry[0])
+        channels = []
+        for _, named_values in entries:
+            channels.extend(name for name, _ in named_values
+                            if name not in channels)
+        micros = np.array([ (t - EPOCH) // timedelta(microseconds=1)
+                            for t, _ in entries ], dtype="<i8")
+        body.append(np.diff(micros, prepend=0).astype("<i8").tobytes())
+        for name in channels:
+            column = np.full(len(entries), np.nan, dtype="<f8")
+            for i, (_, named_values) in enumerate(entries):
+                for n, value in named_values:
+                    if n == name and value is not None:
+                        column[i] = value
+            body.append(column.tobytes())
+        groups.append({ "key": key, "channels": channels,
+                        "count": len(entries) })
+
+    header = json.dumps({ "node": node, "boot": boot, "seq": seq,
+                          "groups": groups }).encode("utf-8")
+    payload = _HEADER_LENGTH.pack(len(header)) + header + b"".join(body)
+    return MAGIC + zlib.compress(payload, level)
+
+def decode_batch(data):
+    """Unpacks a batch made by `encode_batch`.
+
+    :returns: `Batch`
+    :raises ValueError: If `data` isn't a valid batch
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a reading batch")
+    try:
+        payload = zlib.decompress(data[len(MAGIC):])
+        length, = _HEADER_LENGTH.unpack_from(payload)
+        offset = _HEADER_LENGTH.size
+        header = json.loads(payload[offset:offset + length].decode("utf-8"))
+        offset += length
+
+        readings = []
+        for group in header["groups"]:
+            count = group["count"]
+            micros = np.cumsum(np.frombuffer(payload, "<i8", count, offset))
+            offset += 8 * count
+            columns = []
+            for name in group["channels"]:
+                columns.append((name, np.frombuffer(payload, "<f8", count,
+                                                    offset)))
+                offset += 8 * count
+            for i, us in enumerate(micros.tolist()):
+                readings.append((group["key"],
+                                 EPOCH + timedelta(microseconds=us),
+                                 { name: float(values[i])
+                                   for name, values in columns
+                                   if not np.isnan(values[i]) }))
+        if offset != len(payload):
+            raise ValueError("{} trailing bytes".format(len(payload) - offset))
+    except (zlib.error, struct.error, KeyError, TypeError) as e:
+        raise ValueError("Malformed reading batch: {}".format(e))
+    return Batch(header["node"], header["boot"], header["seq"], readings)
@@ -1,2 +1,3 @@
 from .models import Sensor
 from .generated import RandomValuesSensor, SineWaveSensor
+from .group import SensorGroup
@@ -7,6 +7,9 @@ import random
 from time import time
 from math import sin, pi
 
+import numpy as np
+
+from home_controller.tools import get_clock
 from .models import Sensor
 
 class RandomValuesSensor(Sensor):
@@ -29,6 +32,16 @@ class RandomValuesSensor(Sensor):
         return [ self.value_type(random.random(), "value_{}".format(i)) \
                  for i in range(0, 2) ]
 
+    def read_batch(self, timestamps):
+        """Generates values for every timestamp in one vectorized call
+
+        :param timestamps: Array of times, in seconds since the epoch
+        :returns: Dict of {name: values array}
+        """
+        n = len(timestamps)
+        return { "value_{}".format(i): np.random.random_sample(n)
+                 for i in range(0, 2) }
+
 class SineWaveSensor(Sensor):
     """Generates a Sine wave betwen the specified limits with the specified
     period.
@@ -54,7 +67,7 @@ class SineWaveSensor(Sensor):
         if not self.max > self.min:
             raise ValueError("max_value ({}) must be greater than min_value "
                              "({})".format(max_value, min_value))
-        self._start = time()
+        self._start = get_clock().time()
         self.type_ = self.types.SINE_WAVE.value
         super(SineWaveSensor, self).__init__(**kwargs)
 
@@ -64,5 +77,29 @@ class SineWaveSensor(Sensor):
         """
         amp = (self.max - self.min) / 2
         offset = amp + self.min
-        interval = (time() - self._start) * 2 * pi / self.period
+        interval = (get_clock().time() - self._start) * 2 * pi / self.period
         return [ self.value_type(sin(interval) * amp + offset, "value") ]
+
+    def process_config(self):
+        return { "start": self._start, "period": self.period,
+                 "min": self.min, "max": self.max }
+
+    @staticmethod
+    def process_read(config, *args, **kwargs):
+        """`read` for process pool execution
+        """
+        amp = (config["max"] - config["min"]) / 2
+        interval = (time() - config["start"]) * 2 * pi / config["period"]
+        return { "value": sin(interval) * amp + amp + config["min"] }
+
+    def read_batch(self, timestamps):
+        """Computes the wave at every timestamp in one vectorized call
+
+        :param timestamps: Array of times, in seconds since the epoch
+        :returns: Dict of {name: values array}
+        """
+        amp = (self.max - self.min) / 2
+        offset = amp + self.min
+        intervals = (np.asarray(timestamps, dtype=np.float64) - self._start) * \
+            2 * pi / self.period
+        return { "value": np.sin(intervals) * amp + offset }
@@ -0,0 +1,122 @@
+"""Sensors read together over a shared bus
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from collections import OrderedDict
+
+from home_controller.db import Session
+from home_controller.tools import ThreadedExecutor, CircuitOpenError, get_pool
+
+class SensorGroup(ThreadedExecutor):
+    """A set of sensors sharing a bus (1-wire probes, the channels of an ADC)
+    that are read with one bus transaction per sweep.
+
+    `read_all` returns every member's readings at once; they are then written
+    in a single DB transaction. Members keep their own rows, current values &
+    history, and are pinned to the group's executor lane so that updating a
+    member on its own stays on the same thread (and DB session).
+
+    Usage::
+
+        class OneWireBus(SensorGroup):
+            def read_all(self):
+                raw = self.bus.convert_all()
+                return { s: [ s.value_type(raw[s.address], "temperature") ]
+                         for s in self.sensors }
+
+        bus = OneWireBus("1-wire", probes)
+        bus.update()
+    """
+    def __init__(self, name, sensors=(), executor_pool=None):
+        """
+        :param name: Name used in logs & metrics
+        :param sensors: Member sensors
+        :param executor_pool: Executor pool to run on. Defaults to
+                              `ThreadedExecutor.executor_pool`.
+        """
+        if executor_pool is not None:
+            self.executor_pool = executor_pool
+        self.name = name
+        self.sensors = []
+        super(SensorGroup, self).__init__()
+        for sensor in sensors:
+            self.add(sensor)
+
+    def add(self, sensor):
+        """Adds a member. Sensors must be added before they're first updated,
+        so that they run on the group's thread from the start.
+        """
+        sensor.executor_pool = self.executor_pool
+        get_pool(self.executor_pool).share_lane(sensor, self)
+        self.sensors.append(sensor)
+
+    def remove(self, sensor):
+        self.sensors.remove(sensor)
+
+    def read_all(self, *args, **kwargs):
+        """Inherit this method to read every member in one bus transaction.
+
+        This method should be thread-safe, as it will be run in its own thread.
+        The default reads the members one at a time.
+
+        :returns: Dict of {sensor: data}, where data is what `sensor.read`
+                  would return. Members missing from the dict (or mapped to
+                  None) aren't updated.
+        """
+        return { sensor: sensor.read(*args, **kwargs)
+                 for sensor in self.sensors }
+
+    def update(self, *args, **kwargs):
+        """Reads & stores every member. `read_all` will be called in its own
+        thread.
+        """
+        try:
+            return self.execute(self.read_all, self._update_all, *args,
+                                **kwargs)
+        except CircuitOpenError as e:
+            self.log.debug(str(e))
+        except Exception as e:
+            self.log.error("Error reading sensor group {}: {}".format(
+                self.name, e))
+
+    async def update_async(self, *args, **kwargs):
+        """Awaitable version of `update`, to be run on the IOLoop. Returns the
+        readings.
+        """
+        try:
+            return await self.execute_async(self.read_all, self._update_all,
+                                            *args, **kwargs)
+        except Exception as e:
+            self.log.error("Error reading sensor group {}: {}".format(
+                self.name, e))
+            raise
+
+    def _update_all(self, readings):
+        """Updates every member with its readings and writes them together,
+        with one multi-row insert per data table, and moves each member's
+        `last_update` forward
+        """
+        session = Session()
+        try:
+            batch = []
+            for sensor, data in readings.items():
+                if data is not None:
+                    sensor._update_data(data, batch)
+
+            by_class = OrderedDict()
+            for cls, parent_id, timestamp, named_values in batch:
+                _, records, newest = by_class.setdefault(cls.record_type,
+                                                         (cls, [], {}))
+                records.append((parent_id, timestamp, named_values))
+                newest[parent_id] = (timestamp, named_values)
+            connection = session.connection()
+            for cls, records, newest in by_class.values():
+                cls._insert_records(connection, records)
+                # members needn't belong to this thread's session, so their
+                # last_update is written by id, as in `_persist_data`
+                cls._advance_last_update(connection, newest)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
@@ -5,6 +5,7 @@
 
 from enum import Enum
 
+import numpy as np
 from sqlalchemy import (
     Column, Unicode, DateTime
 )
@@ -12,7 +13,7 @@ from sqlalchemy import (
 from home_controller.db import (
     Base, Timestamps, UniqueId, BaseType, Session, HasFloatDataCollection
 )
-from home_controller.tools import ThreadedExecutor
+from home_controller.tools import ThreadedExecutor, CircuitOpenError
 
 class SensorTypes(Enum):
     RANDOM_VALUES = 0
@@ -26,6 +27,10 @@ class Sensor(ThreadedExecutor, Timestamps, UniqueId, BaseType,
     __tablename__ = 'sensors'
     data_table_name = 'sensor_data'
     types = SensorTypes
+    # a queued read is superseded by a newer one, and a hung bus shouldn't
+    # hold up the other sensors on its executor lane
+    max_pending = 1
+    read_timeout = 10.0
     name = Column(Unicode, nullable=False)
     last_update = Column(DateTime)
 
@@ -35,28 +40,65 @@ class Sensor(ThreadedExecutor, Timestamps, UniqueId, BaseType,
 
     @property
     def current_value(self):
-        if getattr(self, "_latest_data", None) is not None:
-            try:
-                return { v.name: v.value for v in self._latest_data }
-            except TypeError:
-                return self._latest_data.value
+        return self._current_data()
 
     def read(self, *args, **kwargs):
         """Inherit this method to read a sensor
 
         This method should be thread-safe, and take care of securing locks on
         any required shared resources, as it will be run in its own thread.
+        Drivers built on async I/O can instead define `read` as a coroutine
+        function and be updated with `update_async`.
         """
         raise NotImplementedError("A sensor defintion must implement read")
 
+    def read_batch(self, timestamps):
+        """Inherit this method to produce readings for many timestamps at once,
+        e.g. for simulated sensors or drivers that return buffered samples.
+
+        :param timestamps: Array of times, in seconds since the epoch
+        :returns: Dict of {name: values array}
+        """
+        raise NotImplementedError("{} does not support batch reads".format(
+                                  self.__class__.__name__))
+
+    def generate(self, start, end, step):
+        """Produces readings on a regular time grid using `read_batch`.
+
+        :param start: First timestamp, in seconds since the epoch
+        :param end: End of the grid (exclusive), in seconds since the epoch
+        :param step: Time between readings, in seconds
+        :returns: (timestamps array, {name: values array}), which can be
+                  written with `store_arrays`
+        """
+        timestamps = np.arange(start, end, step, dtype=np.float64)
+        return timestamps, self.read_batch(timestamps)
+
     def update(self, *args, **kwargs):
         """Method to update this sensor's value.
 
-        `read` will be called in its own thread.
+        `read` will be called in its own thread. Returns the executor future.
+        """
+        try:
+            return self.execute(self.read, self._update_data, *args, **kwargs)
+        except CircuitOpenError as e:
+            self.log.debug(str(e))
+        except Exception as e:
+            self.log.error("Error reading sensor {}: {}".format(
+                self.name, e
+            ))
+
+    async def update_async(self, *args, **kwargs):
+        """Awaitable version of `update`, to be run on the IOLoop.
+
+        `read` may be a coroutine function, in which case it is awaited on the
+        loop rather than run in a thread. Returns the values read.
         """
         try:
-            self.execute(self.read, self._update_data, *args, **kwargs)
+            return await self.execute_async(self.read, self._update_data,
+                                            *args, **kwargs)
         except Exception as e:
             self.log.error("Error reading sensor {}: {}".format(
                 self.name, e
             ))
+            raise
@@ -0,0 +1,186 @@
+"""Deterministic simulation of devices on virtual time
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import heapq
+from itertools import count
+from time import perf_counter
+
+from home_controller.log import logger
+from home_controller.tools import (
+    ThreadedExecutor, VirtualClock, INLINE, set_clock, metrics
+)
+
+class _Periodic(object):
+    """Calls `task` every `interval` seconds of virtual time, without
+    drifting
+    """
+    def __init__(self, simulation, device, task, interval, phase):
+        self.simulation = simulation
+        self.device = device
+        self.task = task
+        self.interval = interval
+        self.due = simulation.clock.time() + phase
+        self.cancelled = False
+        self._timer = simulation.clock.call_later(phase, self._run)
+
+    def _run(self):
+        if self.cancelled:
+            return
+        self.simulation.updates += 1
+        try:
+            self.task()
+        except Exception as e:
+            self.simulation.log.error("Error updating {} in simulation: "
+                                      "{}".format(self.device, e))
+        clock = self.simulation.clock
+        self.due += self.interval
+        self._timer = clock.call_later(self.due - clock.time(), self._run)
+
+    def cancel(self):
+        self.cancelled = True
+        self._timer.cancel()
+
+class Simulation(object):
+    """Runs devices on a `VirtualClock`, with their executor calls run inline
+    on the calling thread, so that a simulated day takes seconds and every
+    run gives the same result.
+
+    While the simulation is running, the process-wide clock is replaced and
+    `executor_pool` is set to `INLINE` on `classes`. Devices are then updated
+    by timers on the virtual clock, and their readings go through the usual
+    update path: persistence, latest values, data listeners (e.g. a
+    `ControlEngine`), and equipment commands, including their minimum on/off
+    times. `replay` feeds recorded history through the same path instead.
+
+    The `PollingScheduler` and process pools still run on wall time, so they
+    aren't used by a simulation.
+
+    Usage::
+
+        with Simulation(datetime(2015, 1, 1)) as simulation:
+            simulation.add(thermometer, 60)
+            simulation.run(86400)
+    """
+    def __init__(self, start=None, clock=None, classes=(ThreadedExecutor,)):
+        """
+        :param start: Starting time as a naive UTC datetime, used if no
+                      `clock` is given
+        :param clock: `VirtualClock` to run on
+        :param classes: Device classes to run on the inline pool. Subclasses
+                        that set their own `executor_pool` must be listed.
+        """
+        self.clock = clock if clock is not None else VirtualClock(start)
+        self.classes = list(classes)
+        self.updates = 0
+        self._tasks = []
+        self._previous_clock = None
+        self._previous_pools = None
+
+    @property
+    def log(self):
+        return logger
+
+    @property
+    def running(self):
+        return self._previous_pools is not None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """Installs the virtual clock & inline executor pool
+        """
+        if self.running:
+            return
+        self._previous_pools = [ (cls, cls.__dict__.get("executor_pool"))
+                                 for cls in self.classes ]
+        for cls in self.classes:
+            cls.executor_pool = INLINE
+        self._previous_clock = set_clock(self.clock)
+
+    def stop(self):
+        """Restores the clock & executor pools in use before `start`, and
+        cancels the update timers
+        """
+        if not self.running:
+            return
+        for timer in self._tasks:
+            timer.cancel()
+        self._tasks = []
+        set_clock(self._previous_clock)
+        for cls, pool in self._previous_pools:
+            if pool is None:
+                del cls.executor_pool
+            else:
+                cls.executor_pool = pool
+        self._previous_clock = self._previous_pools = None
+
+    def add(self, device, interval, task=None, phase=0.0):
+        """Updates `device` every `interval` simulated seconds, starting
+        `phase` seconds from now.
+
+        :param task: Function to call instead of `device.update`
+        """
+        task = task if task is not None else device.update
+        periodic = _Periodic(self, device, task, interval, phase)
+        self._tasks.append(periodic)
+        return periodic
+
+    def run(self, seconds=None, until=None):
+        """Advances the clock by `seconds` (or to the datetime `until`),
+        running every update & deferred command due on the way
+        """
+        if until is None:
+            until = self.clock.time() + seconds
+        self.clock.run_until(until)
+
+    def replay(self, devices, start=None, end=None):
+        """Feeds recorded history through the update path, in timestamp order
+        across devices, with the clock set to each reading's time. Timers due
+        between readings are run as the clock passes them.
+
+        :param devices: Dict of {source device: target device}. Each target
+                        is updated as if it had read the source's values.
+        :param start: Only replay readings from this time
+        :param end: Only replay readings before this time
+        :returns: Dict of the readings replayed, the wall & simulated seconds
+                  taken and the replay rate in readings per second
+        :raises RuntimeError: If the simulation isn't running
+        """
+        if not self.running:
+            raise RuntimeError("The simulation must be started to replay")
+        sequence = count()
+
+        def readings(source, target):
+            for timestamp, values in source.history(start, end):
+                yield timestamp, next(sequence), target, values
+        histories = [ readings(source, target)
+                      for source, target in devices.items() ]
+
+        started = perf_counter()
+        first = last = None
+        records = 0
+        for timestamp, _, target, values in heapq.merge(*histories):
+            first = first or timestamp
+            last = timestamp
+            self.clock.run_until(timestamp)
+            data = [ target.value_type(value, name)
+                     for name, value in values.items() ]
+            target.execute(lambda data=data: data, target._update_data)
+            records += 1
+
+        wall = perf_counter() - started
+        metrics.observe("simulation_replay_seconds", wall)
+        return {
+            "records": records,
+            "wall_seconds": wall,
+            "simulated_seconds": (last - first).total_seconds()
+                                 if records else 0.0,
+            "rate": records / wall if wall > 0 else 0.0,
+        }
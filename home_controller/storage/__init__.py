@@ -0,0 +1,5 @@
+from .buffer import WriteBuffer
+from .wide import HasWideFloatDataCollection, FloatValue, migrate_to_wide
+from .rollups import Rollups, Rollup, RollupPoint
+from .compression import Compressor, Deadband, SwingingDoor, reconstruct
+from .archive import Archive, Segment
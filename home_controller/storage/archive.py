@@ -0,0 +1,497 @@
+"""Archive of old data collection records in memory-mapped segment files
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import json
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from home_controller.db import session_factory
+from home_controller.log import logger
+from home_controller.tools import get_clock
+
+EPOCH = datetime(1970, 1, 1)
+
+MAGIC = b"HCSEG001"
+_HEADER_LENGTH = struct.Struct("<I")
+
+def to_micros(timestamp):
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+def from_micros(micros):
+    return EPOCH + timedelta(microseconds=int(micros))
+
+class Segment(object):
+    """An immutable, columnar segment file holding the records of one device.
+
+    The file is a small JSON header followed by a sorted int64 column of
+    timestamps (microseconds since the epoch) and one fixed-width column per
+    channel, with NaN for channels missing from a record. Columns are read as
+    arrays backed directly by the file's memory map.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a segment file".format(path))
+        length, = _HEADER_LENGTH.unpack_from(self._map, len(MAGIC))
+        offset = len(MAGIC) + _HEADER_LENGTH.size
+        header = json.loads(self._map[offset:offset + length].decode("utf-8"))
+        offset = _aligned(offset + length)
+
+        self.channels = header["channels"]
+        self.count = header["count"]
+        self.dtype = np.dtype(header["dtype"])
+        self.timestamps = np.frombuffer(self._map, "<i8", self.count, offset)
+        offset += self.timestamps.nbytes
+        self.columns = {}
+        for name in self.channels:
+            self.columns[name] = np.frombuffer(self._map, self.dtype,
+                                               self.count, offset)
+            offset += self.columns[name].nbytes
+
+    @property
+    def start(self):
+        return int(self.timestamps[0])
+
+    @property
+    def end(self):
+        return int(self.timestamps[-1])
+
+    @classmethod
+    def write(cls, path, timestamps, columns, dtype=np.float64):
+        """Writes a segment file. The file is written under a temporary name
+        and synced before being renamed, so a segment is never seen half
+        written.
+
+        :param timestamps: Sorted timestamps, in microseconds since the epoch
+        :param columns: Dict of {name: values}, each as long as `timestamps`
+        :param dtype: Value type of the channel columns
+        :returns: The `Segment`
+        """
+        timestamps = np.asarray(timestamps, dtype="<i8")
+        dtype = np.dtype(dtype).newbyteorder("<")
+        header = json.dumps({
+            "channels": list(columns),
+            "count": len(timestamps),
+            "dtype": dtype.str,
+        }).encode("utf-8")
+        prefix = MAGIC + _HEADER_LENGTH.pack(len(header)) + header
+        prefix += b"\0" * (_aligned(len(prefix)) - len(prefix))
+
+        temp = path + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(prefix)
+            f.write(timestamps.tobytes())
+            for values in columns.values():
+                f.write(np.asarray(values, dtype=dtype).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, path)
+        return cls(path)
+
+    def slice(self, start=None, end=None):
+        """Returns the (start, stop) indexes of the records from `start`
+        (inclusive) to `end` (exclusive), given in microseconds
+        """
+        first = 0 if start is None else \
+            int(np.searchsorted(self.timestamps, start, "left"))
+        last = self.count if end is None else \
+            int(np.searchsorted(self.timestamps, end, "left"))
+        return first, last
+
+    def close(self):
+        self.timestamps = None
+        self.columns = {}
+        try:
+            self._map.close()
+        except BufferError:
+            # arrays handed out still reference the map; it's released when
+            # they are
+            pass
+
+def _aligned(offset):
+    return (offset + 7) & ~7
+
+def _merge(parts):
+    """Concatenates (timestamps, {name: values}) parts into one, in time
+    order, filling channels missing from a part with NaN
+    """
+    names = []
+    for _, columns in parts:
+        names.extend(name for name in columns if name not in names)
+    timestamps = np.concatenate([ t for t, _ in parts ])
+    merged = {
+        name: np.concatenate([
+            columns.get(name, np.full(len(t), np.nan))
+            for t, columns in parts ])
+        for name in names
+    }
+    order = np.argsort(timestamps, kind="stable")
+    if np.any(order[1:] < order[:-1]):
+        timestamps = timestamps[order]
+        merged = { name: values[order] for name, values in merged.items() }
+    return timestamps, merged
+
+class Archive(object):
+    """Moves old records out of the DB into per-device segment files, and
+    reads them back.
+
+    Each `run` copies records older than the retention period to new segment
+    files in batches of `batch_size`, deleting each batch from the DB in the
+    same transaction as it's archived. When the DB uses incremental
+    auto-vacuum, the pages freed by each batch are then returned to the
+    filesystem. `history` on an attached class reads archived records
+    together with those still in the DB.
+
+    Segment files are never modified, and live under
+    `directory/<data table>/<device id>/`. A batch writes a new segment for
+    each device & `segment_period` it covers, then merges it with the
+    device's other segments in that period, so a device has one file per
+    period however many batches it took to archive. The segments of a device
+    are found by a time index kept in memory, and read without copying
+    through `mmap`; at most `max_open` segments are kept mapped.
+
+    Usage::
+
+        archive = Archive("/var/lib/home_controller/archive",
+                          retention=timedelta(days=30))
+        archive.attach(Sensor, Equipment)
+        scheduler.add(archive.run, 3600)
+    """
+    def __init__(self, directory, retention=None, value_dtype=np.float64,
+                 batch_size=5000, vacuum_pages=1000,
+                 segment_period=timedelta(days=1), max_open=64):
+        """
+        :param directory: Directory holding the segment files
+        :param retention: How long records are kept in the DB before being
+                          archived. Required unless `run` is given a cutoff.
+        :param value_dtype: Value type of archived channels. `np.float32`
+                            halves the size of the archive, at the cost of
+                            precision.
+        :param batch_size: Most records moved per transaction
+        :param vacuum_pages: Most free pages returned to the filesystem after
+                             each batch
+        :param segment_period: Span of time covered by one segment file
+        :param max_open: Most segments kept mapped; the least recently read
+                         are unmapped first
+        """
+        self.directory = directory
+        self.retention = retention
+        self.value_dtype = np.dtype(value_dtype)
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.segment_period = segment_period
+        self.max_open = max(1, max_open)
+        self.classes = []
+        self._index = {}
+        self._open = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def log(self):
+        return logger
+
+    def attach(self, *classes):
+        """Archives records of `classes` (and subclasses) on `run`, and reads
+        archived records in their `history`
+        """
+        for cls in classes:
+            cls.archive = self
+            if cls not in self.classes:
+                self.classes.append(cls)
+
+    def detach(self, *classes):
+        for cls in classes:
+            if cls.__dict__.get("archive") is self:
+                del cls.archive
+            if cls in self.classes:
+                self.classes.remove(cls)
+
+    @staticmethod
+    def enable_incremental_vacuum(engine):
+        """Switches a SQLite DB to incremental auto-vacuum, so that `run` can
+        shrink the file. This rewrites the whole DB once.
+        """
+        with engine.connect() as connection:
+            connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.execute("VACUUM")
+
+    def _device_directory(self, data_table_name, parent_id):
+        return os.path.join(self.directory, data_table_name, str(parent_id))
+
+    def _segments(self, data_table_name, parent_id):
+        """Returns a copy of the time index of a device's segments
+        """
+        with self._lock:
+            return list(self._load_index(data_table_name, parent_id))
+
+    def _load_index(self, data_table_name, parent_id):
+        """Returns the time index of a device's segments: a list of (start,
+        end, path) tuples sorted by start, loaded from the file names on first
+        use. Call with the lock held.
+        """
+        key = (data_table_name, parent_id)
+        index = self._index.get(key)
+        if index is None:
+            index = []
+            directory = self._device_directory(*key)
+            if os.path.isdir(directory):
+                for name in os.listdir(directory):
+                    if name.endswith(".seg"):
+                        start, end, _ = name[:-4].split("_")
+                        index.append((int(start), int(end),
+                                      os.path.join(directory, name)))
+            index.sort()
+            self._index[key] = index
+        return index
+
+    def _write_segment(self, data_table_name, parent_id, timestamps,
+                       columns):
+        """Writes a segment file for a device without adding it to the index.
+        Returns its (start, end, path) index entry.
+        """
+        # load the index before the new file appears in the directory
+        self._segments(data_table_name, parent_id)
+        directory = self._device_directory(data_table_name, parent_id)
+        os.makedirs(directory, exist_ok=True)
+        start, end = int(timestamps[0]), int(timestamps[-1])
+        sequence = 0
+        while True:
+            path = os.path.join(directory, "{:020d}_{:020d}_{}.seg".format(
+                start, end, sequence))
+            if not os.path.exists(path):
+                break
+            sequence += 1
+
+        Segment.write(path, timestamps, columns, self.value_dtype).close()
+        return start, end, path
+
+    def _add_segment(self, data_table_name, parent_id, timestamps, columns):
+        entry = self._write_segment(data_table_name, parent_id, timestamps,
+                                    columns)
+        with self._lock:
+            insort(self._load_index(data_table_name, parent_id), entry)
+        return entry[2]
+
+    def _remove_segment(self, data_table_name, parent_id, path):
+        with self._lock:
+            index = self._index.get((data_table_name, parent_id), [])
+            index[:] = [ entry for entry in index if entry[2] != path ]
+            segment = self._open.pop(path, None)
+        if segment is not None:
+            segment.close()
+        os.remove(path)
+
+    def _segment(self, path):
+        """Returns the open `Segment` for `path`. Segments are immutable, so
+        they're mapped once & shared, unmapping the least recently used beyond
+        `max_open`. Call with the lock held.
+        """
+        segment = self._open.get(path)
+        if segment is None:
+            segment = self._open[path] = Segment(path)
+            while len(self._open) > self.max_open:
+                _, evicted = self._open.popitem(last=False)
+                # views already handed out keep their part of the map alive
+                evicted.close()
+        else:
+            self._open.move_to_end(path)
+        return segment
+
+    def _period(self, micros):
+        return micros // (self.segment_period // timedelta(microseconds=1))
+
+    def _compact(self, data_table_name, parent_id, period):
+        """Merges a device's segments starting within `period` into one
+        segment
+        """
+        with self._lock:
+            paths = [ path for start, _, path in
+                      self._load_index(data_table_name, parent_id)
+                      if self._period(start) == period ]
+            if len(paths) < 2:
+                return
+            timestamps, columns = _merge([
+                (segment.timestamps, segment.columns)
+                for segment in map(self._segment, paths) ])
+
+        entry = self._write_segment(data_table_name, parent_id, timestamps,
+                                    columns)
+        with self._lock:
+            index = self._load_index(data_table_name, parent_id)
+            index[:] = [ e for e in index if e[2] not in paths ]
+            insort(index, entry)
+            replaced = [ self._open.pop(path, None) for path in paths ]
+        for segment in replaced:
+            if segment is not None:
+                segment.close()
+        for path in paths:
+            os.remove(path)
+
+    def close(self):
+        """Unmaps every open segment
+        """
+        with self._lock:
+            segments = list(self._open.values())
+            self._open.clear()
+        for segment in segments:
+            segment.close()
+
+    def run(self, now=None, cutoff=None):
+        """Archives every attached class's records older than `cutoff`
+        (defaults to `now - retention`).
+
+        :returns: Dict of {data table name: number of records archived}
+        """
+        if cutoff is None:
+            if self.retention is None:
+                raise ValueError("Either a cutoff or a retention is required")
+            cutoff = (now or get_clock().utcnow()) - self.retention
+
+        archived = {}
+        for cls in list(self.classes):
+            archived[cls.data_table_name] = self.archive_class(cls, cutoff)
+        return archived
+
+    def archive_class(self, cls, cutoff):
+        """Archives records of `cls` older than `cutoff`, one batch per
+        transaction. Returns the number of records archived.
+        """
+        total = 0
+        session = session_factory()
+        try:
+            while True:
+                moved = self._archive_batch(session, cls, cutoff)
+                if not moved:
+                    break
+                total += moved
+                self._vacuum(session)
+        finally:
+            session.close()
+        if total:
+            self.log.debug("Archived {} records from {}".format(
+                total, cls.data_table_name))
+        return total
+
+    def _archive_batch(self, session, cls, cutoff):
+        connection = session.connection()
+        found = cls._records_before(connection, cutoff, self.batch_size)
+        if not found:
+            return 0
+
+        by_period = {}
+        for _, parent_id, timestamp, named_values in found:
+            micros = to_micros(timestamp)
+            by_period.setdefault((parent_id, self._period(micros)), []).append(
+                (micros, named_values))
+
+        written = []
+        try:
+            for (parent_id, _), records in by_period.items():
+                channels = []
+                for _, named_values in records:
+                    channels.extend(name for name, _ in named_values
+                                    if name not in channels)
+                columns = { name: np.full(len(records), np.nan)
+                            for name in channels }
+                for i, (_, named_values) in enumerate(records):
+                    for name, value in named_values:
+                        if value is not None:
+                            columns[name][i] = value
+                timestamps = [ micros for micros, _ in records ]
+                written.append((parent_id, self._add_segment(
+                    cls.data_table_name, parent_id, timestamps, columns)))
+
+            cls._delete_records(connection, [ r[0] for r in found ])
+            session.commit()
+        except Exception:
+            session.rollback()
+            for parent_id, path in written:
+                self._remove_segment(cls.data_table_name, parent_id, path)
+            raise
+
+        for parent_id, period in by_period:
+            try:
+                self._compact(cls.data_table_name, parent_id, period)
+            except Exception as e:
+                # the new segment is already archived; it's merged on a
+                # later batch in the same period
+                self.log.error("Error merging segments of {} {}: {}".format(
+                    cls.data_table_name, parent_id, e))
+        return len(found)
+
+    def _vacuum(self, session):
+        connection = session.connection()
+        if connection.dialect.name != "sqlite":
+            return
+        if connection.execute("PRAGMA auto_vacuum").scalar() == 2:
+            # run as a script, as pysqlite only steps a pragma once, freeing a
+            # single page
+            connection.connection.executescript(
+                "PRAGMA incremental_vacuum({})".format(int(self.vacuum_pages)))
+        session.commit()
+
+    def read(self, device, start=None, end=None, channels=None):
+        """Reads a device's archived records as arrays. When the range falls
+        within a single segment the arrays are read-only views of the segment
+        file; otherwise they're copied together.
+
+        :param start: Earliest timestamp (inclusive) to return
+        :param end: Latest timestamp (exclusive) to return
+        :param channels: Optional list of channel names to return
+        :returns: (timestamps, {name: values}), with timestamps in
+                  microseconds since the epoch
+        """
+        start = None if start is None else to_micros(start)
+        end = None if end is None else to_micros(end)
+        parts = []
+        # slice under the lock, so a segment isn't unmapped or merged away
+        # between finding & reading it
+        with self._lock:
+            index = self._load_index(device.data_table_name, device.id)
+            # skip segments that end before the range or start after it
+            if end is not None:
+                index = index[:bisect_left(index, (end,))]
+            if start is not None:
+                index = [ entry for entry in index if entry[1] >= start ]
+
+            for _, _, path in index:
+                segment = self._segment(path)
+                first, last = segment.slice(start, end)
+                if last > first:
+                    parts.append((segment.timestamps[first:last], {
+                        name: column[first:last]
+                        for name, column in segment.columns.items()
+                        if channels is None or name in channels }))
+
+        if not parts:
+            return np.empty(0, dtype="<i8"), { name: np.empty(0)
+                                              for name in channels or () }
+        if len(parts) == 1:
+            return parts[0]
+        return _merge(parts)
+
+    def history(self, device, start=None, end=None, channels=None):
+        """Generator over a device's archived records in time order, in the
+        same (timestamp, {name: value}) form as `history` on the device
+        """
+        timestamps, columns = self.read(device, start, end, channels)
+        names = list(columns)
+        for i, micros in enumerate(timestamps):
+            named_values = {}
+            for name in names:
+                value = columns[name][i]
+                if not np.isnan(value):
+                    named_values[name] = float(value)
+            if named_values:
+                yield from_micros(micros), named_values
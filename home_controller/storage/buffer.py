@@ -0,0 +1,211 @@
+"""Write-behind buffering for data collection records
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import atexit
+import threading
+from collections import deque, OrderedDict
+from time import time
+
+from home_controller.db import session_factory
+from home_controller.log import logger
+from home_controller.tools import shutdown_pools, EXIT_TIMEOUT
+from home_controller.tools.instrumentation import metrics
+
+class WriteBuffer(object):
+    """Queues data collection records in memory and writes them to the DB in a
+    single transaction once `max_size` records are waiting or the oldest
+    record has waited `max_delay` seconds.
+
+    Usage::
+
+        buffer = WriteBuffer(max_size=200, max_delay=2.0)
+        Sensor.write_buffer = buffer
+        buffer.start()
+
+    The writer thread flushes the queue on `stop`, which is also registered to
+    run at interpreter exit.
+    """
+    def __init__(self, max_size=500, max_delay=1.0):
+        """
+        :param max_size: Number of queued records that triggers a flush
+        :param max_delay: Maximum time (in seconds) a record waits in the queue
+        """
+        if max_size < 1:
+            raise ValueError("max_size ({}) must be at least 1".format(
+                             max_size))
+        if max_delay <= 0:
+            raise ValueError("max_delay ({}) must be greater than 0".format(
+                             max_delay))
+
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self._queue = deque()
+        self._oldest = None
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+
+        self.flushes = 0
+        self.records_written = 0
+        self.failed_flushes = 0
+        self.max_queue_depth = 0
+        self.last_flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.total_flush_time = 0.0
+
+    @property
+    def log(self):
+        return logger
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    @property
+    def running(self):
+        return self._running
+
+    def stats(self):
+        """Returns a dict of the buffer's counters. Flush times are in seconds.
+        """
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "records_written": self.records_written,
+            "last_flush_time": self.last_flush_time,
+            "max_flush_time": self.max_flush_time,
+            "mean_flush_time": (self.total_flush_time / self.flushes
+                                if self.flushes else 0.0),
+        }
+
+    def put(self, device, timestamp, data):
+        """Queues a record for `device`. `data` is a value object or list of
+        value objects, as returned by `Sensor.read` or `Equipment.update_state`
+        """
+        entry = (type(device), device.id, timestamp,
+                 device._named_values(data))
+        with self._condition:
+            if not self._queue:
+                self._oldest = time()
+            self._queue.append(entry)
+            depth = len(self._queue)
+            if depth > self.max_queue_depth:
+                self.max_queue_depth = depth
+            if depth >= self.max_size:
+                self._condition.notify()
+
+    def flush(self):
+        """Writes everything currently queued in a single transaction.
+
+        Returns the number of records written. If the write fails the records
+        are put back at the front of the queue so the next flush retries them.
+        """
+        with self._flush_lock:
+            with self._condition:
+                entries = list(self._queue)
+                self._queue.clear()
+                self._oldest = None
+            if not entries:
+                return 0
+
+            start = time()
+            session = session_factory()
+            try:
+                connection = session.connection()
+                by_class = OrderedDict()
+                last_updates = {}
+                for cls, parent_id, timestamp, named_values in entries:
+                    by_class.setdefault(cls.record_type, (cls, []))[1].append(
+                        (parent_id, timestamp, named_values))
+                    last_updates[(cls.__table__, parent_id)] = timestamp
+
+                for cls, records in by_class.values():
+                    cls._insert_records(connection, records)
+
+                for (table, parent_id), timestamp in last_updates.items():
+                    if "last_update" in table.c:
+                        connection.execute(table.update().
+                            where(table.c.id == parent_id).
+                            values(last_update=timestamp))
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                self.failed_flushes += 1
+                with self._condition:
+                    self._queue.extendleft(reversed(entries))
+                    self._oldest = start
+                self.log.error("Error flushing {} buffered records: {}".format(
+                    len(entries), e))
+                return 0
+            finally:
+                session.close()
+
+            elapsed = time() - start
+            metrics.observe("write_buffer_flush_seconds", elapsed)
+            metrics.increment("write_buffer_records_total", len(entries))
+            self.flushes += 1
+            self.records_written += len(entries)
+            self.last_flush_time = elapsed
+            self.total_flush_time += elapsed
+            self.max_flush_time = max(self.max_flush_time, elapsed)
+            self.log.debug("Flushed {} buffered records in {:.4f}s".format(
+                len(entries), elapsed))
+            return len(entries)
+
+    def start(self):
+        """Starts the background writer thread
+        """
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name="WriteBuffer", daemon=True)
+        self._thread.start()
+        atexit.register(self._stop_at_exit)
+
+    def stop(self, timeout=None):
+        """Stops the writer thread and flushes anything left in the queue
+        """
+        if self._running:
+            with self._condition:
+                self._running = False
+                self._condition.notify()
+            self._thread.join(timeout)
+            self._thread = None
+            atexit.unregister(self._stop_at_exit)
+        self.flush()
+
+    def _stop_at_exit(self):
+        # let the executors finish queued updates, which may still write here
+        shutdown_pools(timeout=EXIT_TIMEOUT)
+        self.stop()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._flush_due():
+                    self._condition.wait(self._wait_time())
+                if not self._running:
+                    return
+            failures = self.failed_flushes
+            self.flush()
+            if self.failed_flushes > failures:
+                # back off before retrying a failed write
+                with self._condition:
+                    self._condition.wait(self.max_delay)
+
+    def _flush_due(self):
+        if not self._queue:
+            return False
+        return (len(self._queue) >= self.max_size or
+                time() - self._oldest >= self.max_delay)
+
+    def _wait_time(self):
+        if self._oldest is None:
+            return self.max_delay
+        return max(self.max_delay - (time() - self._oldest), 0.001)
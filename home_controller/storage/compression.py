@@ -0,0 +1,258 @@
+"""Compression of data collection records on the persistence path
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import threading
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+
+import numpy as np
+
+from home_controller.db import EpochDateTime, session_factory
+
+def _seconds(timestamp):
+    return (timestamp - EpochDateTime.epoch).total_seconds()
+
+class _DeviceState(object):
+    __slots__ = ("last_time", "last_values", "held_time", "held_values",
+                 "channels")
+
+    def __init__(self):
+        self.last_time = None
+        self.last_values = None
+        self.held_time = None
+        self.held_values = None
+        self.channels = {}
+
+class Compressor(object):
+    """Base class for record compressors. Set an instance as a data collection
+    class's (or object's) `compression` attribute to have it decide which
+    updates get written.
+
+    Parameters are given as keyword arguments and apply to every channel,
+    unless overridden for a channel in `channels`, e.g.::
+
+        Sensor.compression = Deadband(absolute=0.1, max_interval=600,
+                                      channels={"humidity": {"absolute": 1}})
+
+    A device's first update is always written, and `max_interval` (seconds)
+    bounds the time between written records. A record written for
+    `max_interval` is preceded by any point held back since the last one.
+    """
+    def __init__(self, max_interval=None, channels=None, **params):
+        self.max_interval = max_interval
+        self.params = params
+        self.channel_params = channels or {}
+        self.offered = 0
+        self.persisted = 0
+        self._states = WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def params_for(self, channel):
+        params = dict(self.params)
+        params.update(self.channel_params.get(channel, {}))
+        return params
+
+    @property
+    def ratio(self):
+        """Number of updates offered per record written
+        """
+        return self.offered / self.persisted if self.persisted else 0.0
+
+    def stats(self):
+        return {
+            "offered": self.offered,
+            "persisted": self.persisted,
+            "ratio": self.ratio,
+        }
+
+    def offer(self, device, timestamp, named_values):
+        """Returns the list of (timestamp, [(name, value)]) records that should
+        be written for an update of `device`
+        """
+        with self._lock:
+            self.offered += 1
+            state = self._states.get(device)
+            if state is None:
+                state = self._states[device] = _DeviceState()
+
+            if state.last_time is None or (
+                    self.max_interval is not None and
+                    _seconds(timestamp) - _seconds(state.last_time) >=
+                    self.max_interval):
+                # the held point is still needed to draw the line up to now
+                records = [(timestamp, named_values)]
+                if state.held_time is not None:
+                    records.insert(0, (state.held_time, state.held_values))
+                self._reset(state, timestamp, named_values)
+            else:
+                records = self._offer(state, timestamp, named_values)
+
+            self.persisted += len(records)
+            return records
+
+    def pending(self, device):
+        """Returns the record held back for `device` that would be written by
+        `flush`, or None
+        """
+        state = self._states.get(device)
+        if state is None or state.held_time is None:
+            return None
+        return state.held_time, state.held_values
+
+    def flush(self):
+        """Writes every held back record in a single transaction, e.g. before
+        shutting down. Safe to call from any thread.
+
+        Returns the number of records written. If the write fails the records
+        are still held, so a later flush retries them.
+        """
+        with self._lock:
+            held = [ (device, state.held_time, state.held_values)
+                     for device, state in self._states.items()
+                     if state.held_time is not None ]
+            if not held:
+                return 0
+
+            by_class = OrderedDict()
+            for device, timestamp, named_values in held:
+                cls = type(device)
+                by_class.setdefault(cls.record_type, (cls, []))[1].append(
+                    (device.id, timestamp, named_values))
+            session = session_factory()
+            try:
+                connection = session.connection()
+                for cls, records in by_class.values():
+                    cls._insert_records(connection, records)
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+            for device, timestamp, named_values in held:
+                self._reset(self._states[device], timestamp, named_values)
+            self.persisted += len(held)
+        return len(held)
+
+    def _reset(self, state, timestamp, named_values):
+        state.last_time = timestamp
+        state.last_values = dict(named_values)
+        state.held_time = None
+        state.held_values = None
+        state.channels = {}
+
+    def _offer(self, state, timestamp, named_values):
+        raise NotImplementedError("A compressor must implement _offer")
+
+class Deadband(Compressor):
+    """Writes a record when any channel has moved more than `absolute`, or
+    more than `relative` times its last written value, since the last written
+    record.
+    """
+    def __init__(self, absolute=None, relative=None, **kwargs):
+        super(Deadband, self).__init__(absolute=absolute, relative=relative,
+                                       **kwargs)
+
+    def _exceeds(self, channel, last, value):
+        if last is None or value is None:
+            return last != value
+        params = self.params_for(channel)
+        change = abs(value - last)
+        if params["absolute"] is not None and change > params["absolute"]:
+            return True
+        if params["relative"] is not None and \
+                change > params["relative"] * abs(last):
+            return True
+        return params["absolute"] is None and params["relative"] is None and \
+            change > 0
+
+    def _offer(self, state, timestamp, named_values):
+        if any(self._exceeds(name, state.last_values.get(name), value)
+               for name, value in named_values):
+            self._reset(state, timestamp, named_values)
+            return [(timestamp, named_values)]
+        return []
+
+class SwingingDoor(Compressor):
+    """Swinging door trending: a reading is dropped as long as every channel
+    can still be drawn as a straight line from the last written record to
+    within `deviation` of all the readings since. Once that fails, the
+    previous (held back) reading is written and becomes the new pivot.
+    """
+    def __init__(self, deviation, **kwargs):
+        super(SwingingDoor, self).__init__(deviation=deviation, **kwargs)
+
+    def _violates(self, state, channel, now, value):
+        pivot = state.last_values.get(channel)
+        if pivot is None or value is None:
+            return pivot != value
+        deviation = self.params_for(channel)["deviation"]
+        dt = now - _seconds(state.last_time)
+        if dt <= 0:
+            return abs(value - pivot) > deviation
+        upper, lower = state.channels.get(channel, (float("inf"),
+                                                    float("-inf")))
+        upper = min(upper, (value + deviation - pivot) / dt)
+        lower = max(lower, (value - deviation - pivot) / dt)
+        state.channels[channel] = (upper, lower)
+        return lower > upper
+
+    def _offer(self, state, timestamp, named_values):
+        now = _seconds(timestamp)
+        violated = [ self._violates(state, name, now, value)
+                     for name, value in named_values ]
+        if not any(violated):
+            state.held_time = timestamp
+            state.held_values = named_values
+            return []
+
+        if state.held_time is None:
+            # nothing to fall back on, so the reading itself is the new pivot
+            self._reset(state, timestamp, named_values)
+            return [(timestamp, named_values)]
+
+        record = (state.held_time, state.held_values)
+        self._reset(state, *record)
+        now_violated = [ self._violates(state, name, now, value)
+                         for name, value in named_values ]
+        if any(now_violated):
+            self._reset(state, timestamp, named_values)
+            return [record, (timestamp, named_values)]
+        state.held_time = timestamp
+        state.held_values = named_values
+        return [record]
+
+def reconstruct(history, start, end, step, channels=None):
+    """Linearly interpolates compressed history back onto a regular grid.
+
+    :param history: Iterable of (timestamp, {name: value}) tuples in time
+                    order, e.g. from `device.history()`
+    :param start: First grid timestamp
+    :param end: End of the grid (exclusive)
+    :param step: Grid spacing in seconds
+    :param channels: Channels to reconstruct. Defaults to all channels seen.
+    :returns: (grid, {name: values}) where grid is an array of seconds since
+              the epoch. Grid points outside the recorded range are NaN.
+    """
+    times = {}
+    values = {}
+    for timestamp, named_values in history:
+        seconds = _seconds(timestamp)
+        for name, value in named_values.items():
+            if channels is None or name in channels:
+                times.setdefault(name, []).append(seconds)
+                values.setdefault(name, []).append(value)
+
+    grid = np.arange(_seconds(start), _seconds(end), step, dtype=np.float64)
+    result = {}
+    for name in (channels if channels is not None else sorted(times)):
+        if name not in times:
+            result[name] = np.full(len(grid), np.nan)
+            continue
+        result[name] = np.interp(grid, np.array(times[name]),
+                                 np.array(values[name], dtype=np.float64),
+                                 left=np.nan, right=np.nan)
+    return grid, result
@@ -0,0 +1,298 @@
+"""Multi-resolution rollups (downsampled aggregates) of data collections
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import atexit
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import (
+    Column, Integer, Float, Unicode, DateTime, Index, text, bindparam
+)
+
+from home_controller.db import (
+    Base, UniqueId, session_factory, HasFloatDataCollection
+)
+from home_controller.log import logger
+from home_controller.tools import get_clock, shutdown_pools, EXIT_TIMEOUT
+
+EPOCH = datetime(1970, 1, 1)
+
+#: (resolution in seconds, retention) for each rollup tier. A retention of
+#: None keeps the tier forever.
+DEFAULT_TIERS = (
+    (60, timedelta(days=7)),
+    (3600, timedelta(days=365)),
+    (86400, None),
+)
+
+RollupPoint = namedtuple("RollupPoint",
+                         ["bucket", "count", "mean", "minimum", "maximum"])
+
+class Rollup(UniqueId, Base):
+    """Aggregate of one channel of one device over one time bucket
+    """
+    __tablename__ = "data_rollups"
+    __table_args__ = (
+        Index("ix_data_rollups_key", "source", "parent_id", "channel",
+              "resolution", "bucket", unique=True),
+    )
+    source = Column(Unicode(40), nullable=False)
+    parent_id = Column(Integer, nullable=False)
+    channel = Column(Unicode(20), nullable=False)
+    resolution = Column(Integer, nullable=False)
+    bucket = Column(DateTime, nullable=False)
+    count = Column(Integer, nullable=False)
+    total = Column(Float, nullable=False)
+    minimum = Column(Float, nullable=False)
+    maximum = Column(Float, nullable=False)
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+#: Adds a bucket's aggregates to its row, creating the row if needed, in one
+#: statement so concurrent writers can't both insert the same bucket
+_upsert = text("""
+    INSERT INTO data_rollups (source, parent_id, channel, resolution, bucket,
+                              count, total, minimum, maximum)
+    VALUES (:source, :parent_id, :channel, :resolution, :bucket,
+            :count, :total, :minimum, :maximum)
+    ON CONFLICT (source, parent_id, channel, resolution, bucket) DO UPDATE SET
+        count = data_rollups.count + excluded.count,
+        total = data_rollups.total + excluded.total,
+        minimum = CASE WHEN excluded.minimum < data_rollups.minimum
+                  THEN excluded.minimum ELSE data_rollups.minimum END,
+        maximum = CASE WHEN excluded.maximum > data_rollups.maximum
+                  THEN excluded.maximum ELSE data_rollups.maximum END
+""").bindparams(bindparam("bucket", type_=DateTime))
+
+class _Accumulator(object):
+    __slots__ = ("bucket", "count", "total", "minimum", "maximum")
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.count = 0
+        self.total = 0.0
+        self.minimum = float("inf")
+        self.maximum = float("-inf")
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+
+def bucket_start(timestamp, resolution):
+    """Returns the start of the `resolution` second bucket holding `timestamp`
+    """
+    seconds = (timestamp - EPOCH).total_seconds()
+    return EPOCH + timedelta(seconds=seconds - seconds % resolution)
+
+class Rollups(object):
+    """Keeps rollup tables up to date incrementally as data is recorded.
+
+    Each tier's current bucket is accumulated in memory and written when a
+    reading for a later bucket arrives, so recording a value only touches the
+    DB once per bucket per channel. Open buckets are also flushed every
+    `flush_interval` seconds, and at interpreter exit while attached, so a
+    restart loses at most that much of the coarser tiers.
+
+    Usage::
+
+        rollups = Rollups(raw_retention=timedelta(days=2))
+        rollups.attach()
+        ...
+        resolution, points = rollups.query(sensor, "value", start, end,
+                                           max_points=300)
+    """
+    def __init__(self, tiers=DEFAULT_TIERS, raw_retention=None,
+                 flush_interval=300):
+        """
+        :param tiers: Iterable of (resolution in seconds, retention) tuples
+        :param raw_retention: How long to keep raw records for, or None to
+                              keep them forever
+        :param flush_interval: Seconds between writes of the open (partial)
+                               buckets, or None to only write them when they
+                               close or on `flush`
+        """
+        self.tiers = sorted(tiers)
+        if not self.tiers:
+            raise ValueError("At least one rollup tier is required")
+        self.raw_retention = raw_retention
+        self.flush_interval = flush_interval
+        self._last_flush = get_clock().monotonic()
+        self._open = {}
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    @property
+    def log(self):
+        return logger
+
+    @property
+    def resolutions(self):
+        return [ resolution for resolution, _ in self.tiers ]
+
+    def attach(self):
+        """Starts recording every data collection update
+        """
+        HasFloatDataCollection.add_data_listener(self.record)
+        atexit.register(self._flush_at_exit)
+
+    def detach(self):
+        HasFloatDataCollection.remove_data_listener(self.record)
+        atexit.unregister(self._flush_at_exit)
+        self.flush()
+
+    def _flush_at_exit(self):
+        # let the executors finish queued updates, which may still record here
+        shutdown_pools(timeout=EXIT_TIMEOUT)
+        self.flush()
+
+    def record(self, device, timestamp, named_values):
+        """Adds a reading to the open buckets. This is the data listener
+        registered by `attach`.
+        """
+        if device.id is None:
+            return
+
+        source = device.data_table_name
+        closed = []
+        now = get_clock().monotonic()
+        with self._lock:
+            self._sources.setdefault(source, type(device))
+            for resolution in self.resolutions:
+                bucket = bucket_start(timestamp, resolution)
+                for channel, value in named_values:
+                    if value is None:
+                        continue
+                    key = (source, device.id, channel, resolution)
+                    acc = self._open.get(key)
+                    if acc is None or acc.bucket != bucket:
+                        if acc is not None:
+                            closed.append((key, acc))
+                        acc = self._open[key] = _Accumulator(bucket)
+                    acc.add(value)
+            if self.flush_interval is not None and \
+                    now - self._last_flush >= self.flush_interval:
+                closed.extend(self._open.items())
+                self._open.clear()
+                self._last_flush = now
+
+        if closed:
+            self._write(closed)
+
+    def flush(self):
+        """Writes all open (partial) buckets. Later readings in the same
+        buckets are merged into the written rows.
+        """
+        with self._lock:
+            buckets = list(self._open.items())
+            self._open.clear()
+            self._last_flush = get_clock().monotonic()
+        self._write(buckets)
+
+    def _write(self, buckets):
+        if not buckets:
+            return
+        session = session_factory()
+        try:
+            session.execute(_upsert, [
+                dict(source=source, parent_id=parent_id, channel=channel,
+                     resolution=resolution, bucket=acc.bucket,
+                     count=acc.count, total=acc.total, minimum=acc.minimum,
+                     maximum=acc.maximum)
+                for (source, parent_id, channel, resolution), acc in buckets ])
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            self.log.error("Error writing {} rollup buckets: {}".format(
+                len(buckets), e))
+        finally:
+            session.close()
+
+    def resolution_for(self, start, end, max_points):
+        """Returns the finest tier resolution that covers `start` to `end` in
+        at most `max_points` buckets, or the coarsest tier if none do.
+        """
+        span = (end - start).total_seconds()
+        for resolution in self.resolutions:
+            if span / resolution <= max_points:
+                return resolution
+        return self.resolutions[-1]
+
+    def query(self, device, channel, start, end, max_points=500,
+              resolution=None):
+        """Returns aggregated values for one channel of `device`.
+
+        :param start: Start of the range (inclusive)
+        :param end: End of the range (exclusive)
+        :param max_points: Point budget used to pick the resolution
+        :param resolution: Explicit tier resolution, overrides `max_points`
+        :returns: (resolution, [RollupPoint]) with points in time order,
+                  including buckets that are still open in memory
+        """
+        if resolution is None:
+            resolution = self.resolution_for(start, end, max_points)
+
+        source = device.data_table_name
+        first = bucket_start(start, resolution)
+        session = session_factory()
+        try:
+            rows = session.query(Rollup).filter(
+                Rollup.source == source,
+                Rollup.parent_id == device.id,
+                Rollup.channel == channel,
+                Rollup.resolution == resolution,
+                Rollup.bucket >= first,
+                Rollup.bucket < end).all()
+            points = { r.bucket: [r.count, r.total, r.minimum, r.maximum]
+                       for r in rows }
+        finally:
+            session.close()
+
+        with self._lock:
+            acc = self._open.get((source, device.id, channel, resolution))
+            if acc is not None and first <= acc.bucket < end:
+                point = points.setdefault(acc.bucket, [0, 0.0, acc.minimum,
+                                                       acc.maximum])
+                point[0] += acc.count
+                point[1] += acc.total
+                point[2] = min(point[2], acc.minimum)
+                point[3] = max(point[3], acc.maximum)
+
+        return resolution, [
+            RollupPoint(bucket, count, total / count, minimum, maximum)
+            for bucket, (count, total, minimum, maximum)
+            in sorted(points.items()) ]
+
+    def prune(self, now=None):
+        """Deletes rollups older than their tier's retention, and raw records
+        older than `raw_retention` for every device class seen so far.
+        """
+        if now is None:
+            now = get_clock().utcnow()
+
+        session = session_factory()
+        try:
+            for resolution, retention in self.tiers:
+                if retention is not None:
+                    session.query(Rollup).filter(
+                        Rollup.resolution == resolution,
+                        Rollup.bucket < now - retention). \
+                        delete(synchronize_session=False)
+            if self.raw_retention is not None:
+                connection = session.connection()
+                for cls in list(self._sources.values()):
+                    deleted = cls._delete_records_before(
+                        connection, now - self.raw_retention)
+                    self.log.debug("Pruned {} raw records from {}".format(
+                        deleted, cls.data_table_name))
+            session.commit()
+        finally:
+            session.close()
@@ -0,0 +1,372 @@
+"""Wide (one row per reading) storage for data collections
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import threading
+
+from sqlalchemy import (
+    ForeignKey, Column, Integer, BigInteger, Float, MetaData, Table, Index,
+    select, func, case, literal, type_coerce, event
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import relationship
+from sqlalchemy.ext.declarative import declared_attr
+
+from home_controller.db import (
+    Base, Session, UniqueId, JSONEncodedDict, EpochDateTime,
+    HasFloatDataCollection
+)
+
+class FloatValue(object):
+    """Plain value holder used as the `value_type` of wide data collections.
+    Has the same constructor & attributes as the EAV value models.
+    """
+    __slots__ = ("value", "name", "record")
+
+    def __init__(self, value, name, record=None):
+        self.value = value
+        self.name = name
+        self.record = record
+
+    def __repr__(self):
+        return "FloatValue({!r}, {!r})".format(self.value, self.name)
+
+class _DataLayout(UniqueId):
+    """Base class for the dynamically created channel layout tables. A layout
+    is the ordered list of channel names stored in a record's value columns.
+    """
+    channels = Column(JSONEncodedDict(255), nullable=False, unique=True)
+
+class _WideDataCollection(UniqueId):
+    """Base class for dynamically created wide collection tables. Channel
+    values are stored in the `value_<n>` columns in the order given by the
+    record's layout.
+    """
+    timestamp = Column(EpochDateTime)
+
+    def __init__(self, parent, values, layout=None):
+        try:
+            len(values)
+        except TypeError:
+            values = [values]
+
+        if layout is not None:
+            self.layout = layout
+        for i, v in enumerate(values):
+            setattr(self, "value_{}".format(i), v.value)
+        self.parent = parent
+
+    @property
+    def values(self):
+        return [ FloatValue(getattr(self, "value_{}".format(i)), name, self)
+                 for i, name in enumerate(self.layout.channels) ]
+
+_layout_lock = threading.Lock()
+
+@event.listens_for(Engine, "commit")
+def _cache_layouts(connection):
+    """Caches the layout ids looked up in the transaction just committed
+    """
+    for ids, names, layout_id in connection.info.pop("wide_layouts", ()):
+        ids[names] = layout_id
+
+@event.listens_for(Engine, "rollback")
+@event.listens_for(Engine, "rollback_savepoint")
+def _discard_layouts(connection, *args):
+    connection.info.pop("wide_layouts", None)
+
+#: Statements built by `_latest_query`, by record type
+_latest_queries = {}
+
+class HasWideFloatDataCollection(HasFloatDataCollection):
+    """Alternative to `HasFloatDataCollection` that stores each reading as a
+    single row, with up to `max_channels` float columns and a small integer
+    layout id in place of repeated channel names.
+
+    Records & values are accessed the same way as with the EAV layout
+    (`device.data`, `record.values`, `value.name`, `value.value`), but the
+    value objects are plain `FloatValue` instances rather than models.
+    """
+    max_channels = 8
+
+    @declared_attr
+    def data(cls):
+        make_cls_name = lambda n: "".join(
+            [s.capitalize() for s in cls.data_table_name.split("_")]) + n
+
+        layout = type(make_cls_name("Layout"), (_DataLayout, Base), {
+            "__tablename__": cls.data_table_name + "_layouts",
+            "ids": {},
+        })
+
+        attrs = {
+            "__tablename__": cls.data_table_name,
+            "__table_args__": (
+                Index("ix_{}_parent_timestamp".format(cls.data_table_name),
+                      "parent_id", "timestamp"),
+            ),
+            "parent_id": Column(Integer,
+                                ForeignKey("{}.id".format(cls.__tablename__)),
+                                nullable=False),
+            "layout_id": Column(Integer,
+                                ForeignKey("{}.id".format(
+                                    layout.__tablename__)),
+                                nullable=False),
+            "layout": relationship(layout, lazy="joined"),
+        }
+        for i in range(cls.max_channels):
+            attrs["value_{}".format(i)] = Column(Float)
+        collection = type(make_cls_name("Collection"),
+                          (_WideDataCollection, Base), attrs)
+
+        cls.record_type = collection
+        cls.layout_type = layout
+        cls.value_type = FloatValue
+
+        return relationship(collection, backref="parent", lazy="dynamic")
+
+    @classmethod
+    def _layout_id(cls, connection, names):
+        """Returns the id of the layout for `names`, creating it if needed.
+        Ids found inside a transaction are only cached once it commits, since
+        the layout may have been created by it.
+        """
+        names = tuple(names)
+        if len(names) > cls.max_channels:
+            raise ValueError("{} channels given, but {} stores at most "
+                             "{}".format(len(names), cls.__name__,
+                                         cls.max_channels))
+
+        ids = cls.layout_type.ids
+        layout_id = ids.get(names)
+        if layout_id is None:
+            table = cls.layout_type.__table__
+            with _layout_lock:
+                layout_id = connection.execute(select([table.c.id]).where(
+                    table.c.channels == list(names))).scalar()
+                if layout_id is None:
+                    layout_id = connection.execute(table.insert(),
+                        channels=list(names)).inserted_primary_key[0]
+            if connection.in_transaction():
+                connection.info.setdefault("wide_layouts", []).append(
+                    (ids, names, layout_id))
+            else:
+                ids[names] = layout_id
+        return layout_id
+
+    @classmethod
+    def _insert_records(cls, connection, records):
+        """Inserts records using Core statements, one row per record.
+
+        :param connection: Connection to execute the inserts on
+        :param records: Iterable of (parent_id, timestamp, [(name, value)])
+                        tuples
+        """
+        empty = { "value_{}".format(i): None
+                  for i in range(cls.max_channels) }
+        rows = []
+        for parent_id, timestamp, named_values in records:
+            row = dict(empty)
+            row.update({ "value_{}".format(i): value
+                         for i, (_, value) in enumerate(named_values) })
+            row.update({
+                "parent_id": parent_id,
+                "timestamp": timestamp,
+                "layout_id": cls._layout_id(connection,
+                                            [n for n, _ in named_values]),
+            })
+            rows.append(row)
+        if rows:
+            connection.execute(cls.record_type.__table__.insert(), rows)
+
+    @classmethod
+    def _delete_records_before(cls, connection, cutoff):
+        """Deletes all records older than `cutoff`. Returns the number of
+        records deleted.
+        """
+        records = cls.record_type.__table__
+        return connection.execute(records.delete().where(
+            records.c.timestamp < cutoff)).rowcount
+
+    @classmethod
+    def _latest_query(cls):
+        """Returns the statement used by `_latest_records`, built once per
+        data table
+        """
+        query = _latest_queries.get(cls.record_type)
+        if query is not None:
+            return query
+
+        records = cls.record_type.__table__
+        layouts = cls.layout_type.__table__
+        newest = select([records.c.parent_id,
+                         func.max(records.c.timestamp).label("timestamp")]). \
+            group_by(records.c.parent_id).alias()
+        query = select([records, layouts.c.channels]). \
+            select_from(records.join(newest, (newest.c.parent_id ==
+                                              records.c.parent_id) &
+                                             (newest.c.timestamp ==
+                                              records.c.timestamp)).
+                        join(layouts, layouts.c.id == records.c.layout_id)). \
+            order_by(records.c.id)
+        _latest_queries[cls.record_type] = query
+        return query
+
+    @classmethod
+    def _latest_records(cls, connection):
+        """Yields (parent_id, timestamp, [(name, value)]) for the newest record
+        of every parent, in a single query
+        """
+        latest = {}
+        for row in connection.execute(cls._latest_query()):
+            latest[row.parent_id] = (row.timestamp, [
+                (name, row["value_{}".format(i)])
+                for i, name in enumerate(row.channels) ])
+        for parent_id, (timestamp, named_values) in latest.items():
+            yield parent_id, timestamp, named_values
+
+    @classmethod
+    def _records_before(cls, connection, cutoff, limit):
+        """Returns up to `limit` of the oldest records older than `cutoff`, as
+        a list of (record_id, parent_id, timestamp, [(name, value)]) tuples in
+        time order
+        """
+        records = cls.record_type.__table__
+        layouts = cls.layout_type.__table__
+        query = select([records, layouts.c.channels]). \
+            select_from(records.join(layouts,
+                                     layouts.c.id == records.c.layout_id)). \
+            where(records.c.timestamp < cutoff). \
+            order_by(records.c.timestamp, records.c.id).limit(limit)
+        return [ (row.id, row.parent_id, row.timestamp, [
+                     (name, row["value_{}".format(i)])
+                     for i, name in enumerate(row.channels) ])
+                 for row in connection.execute(query) ]
+
+    @classmethod
+    def _delete_records(cls, connection, record_ids):
+        """Deletes the records with the given ids
+        """
+        records = cls.record_type.__table__
+        connection.execute(records.delete().where(
+            records.c.id.in_(record_ids)))
+
+    @classmethod
+    def _aggregate_query(cls, connection, parent_id, channel, start, end,
+                         seconds):
+        """Returns a statement selecting (bucket index, count, sum, min, max)
+        rows for one channel of one parent. The channel's column is picked
+        per layout, so the aggregation is still a single grouped query.
+        """
+        records = cls.record_type.__table__
+        layouts = cls.layout_type.__table__
+        columns = { row.id: "value_{}".format(row.channels.index(channel))
+                    for row in connection.execute(
+                        select([layouts.c.id, layouts.c.channels]))
+                    if channel in row.channels }
+        if not columns:
+            return None
+
+        value = case([ (records.c.layout_id == layout_id, records.c[column])
+                       for layout_id, column in columns.items() ])
+        query = select([value]).where(
+            (records.c.parent_id == parent_id) &
+            (records.c.layout_id.in_(list(columns))) &
+            (records.c.timestamp >= start) &
+            (records.c.timestamp < end))
+        if seconds is None:
+            bucket = literal(0)
+        else:
+            # integer division of the raw microseconds
+            bucket = type_coerce(records.c.timestamp, BigInteger) / \
+                (seconds * 1000000)
+            query = query.group_by(bucket).order_by(bucket)
+        return query.with_only_columns([
+            bucket, func.count(value), func.sum(value), func.min(value),
+            func.max(value)])
+
+    def _db_history(self, start=None, end=None, channels=None, limit=None,
+                    newest_first=False):
+        """Generator over the records held in the DB, read in a single
+        streamed query. See `history`. `newest_first` reverses the order.
+        """
+        if getattr(self, "id", None) is None:
+            return
+
+        records = self.record_type.__table__
+        layouts = self.layout_type.__table__
+        columns = [ records.c["value_{}".format(i)]
+                    for i in range(self.max_channels) ]
+
+        query = select([records.c.timestamp, layouts.c.channels] + columns). \
+            select_from(records.join(layouts,
+                                     layouts.c.id == records.c.layout_id)). \
+            where(records.c.parent_id == self.id)
+        if start is not None:
+            query = query.where(records.c.timestamp >= start)
+        if end is not None:
+            query = query.where(records.c.timestamp < end)
+        order = [records.c.timestamp, records.c.id]
+        if newest_first:
+            order = [ column.desc() for column in order ]
+        query = query.order_by(*order)
+        if limit is not None:
+            query = query.limit(limit)
+
+        result = Session().connection(). \
+            execution_options(stream_results=True).execute(query)
+        for row in result:
+            named_values = dict(zip(row.channels, row[2:]))
+            if channels is not None:
+                named_values = { name: named_values[name] for name in channels
+                                 if name in named_values }
+            yield row.timestamp, named_values
+
+def migrate_to_wide(connection, source_table, target_cls, chunk_size=1000):
+    """Copies records from an EAV data collection table into the wide table
+    of `target_cls`.
+
+    The source tables are reflected by name, so they must not be the tables
+    currently mapped by `target_cls`; rename the old tables first, e.g.
+    `ALTER TABLE sensor_data RENAME TO sensor_data_eav` (and the matching
+    `_values` table). Parent ids are copied unchanged.
+
+    :param connection: Connection to run the migration on
+    :param source_table: Name of the EAV record table. Values are read from
+                         `<source_table>_values`.
+    :param target_cls: Model class using `HasWideFloatDataCollection`
+    :param chunk_size: Number of records copied per batch
+    :returns: Number of records copied
+    """
+    metadata = MetaData()
+    records = Table(source_table, metadata, autoload=True,
+                    autoload_with=connection)
+    values = Table(source_table + "_values", metadata, autoload=True,
+                   autoload_with=connection)
+
+    copied = 0
+    last_id = 0
+    while True:
+        chunk = connection.execute(
+            select([records.c.id, records.c.parent_id, records.c.timestamp]).
+            where(records.c.id > last_id).
+            order_by(records.c.id).
+            limit(chunk_size)).fetchall()
+        if not chunk:
+            return copied
+
+        first_id, last_id = chunk[0].id, chunk[-1].id
+        named_values = {}
+        for row in connection.execute(
+                select([values.c.record_id, values.c.name, values.c.value]).
+                where(values.c.record_id.between(first_id, last_id)).
+                order_by(values.c.record_id, values.c.id)):
+            named_values.setdefault(row.record_id, []).append(
+                (row.name, row.value))
+
+        with connection.begin():
+            target_cls._insert_records(connection, [
+                (r.parent_id, r.timestamp, named_values.get(r.id, []))
+                for r in chunk ])
+        copied += len(chunk)
@@ -4,13 +4,17 @@
 # Ben Peters (bencpeters@gmail.com)
 
 from sqlalchemy.engine import create_engine
+from sqlalchemy.pool import StaticPool
 
 from home_controller.db import Base, Session, session_factory
 
 def setup_module():
     global connection, engine
 
-    engine = create_engine('sqlite://')
+    # share the in-memory DB with the executor threads, which run the
+    # persistence callbacks
+    engine = create_engine('sqlite://', poolclass=StaticPool,
+                           connect_args={'check_same_thread': False})
     connection = engine.connect()
     Base.metadata.create_all(connection)
     session_factory.configure(bind=engine)
@@ -0,0 +1,105 @@
+"""Tests event-driven rule evaluation
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from datetime import datetime, time, timedelta
+from time import sleep
+from unittest.mock import MagicMock
+
+from nose.tools import *
+
+from home_controller.tests import DatabaseTest
+from home_controller.control import ControlEngine, Thermostat, PID, Schedule
+from home_controller.equipment import BinaryEquipment
+from home_controller.sensors import RandomValuesSensor, Sensor
+from home_controller.tools import metrics, CircuitOpenError
+
+class TestControlEngine(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.sensor = RandomValuesSensor(sensor_name="thermometer")
+        self.furnace = BinaryEquipment("state", "furnace")
+        self.engine = ControlEngine()
+        self.rule = self.engine.add(Thermostat(self.sensor, "temperature",
+                                               self.furnace, setpoint=20))
+        self.engine.attach()
+        self.async_wait_time = 0.1
+        metrics.reset()
+
+    def teardown(self):
+        self.engine.detach()
+        super().teardown()
+
+    def _read(self, temperature):
+        self.sensor.read = MagicMock(return_value=[
+            Sensor.value_type(temperature, "temperature")])
+        self.sensor.update()
+        sleep(self.async_wait_time)
+
+    def test_sensor_update_sets_equipment(self):
+        self._read(18.0)
+        eq_(self.furnace.current_state, 1.0)
+        self._read(21.0)
+        eq_(self.furnace.current_state, 0.0)
+
+    def test_unchanged_input_is_not_evaluated(self):
+        for _ in range(3):
+            self._read(18.0)
+        eq_(self.rule.evaluations, 1)
+        eq_(self.furnace.data.count(), 1)
+
+    def test_schedule_change_is_applied(self):
+        self.rule.setpoint = Schedule([(time(6), 21.0), (time(22), 16.0)])
+        reading = [("temperature", 18.0)]
+        self.engine.record(self.sensor, datetime(2016, 1, 1, 5), reading)
+        sleep(self.async_wait_time)
+        eq_(self.furnace.current_state, 0.0)
+        self.engine.record(self.sensor, datetime(2016, 1, 1, 7), reading)
+        sleep(self.async_wait_time)
+        eq_(self.furnace.current_state, 1.0)
+        eq_(self.rule.evaluations, 2)
+
+    def test_noop_command_is_not_timed(self):
+        self.furnace.set(1.0)
+        sleep(self.async_wait_time)
+        self._read(18.0)
+        self.furnace.set(0.0)
+        sleep(self.async_wait_time)
+        stats = metrics.summary("control_latency_seconds", by="rule")
+        ok_("Thermostat" not in stats)
+
+    def test_failed_command_is_retried(self):
+        set_state = self.furnace.set
+        self.furnace.set = MagicMock(side_effect=CircuitOpenError("open"))
+        self._read(18.0)
+        eq_(self.furnace.current_state, None)
+        self.furnace.set = set_state
+        self._read(18.5)
+        eq_(self.furnace.current_state, 1.0)
+
+    def test_latency_is_recorded(self):
+        self._read(18.0)
+        stats = metrics.summary("control_latency_seconds", by="rule")
+        eq_(stats["Thermostat"]["count"], 1)
+
+    def test_removed_rule_is_ignored(self):
+        self.engine.remove(self.rule)
+        self._read(18.0)
+        eq_(self.rule.evaluations, 0)
+        eq_(self.furnace.current_state, None)
+
+class TestTimeBasedRules(object):
+    def test_pid_integrates_steady_error(self):
+        engine = ControlEngine()
+        valve = MagicMock()
+        engine.add(PID("sensor", "temperature", valve, setpoint=20, kp=0,
+                       ki=0.01))
+        start = datetime(2016, 1, 1)
+        for i in range(4):
+            engine.record("sensor", start + timedelta(seconds=10 * i),
+                          [("temperature", 18.0)])
+        outputs = [ args[0] for args, _ in valve.set.call_args_list ]
+        eq_(len(outputs), 4)
+        ok_(outputs == sorted(outputs) and outputs[-1] > outputs[0],
+            "Expected the output to keep rising, got {}".format(outputs))
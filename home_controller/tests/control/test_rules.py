@@ -0,0 +1,78 @@
+"""Tests the control rules
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from datetime import datetime, time, timedelta
+
+from nose.tools import *
+
+from home_controller.control import Thermostat, PID, Schedule
+
+START = datetime(2016, 1, 1, 12)
+
+def _evaluate(rule, value, seconds=0):
+    rule.update("sensor", "temperature", value)
+    return rule.evaluate(START + timedelta(seconds=seconds))
+
+class TestThermostat(object):
+    def test_heating_hysteresis(self):
+        rule = Thermostat("sensor", "temperature", None, setpoint=20, band=1)
+        eq_(_evaluate(rule, 19.0), 1.0)
+        eq_(_evaluate(rule, 19.8), None)
+        eq_(_evaluate(rule, 20.4), None)
+        eq_(_evaluate(rule, 20.6), 0.0)
+
+    def test_cooling(self):
+        rule = Thermostat("sensor", "temperature", None, setpoint=20, band=1,
+                          cooling=True)
+        eq_(_evaluate(rule, 21.0), 1.0)
+        eq_(_evaluate(rule, 19.0), 0.0)
+
+    def test_scheduled_setpoint(self):
+        schedule = Schedule([(time(6), 21.0), (time(22), 16.0)])
+        rule = Thermostat("sensor", "temperature", None, setpoint=schedule)
+        rule.update("sensor", "temperature", 18.0)
+        eq_(rule.evaluate(datetime(2016, 1, 1, 12)), 1.0)
+        eq_(rule.evaluate(datetime(2016, 1, 1, 23)), 0.0)
+
+    def test_unchanged_input(self):
+        rule = Thermostat("sensor", "temperature", None, setpoint=20)
+        ok_(rule.update("sensor", "temperature", 18.0))
+        ok_(not rule.update("sensor", "temperature", 18.0))
+
+    def test_refresh_on_setpoint_change(self):
+        schedule = Schedule([(time(6), 21.0), (time(22), 16.0)])
+        rule = Thermostat("sensor", "temperature", None, setpoint=schedule)
+        ok_(rule.refresh(datetime(2016, 1, 1, 5)))
+        ok_(not rule.refresh(datetime(2016, 1, 1, 5, 30)))
+        ok_(rule.refresh(datetime(2016, 1, 1, 7)))
+
+class TestPID(object):
+    def test_proportional(self):
+        rule = PID("sensor", "temperature", None, setpoint=20, kp=0.1)
+        assert_almost_equal(_evaluate(rule, 17.0), 0.3)
+        eq_(_evaluate(rule, 10.0), 1.0)
+
+    def test_refreshed_on_every_reading(self):
+        rule = PID("sensor", "temperature", None, setpoint=20, kp=0.1)
+        ok_(all(rule.refresh(START + timedelta(seconds=i)) for i in range(3)))
+
+    def test_integral_is_clamped(self):
+        rule = PID("sensor", "temperature", None, setpoint=20, kp=0, ki=1)
+        _evaluate(rule, 10.0, 0)
+        eq_(_evaluate(rule, 10.0, 100), 1.0)
+        eq_(rule.integral, 1.0)
+        # no windup, so the output drops as soon as the error changes sign
+        ok_(_evaluate(rule, 20.5, 101) < 1.0)
+
+class TestSchedule(object):
+    def test_wraps_around_midnight(self):
+        schedule = Schedule([(time(6), "day"), (time(22), "night")])
+        eq_(schedule(datetime(2016, 1, 1, 3)), "night")
+        eq_(schedule(datetime(2016, 1, 1, 6)), "day")
+        eq_(schedule(datetime(2016, 1, 1, 22, 30)), "night")
+
+    @raises(ValueError)
+    def test_empty(self):
+        Schedule([])
@@ -3,14 +3,26 @@
 
 # Ben Peters (bencpeters@gmail.com)
 
+import asyncio
+import shutil
+import tempfile
+import threading
 from time import sleep
-from datetime import datetime
+from datetime import datetime, timedelta
 from unittest.mock import MagicMock
 
+import numpy as np
 from nose.tools import *
+from sqlalchemy import event
+from tornado.ioloop import IOLoop
 
+import home_controller.tests
 from home_controller.tests import DatabaseTest
 from home_controller.equipment import Equipment, BinaryEquipment
+from home_controller.storage import Archive
+from home_controller.tools import (
+    get_pool, shutdown_pools, VirtualClock, using_clock
+)
 
 class TestEquipment(DatabaseTest):
     """Tests basic shared equipment functionality.
@@ -35,11 +47,11 @@ class TestEquipment(DatabaseTest):
 
     def test_set_adds_objects_to_db(self):
         val = 0.5
-        eq_(len(self.equip.data), 0)
+        eq_(self.equip.data.count(), 0)
         self.equip.set(val)
         sleep(self.async_wait_time)
         records = self.session.query(Equipment). \
-            filter(Equipment.id == self.equip.id).first().data
+            filter(Equipment.id == self.equip.id).first().data.all()
         eq_(len(records), 1)
         eq_(records[0].values[0].value, val)
 
@@ -50,6 +62,12 @@ class TestEquipment(DatabaseTest):
         curr_val = self.equip.current_state
         eq_(curr_val, val)
 
+    def test_set_async(self):
+        val = 0.3
+        IOLoop.current().run_sync(lambda: self.equip.set_async(val))
+        self.equip.update_state.assert_called_once_with(val)
+        eq_(self.equip.current_state, val)
+
     def test_last_update(self):
         start = datetime.now()
         self.equip.set(0.5)
@@ -80,3 +98,178 @@ class TestBinaryEquipment(DatabaseTest):
         ]
         for val, exp in tests:
             yield self._test_val, val, exp
+
+class TestCommandPipeline(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.equip = BinaryEquipment("state", "pipeline")
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+        update_state = self.equip.update_state
+
+        def counting_update(new_state, *args, **kwargs):
+            self.release.wait(1)
+            self.calls.append(new_state)
+            return update_state(new_state)
+        self.equip.update_state = counting_update
+        self.async_wait_time = 0.1
+
+    def teardown(self):
+        self.release.set()
+        super().teardown()
+
+    def test_noop_commands_are_dropped(self):
+        for _ in range(5):
+            self.equip.set(1)
+            sleep(0.02)
+        sleep(self.async_wait_time)
+        eq_(self.calls, [1])
+        eq_(self.equip.data.count(), 1)
+        eq_(self.equip.command_stats()["noops"], 4)
+
+    def test_equivalent_commands_are_noops(self):
+        self.equip.set(0.9)
+        sleep(self.async_wait_time)
+        self.equip.set(0.7)
+        sleep(self.async_wait_time)
+        eq_(self.calls, [0.9])
+
+    def test_burst_collapses_to_latest(self):
+        self.release.clear()
+        self.equip.set(1)
+        for state in (0, 1, 0):
+            self.equip.set(state)
+        self.release.set()
+        sleep(self.async_wait_time)
+        eq_(self.calls, [1, 0])
+        eq_(self.equip.current_state, 0)
+        eq_(self.equip.command_stats()["coalesced"], 2)
+
+    def test_min_on_time_defers_switching_off(self):
+        self.equip.min_on_time = 0.2
+        self.equip.set(1)
+        sleep(0.05)
+        self.equip.set(0)
+        sleep(0.05)
+        eq_(self.calls, [1])
+        eq_(self.equip.command_stats()["deferred"], 1)
+        sleep(0.2)
+        eq_(self.calls, [1, 0])
+        eq_(self.equip.current_state, 0)
+
+    def test_deferred_command_can_be_cancelled(self):
+        self.equip.min_on_time = 0.1
+        self.equip.set(1)
+        sleep(0.05)
+        self.equip.set(0)
+        self.equip.set(1)
+        sleep(0.15)
+        eq_(self.calls, [1])
+
+    def test_coalesced_sync_command_does_not_block(self):
+        self.release.clear()
+        self.equip.set(1)
+        self.equip.set(0, run_sync=True)
+        self.release.set()
+        sleep(self.async_wait_time)
+        eq_(self.calls, [1, 0])
+
+    def test_shutdown_drains_coalesced_commands(self):
+        self.release.clear()
+        self.equip.set(1)
+        self.equip.set(0)
+        threading.Timer(0.05, self.release.set).start()
+        shutdown_pools()
+        eq_(self.calls, [1, 0])
+        eq_(get_pool().device_count, 0, "Pool shouldn't be recreated by the "
+            "drained commands")
+
+    def test_set_async_skips_noops(self):
+        IOLoop.current().run_sync(lambda: self.equip.set_async(1))
+        result = IOLoop.current().run_sync(lambda: self.equip.set_async(1))
+        eq_(result, None)
+        eq_(self.calls, [1])
+
+    def test_set_async_waits_on_the_clock(self):
+        self.equip.min_on_time = 60
+        clock = VirtualClock(datetime(2015, 1, 1))
+
+        async def switch():
+            await self.equip.set_async(1)
+            switching_off = asyncio.ensure_future(self.equip.set_async(0))
+            await asyncio.sleep(0.05)
+            ok_(not switching_off.done())
+            clock.advance(60)
+            await asyncio.wait_for(switching_off, 1)
+
+        with using_clock(clock):
+            IOLoop.current().run_sync(switch)
+        eq_(self.calls, [1, 0])
+
+class TestDutyCycle(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.equip = BinaryEquipment("state", "compressor")
+        self.session.add(self.equip)
+        self.session.commit()
+        self.start = datetime(2015, 6, 1)
+        # off before the range, on 00:30-01:30 & 02:00-02:15
+        Equipment.bulk_ingest([
+            (self.equip, self.start - timedelta(hours=1), { "state": 0.0 }),
+            (self.equip, self.start + timedelta(minutes=30), { "state": 1.0 }),
+            (self.equip, self.start + timedelta(minutes=90), { "state": 0.0 }),
+            (self.equip, self.start + timedelta(minutes=120), { "state": 1.0 }),
+            (self.equip, self.start + timedelta(minutes=135), { "state": 0.0 }),
+        ])
+
+    def test_duty_cycle(self):
+        result = self.equip.duty_cycle(self.start,
+                                       self.start + timedelta(hours=3),
+                                       timedelta(hours=1))
+        eq_(result.buckets.tolist(),
+            [ self.start + timedelta(hours=h) for h in range(3) ])
+        eq_(result.values["on_seconds"].tolist(), [1800.0, 1800.0, 900.0])
+        eq_(result.values["duty_cycle"].tolist(), [0.5, 0.5, 0.25])
+
+    def test_time_in_state(self):
+        result = self.equip.time_in_state(self.start,
+                                          self.start + timedelta(hours=3))
+        eq_(result.values[1.0].tolist(), [4500.0])
+        eq_(result.values[0.0].tolist(), [6300.0])
+
+    def test_states_read_in_one_query(self):
+        queries = []
+        def count_query(*args):
+            queries.append(args[2])
+        engine = home_controller.tests.engine
+        event.listen(engine, "before_cursor_execute", count_query)
+        try:
+            result = self.equip.duty_cycle(self.start,
+                                           self.start + timedelta(hours=3))
+        finally:
+            event.remove(engine, "before_cursor_execute", count_query)
+        eq_(len(queries), 1)
+        eq_(result.values["on_seconds"].tolist(), [4500.0])
+
+    def test_state_before_range_from_archive(self):
+        directory = tempfile.mkdtemp()
+        archive = Archive(directory)
+        archive.attach(Equipment)
+        try:
+            archive.run(cutoff=self.start + timedelta(minutes=60))
+            eq_(self.equip.data.count(), 3)
+            result = self.equip.duty_cycle(self.start,
+                                           self.start + timedelta(hours=3),
+                                           timedelta(hours=1))
+            eq_(result.values["on_seconds"].tolist(), [1800.0, 1800.0, 900.0])
+        finally:
+            archive.detach(Equipment)
+            archive.close()
+            shutil.rmtree(directory)
+
+    def test_unknown_state_is_excluded(self):
+        start = self.start - timedelta(hours=2)
+        result = self.equip.duty_cycle(start, self.start, timedelta(hours=1))
+        ok_(np.isnan(result.values["duty_cycle"][0]))
+        eq_(result.values["duty_cycle"][1], 0.0)
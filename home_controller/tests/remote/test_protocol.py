@@ -0,0 +1,43 @@
+"""Tests the remote node batch format
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from datetime import datetime, timedelta
+
+from nose.tools import *
+
+from home_controller.remote import encode_batch, decode_batch
+
+class TestProtocol(object):
+    def setup(self):
+        self.start = datetime(2015, 5, 1, 12, 0, 0, 250)
+
+    def test_round_trip(self):
+        readings = [
+            ("a", self.start + timedelta(seconds=1), [("x", 2.0)]),
+            ("b", self.start, [("y", -1.5), ("z", None)]),
+            ("a", self.start, [("x", 1.0), ("w", 3.0)]),
+        ]
+        batch = decode_batch(encode_batch("node", "boot", 7, readings))
+        eq_((batch.node, batch.boot, batch.seq), ("node", "boot", 7))
+        eq_(batch.readings, [
+            ("a", self.start, { "x": 1.0, "w": 3.0 }),
+            ("a", self.start + timedelta(seconds=1), { "x": 2.0 }),
+            ("b", self.start, { "y": -1.5 }),
+        ])
+
+    def test_compact(self):
+        readings = [ ("sensor", self.start + timedelta(seconds=i),
+                      [("value", 20.0)]) for i in range(1000) ]
+        ok_(len(encode_batch("node", "boot", 1, readings)) < 1000)
+
+    @raises(ValueError)
+    def test_rejects_other_data(self):
+        decode_batch(b"GET / HTTP/1.1")
+
+    @raises(ValueError)
+    def test_rejects_truncated_batch(self):
+        data = encode_batch("node", "boot", 1, [("a", self.start,
+                                                 [("x", 1.0)])])
+        decode_batch(data[:-4])
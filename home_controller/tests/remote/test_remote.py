@@ -0,0 +1,216 @@
+"""Tests shipping readings from remote nodes to the ingest endpoint
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from nose.tools import *
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+import home_controller.tests
+from home_controller.db import Base, HasFloatDataCollection
+from home_controller.tests import DatabaseTest
+from home_controller.equipment import BinaryEquipment
+from home_controller.sensors import RandomValuesSensor
+from home_controller.remote import Node, IngestServer, encode_batch
+
+def setup_module():
+    Base.metadata.create_all(home_controller.tests.engine)
+
+def _run_node(name, url, keys, readings):
+    """Runs a node in its own process until at least `readings` polls per
+    sensor have been shipped & acknowledged
+    """
+    async def main():
+        node = Node(name, url, flush_interval=0.05, retry_interval=0.05)
+        for key in keys:
+            node.add(RandomValuesSensor(sensor_name=key), 0.01, phase=0)
+        node.start()
+        devices = lambda: node.scheduler.stats()["devices"].values()
+        while any(d["runs"] < readings for d in devices()):
+            await gen.sleep(0.01)
+        node.scheduler.stop()
+        # let reads already launched record their values
+        while any(d["pending"] for d in devices()):
+            await gen.sleep(0.01)
+        drained = await node.drain(timeout=20)
+        node.stop()
+        return drained
+
+    if not IOLoop.current().run_sync(main, timeout=30):
+        raise SystemExit(1)
+
+class TestRemoteNodes(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.server = IngestServer()
+        sock, port = bind_unused_port()
+        self.http = HTTPServer(self.server.application())
+        self.http.add_sockets([sock])
+        self.url = "http://127.0.0.1:{}/ingest".format(port)
+        self.spool = tempfile.mkdtemp()
+
+    def teardown(self):
+        self.http.stop()
+        shutil.rmtree(self.spool)
+        super().teardown()
+
+    def _sensors(self, *names):
+        sensors = [ RandomValuesSensor(sensor_name=name) for name in names ]
+        self.session.add_all(sensors)
+        self.session.commit()
+        return sensors
+
+    def _run(self, coroutine, timeout=30):
+        return IOLoop.current().run_sync(coroutine, timeout=timeout)
+
+    def test_node_processes(self):
+        sensors = self._sensors("remote a", "remote b", "remote c", "remote d")
+        context = multiprocessing.get_context("spawn")
+        processes = [
+            context.Process(target=_run_node,
+                            args=("node 0", self.url, ["remote a"], 20)),
+            context.Process(target=_run_node,
+                            args=("node 1", self.url,
+                                  ["remote b", "remote c"], 20)),
+            context.Process(target=_run_node,
+                            args=("node 2", self.url, ["remote d"], 20)),
+        ]
+        for process in processes:
+            process.start()
+
+        async def wait():
+            while any(p.is_alive() for p in processes):
+                await gen.sleep(0.05)
+        self._run(wait, timeout=60)
+
+        eq_([ p.exitcode for p in processes ], [0, 0, 0])
+        counts = [ sensor.data.count() for sensor in sensors ]
+        ok_(all(count >= 20 for count in counts), counts)
+        eq_(self.server.stats()["nodes"], 3)
+        eq_(self.server.stats()["records"], sum(counts))
+        history = list(sensors[1].history())
+        eq_(set(history[0][1]), { "value_0", "value_1" })
+
+    def test_store_and_forward(self):
+        sensor, = self._sensors("forwarded")
+        # nothing is listening on the first URL
+        sock, port = bind_unused_port()
+        sock.close()
+        offline = Node("node", "http://127.0.0.1:{}/ingest".format(port),
+                       spool_directory=self.spool, retry_interval=0.01,
+                       max_retry_interval=0.02)
+        start = datetime(2015, 1, 1)
+        for i in range(5):
+            offline.record("forwarded", start + timedelta(seconds=i),
+                           [("value", float(i))])
+
+        async def fail_to_send():
+            offline.start()
+            ok_(not await offline.drain(timeout=0.2))
+            offline.stop()
+        self._run(fail_to_send)
+        ok_(offline.retries > 0)
+        eq_(len(os.listdir(self.spool)), 1)
+
+        # a restarted node resends what was spooled
+        online = Node("node", self.url, spool_directory=self.spool)
+        eq_(online.pending, 1)
+
+        async def send():
+            online.start()
+            ok_(await online.drain(timeout=10))
+            online.stop()
+        self._run(send)
+        eq_(os.listdir(self.spool), [])
+        eq_([ v["value"] for _, v in sensor.history() ],
+            [0.0, 1.0, 2.0, 3.0, 4.0])
+
+    def test_duplicates_and_unknown_devices(self):
+        sensor, = self._sensors("deduplicated")
+        registered = RandomValuesSensor(sensor_name="registered")
+        self.session.add(registered)
+        self.session.commit()
+        self.server.register(registered, "alias")
+        seen = []
+        listener = lambda device, timestamp, values: seen.append(device)
+        HasFloatDataCollection.add_data_listener(listener)
+
+        data = encode_batch("node", "boot", 1, [
+            ("deduplicated", datetime(2015, 1, 1), [("value", 1.0)]),
+            ("alias", datetime(2015, 1, 1), [("value", 2.0)]),
+            ("missing", datetime(2015, 1, 1), [("value", 3.0)]),
+        ])
+
+        async def post_twice():
+            client = AsyncHTTPClient()
+            acks = []
+            for _ in range(2):
+                response = await client.fetch(self.url, method="POST",
+                                              body=data)
+                acks.append(json.loads(response.body.decode("utf-8")))
+            return acks
+        try:
+            first, second = self._run(post_twice)
+        finally:
+            HasFloatDataCollection.remove_data_listener(listener)
+
+        eq_((first["records"], first["duplicate"], first["unknown"]),
+            (2, False, ["missing"]))
+        ok_(second["duplicate"])
+        eq_(sensor.data.count(), 1)
+        eq_(registered.data.count(), 1)
+        eq_(len(seen), 2)
+
+    def _post(self, data):
+        async def post():
+            response = await AsyncHTTPClient().fetch(
+                self.url, method="POST", body=data, raise_error=False)
+            return response.code, json.loads(response.body.decode("utf-8"))
+        return self._run(post)
+
+    def test_duplicates_after_restart(self):
+        sensor, = self._sensors("restarted")
+        data = encode_batch("node", "restart", 1, [
+            ("restarted", datetime(2015, 1, 1), [("value", 1.0)])])
+        eq_(self._post(data)[1]["records"], 1)
+
+        self.http.stop()
+        self.server = IngestServer()
+        sock, port = bind_unused_port()
+        self.http = HTTPServer(self.server.application())
+        self.http.add_sockets([sock])
+        self.url = "http://127.0.0.1:{}/ingest".format(port)
+        ok_(self._post(data)[1]["duplicate"])
+        eq_(sensor.data.count(), 1)
+
+    def test_failed_batch_is_not_partly_written(self):
+        sensor, = self._sensors("partial")
+        switch = BinaryEquipment("state", "partial switch")
+        self.session.add(switch)
+        self.session.commit()
+        self.server.register(switch)
+        data = encode_batch("node", "partial", 1, [
+            ("partial", datetime(2015, 1, 1), [("value", 1.0)]),
+            ("partial switch", datetime(2015, 1, 1), [("state", 1.0)]),
+        ])
+
+        with patch.object(BinaryEquipment, "_insert_records",
+                          side_effect=IOError("disk full")):
+            eq_(self._post(data)[0], 500)
+        eq_(sensor.data.count(), 0)
+        code, ack = self._post(data)
+        eq_((code, ack["records"], ack["duplicate"]), (200, 2, False))
+        eq_(sensor.data.count(), 1)
+        eq_(switch.data.count(), 1)
@@ -4,11 +4,13 @@
 # Ben Peters (bencpeters@gmail.com)
 
 from nose.tools import *
-from time import sleep
-from datetime import datetime
+from tornado.ioloop import IOLoop
+from time import sleep, time
+from datetime import datetime, timedelta
 
 from home_controller.tests import DatabaseTest
 from home_controller.sensors import RandomValuesSensor, Sensor, SineWaveSensor
+from home_controller.tools import configure_process_pool, shutdown_pools
 
 class TestRandomSensor(DatabaseTest):
     """
@@ -34,16 +36,16 @@ class TestRandomSensor(DatabaseTest):
     def test_update_sensor_reads_sensor(self):
         self.sensor.update()
         sleep(self.async_wait_time)
-        records = self.sensor.data
+        records = self.sensor.data.all()
         eq_(len(records), 1)
         self._test_random_value(records[0].values)
 
     def test_update_sensor_adds_objects_to_db(self):
-        eq_(len(self.sensor.data), 0)
+        eq_(self.sensor.data.count(), 0)
         self.sensor.update()
         sleep(self.async_wait_time)
         records = self.session.query(Sensor). \
-            filter(Sensor.id == self.sensor.id).first().data
+            filter(Sensor.id == self.sensor.id).first().data.all()
         eq_(len(records), 1)
         self._test_random_value(records[0].values)
 
@@ -60,12 +62,50 @@ class TestRandomSensor(DatabaseTest):
                 "curr_value {} ({}) should equal {}".format(
                         val.name, curr_val[val.name], val.value))
 
+    def test_update_async(self):
+        values = IOLoop.current().run_sync(self.sensor.update_async)
+        self._test_random_value(values)
+        eq_(self.sensor.data.count(), 1)
+        eq_(self.sensor.current_value, { v.name: v.value for v in values })
+
     def test_last_update(self):
         start = datetime.now()
         self.sensor.update()
         sleep(self.async_wait_time)
         ok_(self.sensor.last_update > start)
 
+class TestSensorHistory(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.sensor = RandomValuesSensor(sensor_name="history")
+        self.start = datetime(2015, 1, 1)
+        for i in range(5):
+            self.sensor._persist_data(self.start + timedelta(minutes=i),
+                                      self.sensor.read())
+
+    def test_history_in_time_order(self):
+        history = list(self.sensor.history())
+        eq_(len(history), 5)
+        eq_([ ts for ts, _ in history ],
+            [ self.start + timedelta(minutes=i) for i in range(5) ])
+        eq_(set(history[0][1].keys()), { "value_0", "value_1" })
+
+    def test_history_range(self):
+        history = list(self.sensor.history(
+            start=self.start + timedelta(minutes=1),
+            end=self.start + timedelta(minutes=3)))
+        eq_([ ts for ts, _ in history ],
+            [ self.start + timedelta(minutes=i) for i in (1, 2) ])
+
+    def test_history_channels_and_limit(self):
+        history = list(self.sensor.history(channels=["value_1"], limit=2))
+        eq_(len(history), 2)
+        for _, values in history:
+            eq_(list(values.keys()), ["value_1"])
+
+    def test_history_unsaved_sensor(self):
+        eq_(list(RandomValuesSensor(sensor_name="new").history()), [])
+
 class TestSineWaveSensor(DatabaseTest):
     def setup(self):
         self.period = 0.1
@@ -96,3 +136,53 @@ class TestSineWaveSensor(DatabaseTest):
                                                           self.max))
         ok_(abs(val.value - end_val.value) > 1, "Value {} should have changed "
                 "from {}".format(val.value, end_val.value))
+
+    def test_update_in_process_pool(self):
+        configure_process_pool("sine", 1)
+        self.sensor.process_pool = "sine"
+        try:
+            values = IOLoop.current().run_sync(self.sensor.update_async,
+                                               timeout=30)
+        finally:
+            shutdown_pools()
+        eq_(len(values), 1)
+        ok_(isinstance(values[0], Sensor.value_type))
+        ok_(self.min <= values[0].value <= self.max)
+        eq_(self.sensor.data.count(), 1)
+
+class TestBatchGeneration(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.sine = SineWaveSensor(sensor_name="sine_batch", period=10,
+                                   max_value=8, min_value=-2)
+        self.random = RandomValuesSensor(sensor_name="random_batch")
+
+    def test_sine_batch_matches_read(self):
+        now = time()
+        value = self.sine.read()[0].value
+        batch = self.sine.read_batch([now])["value"]
+        ok_(abs(batch[0] - value) < 0.01)
+
+    def test_generate_grid(self):
+        start = time()
+        timestamps, values = self.sine.generate(start, start + 10, 0.5)
+        eq_(len(timestamps), 20)
+        eq_(len(values["value"]), 20)
+        ok_(values["value"].max() <= 8 and values["value"].min() >= -2)
+
+        timestamps, values = self.random.generate(start, start + 10, 1)
+        eq_(sorted(values.keys()), ["value_0", "value_1"])
+        ok_(all(0 <= v < 1 for v in values["value_1"]))
+
+    def test_store_arrays(self):
+        start = datetime(2015, 2, 1)
+        epoch = (start - datetime(1970, 1, 1)).total_seconds()
+        timestamps, values = self.sine.generate(epoch, epoch + 60, 1)
+        eq_(self.sine.store_arrays(timestamps, values, chunk_size=25), 60)
+
+        history = list(self.sine.history())
+        eq_(len(history), 60)
+        eq_(history[0][0], start)
+        ok_(abs(history[-1][1]["value"] - values["value"][-1]) < 1e-9)
+        eq_(self.sine.last_update, start + timedelta(seconds=59))
+        eq_(self.sine.current_value, { "value": values["value"][-1] })
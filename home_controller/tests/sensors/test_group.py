@@ -0,0 +1,82 @@
+"""Tests batched reads of sensor groups
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from nose.tools import *
+from sqlalchemy import event
+from tornado.ioloop import IOLoop
+
+import home_controller.tests
+from home_controller.tests import DatabaseTest
+from home_controller.sensors import RandomValuesSensor, Sensor, SensorGroup
+from home_controller.tools import get_pool
+
+class Bus(SensorGroup):
+    """Reads every probe in one call
+    """
+    reads = 0
+
+    def read_all(self):
+        self.reads += 1
+        return { s: [ Sensor.value_type(float(i), "temperature") ]
+                 for i, s in enumerate(self.sensors) }
+
+class TestSensorGroup(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.probes = [ RandomValuesSensor(sensor_name="probe_{}".format(i))
+                        for i in range(3) ]
+        self.bus = Bus("bus", self.probes)
+
+    def test_one_read_updates_every_member(self):
+        self.bus.update().result()
+        eq_(self.bus.reads, 1)
+        for i, probe in enumerate(self.probes):
+            eq_(probe.current_value, { "temperature": float(i) })
+            eq_(probe.data.count(), 1)
+
+    def test_members_are_written_in_one_transaction(self):
+        self.bus.update().result()
+        commits = []
+        listener = lambda conn: commits.append(conn)
+        engine = home_controller.tests.engine
+        event.listen(engine, "commit", listener)
+        try:
+            self.bus.update().result()
+        finally:
+            event.remove(engine, "commit", listener)
+        eq_(len(commits), 1)
+        eq_([ p.data.count() for p in self.probes ], [2, 2, 2])
+
+    def test_last_update_of_saved_members(self):
+        self.session.add_all(self.probes)
+        self.session.commit()
+        for probe in self.probes:
+            self.session.refresh(probe)
+        # e.g. loaded by the bootstrap, in a session that has since closed
+        self.session.expunge_all()
+        self.bus.update().result()
+        for probe in self.probes:
+            eq_(self.session.query(Sensor.last_update).
+                filter_by(id=probe.id).scalar(), probe.last_update)
+
+    def test_members_share_the_group_thread(self):
+        pool = get_pool()
+        ok_(all(pool.executor_for(p) is pool.executor_for(self.bus)
+                for p in self.probes))
+
+    def test_default_read_all_reads_each_member(self):
+        group = SensorGroup("plain", [ RandomValuesSensor(sensor_name="r") ])
+        readings = IOLoop.current().run_sync(group.update_async)
+        eq_(len(next(iter(readings.values()))), 2)
+
+    @raises(ValueError)
+    def test_member_already_running_elsewhere(self):
+        probe = RandomValuesSensor(sensor_name="busy")
+        probe.update().result()
+        other = SensorGroup("other")
+        pool = get_pool()
+        while pool.executor_for(other) is pool.executor_for(probe):
+            other = SensorGroup("other")
+        other.add(probe)
@@ -0,0 +1,171 @@
+"""Tests the segment file archive
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+import numpy as np
+from nose.tools import *
+
+import home_controller.tests
+from home_controller.db import Base
+from home_controller.tests import DatabaseTest
+from home_controller.sensors import RandomValuesSensor
+from home_controller.storage import Archive, Segment
+from home_controller.tests.storage.test_wide import WideDevice
+
+def setup_module():
+    Base.metadata.create_all(home_controller.tests.engine)
+
+class TestSegment(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        path = os.path.join(self.directory, "test.seg")
+        segment = Segment.write(path, [10, 20, 30],
+                                { "a": [1.0, 2.0, 3.0],
+                                  "b": [np.nan, 5.0, 6.0] })
+        eq_(segment.channels, ["a", "b"])
+        eq_((segment.start, segment.end), (10, 30))
+        eq_(segment.slice(15, 30), (1, 2))
+        eq_(segment.columns["a"].tolist(), [1.0, 2.0, 3.0])
+        ok_(np.isnan(segment.columns["b"][0]))
+        ok_(not segment.columns["a"].flags.writeable)
+        segment.close()
+
+    @raises(ValueError)
+    def test_rejects_other_files(self):
+        path = os.path.join(self.directory, "other.seg")
+        with open(path, "wb") as f:
+            f.write(b"not a segment")
+        Segment(path)
+
+class TestArchive(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.directory = tempfile.mkdtemp()
+        self.archive = Archive(self.directory, batch_size=4)
+        self.archive.attach(RandomValuesSensor, WideDevice)
+        self.sensor = RandomValuesSensor(sensor_name="archived")
+        self.session.add(self.sensor)
+        self.session.commit()
+        self.start = datetime(2015, 1, 1)
+        self.seconds = (self.start - datetime(1970, 1, 1)).total_seconds()
+
+    def teardown(self):
+        self.archive.detach(RandomValuesSensor, WideDevice)
+        self.archive.close()
+        shutil.rmtree(self.directory)
+        super().teardown()
+
+    def _store(self, device, count):
+        device.store_arrays(self.seconds + np.arange(count),
+                            { "a": np.arange(count) * 1.0,
+                              "b": np.arange(count) * 2.0 })
+
+    def _files(self, device):
+        return os.listdir(os.path.join(self.directory, device.data_table_name,
+                                       str(device.id)))
+
+    def test_moves_old_records(self):
+        self._store(self.sensor, 10)
+        archived = self.archive.run(cutoff=self.start + timedelta(seconds=6))
+        eq_(archived[RandomValuesSensor.data_table_name], 6)
+        eq_(self.sensor.data.count(), 4)
+        # the segments of the two batches are merged into one
+        eq_(len(self._files(self.sensor)), 1)
+        eq_(self.archive.read(self.sensor)[1]["a"].tolist(),
+            [ i * 1.0 for i in range(6) ])
+
+    def test_one_segment_per_period(self):
+        archive = Archive(self.directory, batch_size=3,
+                          segment_period=timedelta(seconds=5))
+        self._store(self.sensor, 10)
+        archive.archive_class(RandomValuesSensor,
+                              self.start + timedelta(seconds=10))
+        eq_(len(self._files(self.sensor)), 2)
+        timestamps, columns = archive.read(self.sensor)
+        eq_(len(timestamps), 10)
+        eq_(columns["b"].tolist(), [ i * 2.0 for i in range(10) ])
+        archive.close()
+
+    def test_open_segments_are_capped(self):
+        archive = Archive(self.directory, batch_size=3,
+                          segment_period=timedelta(seconds=2), max_open=2)
+        self._store(self.sensor, 10)
+        archive.archive_class(RandomValuesSensor,
+                              self.start + timedelta(seconds=10))
+        timestamps, columns = archive.read(self.sensor)
+        eq_(len(self._files(self.sensor)), 5)
+        eq_(len(archive._open), 2)
+        eq_(columns["a"].tolist(), [ i * 1.0 for i in range(10) ])
+        archive.close()
+
+    def test_history_spans_archive_and_db(self):
+        self._store(self.sensor, 10)
+        self.archive.run(cutoff=self.start + timedelta(seconds=6))
+        history = list(self.sensor.history())
+        eq_([ t for t, _ in history ],
+            [ self.start + timedelta(seconds=i) for i in range(10) ])
+        eq_([ v["b"] for _, v in history ], [ i * 2.0 for i in range(10) ])
+
+        history = list(self.sensor.history(
+            start=self.start + timedelta(seconds=2), channels=["a"], limit=5))
+        eq_([ v for _, v in history ], [ { "a": i * 1.0 } for i in range(2, 7) ])
+
+    def test_read_single_segment_is_a_view(self):
+        self._store(self.sensor, 4)
+        self.archive.run(cutoff=self.start + timedelta(days=1))
+        timestamps, columns = self.archive.read(
+            self.sensor, start=self.start + timedelta(seconds=1))
+        eq_(len(timestamps), 3)
+        eq_(columns["a"].tolist(), [1.0, 2.0, 3.0])
+        ok_(columns["a"].base is not None)
+        ok_(not columns["a"].flags.owndata)
+
+    def test_index_is_loaded_from_files(self):
+        self._store(self.sensor, 6)
+        self.archive.run(cutoff=self.start + timedelta(days=1))
+        fresh = Archive(self.directory)
+        timestamps, columns = fresh.read(self.sensor)
+        eq_(len(timestamps), 6)
+        eq_(columns["b"].tolist(), [ i * 2.0 for i in range(6) ])
+        fresh.close()
+
+    def test_retention(self):
+        self._store(self.sensor, 3)
+        self.archive.retention = timedelta(days=1)
+        self.archive.run(now=self.start + timedelta(hours=1))
+        eq_(self.sensor.data.count(), 3)
+        self.archive.run(now=self.start + timedelta(days=2))
+        eq_(self.sensor.data.count(), 0)
+
+    @raises(ValueError)
+    def test_run_needs_cutoff(self):
+        self.archive.run()
+
+    def test_wide_storage(self):
+        device = WideDevice("archived wide")
+        self.session.add(device)
+        self.session.commit()
+        self._store(device, 5)
+        self.archive.run(cutoff=self.start + timedelta(seconds=3))
+        eq_(device.data.count(), 2)
+        eq_([ v["a"] for _, v in device.history() ],
+            [ i * 1.0 for i in range(5) ])
+
+    def test_aggregate_includes_archive(self):
+        self._store(self.sensor, 10)
+        self.archive.run(cutoff=self.start + timedelta(seconds=5))
+        result = self.sensor.aggregate("a", self.start,
+                                       self.start + timedelta(minutes=1), 4)
+        eq_(result.values["count"].tolist(), [4, 4, 2])
+        eq_(result.values["sum"].tolist(), [6.0, 22.0, 17.0])
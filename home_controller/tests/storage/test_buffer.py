@@ -0,0 +1,66 @@
+"""Tests the write-behind buffer
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from datetime import datetime
+
+from nose.tools import *
+
+from home_controller.tests import DatabaseTest
+from home_controller.sensors import RandomValuesSensor, Sensor
+from home_controller.storage import WriteBuffer
+
+class TestWriteBuffer(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.buffer = WriteBuffer(max_size=10, max_delay=60)
+        self.sensor = RandomValuesSensor(sensor_name="buffered")
+        self.session.add(self.sensor)
+        self.session.commit()
+        self.sensor.write_buffer = self.buffer
+
+    def _record_count(self):
+        return self.session.query(Sensor.record_type). \
+            filter(Sensor.record_type.parent_id == self.sensor.id).count()
+
+    def test_update_is_queued(self):
+        self.sensor._update_data(self.sensor.read())
+        eq_(self.buffer.queue_depth, 1)
+        eq_(self._record_count(), 0)
+
+    def test_current_value_updates_immediately(self):
+        start = datetime.utcnow()
+        data = self.sensor.read()
+        self.sensor._update_data(data)
+        eq_(self.sensor.current_value, { v.name: v.value for v in data })
+        ok_(self.sensor.last_update >= start)
+
+    def test_flush_writes_all_records(self):
+        for _ in range(3):
+            self.sensor._update_data(self.sensor.read())
+        eq_(self.buffer.flush(), 3)
+        eq_(self.buffer.queue_depth, 0)
+        eq_(self._record_count(), 3)
+
+        records = self.session.query(Sensor.record_type). \
+            filter(Sensor.record_type.parent_id == self.sensor.id).all()
+        for record in records:
+            eq_(len(record.values), 2)
+            ok_(record.timestamp is not None)
+
+    def test_stop_flushes(self):
+        self.sensor._update_data(self.sensor.read())
+        self.buffer.stop()
+        eq_(self._record_count(), 1)
+
+    def test_stats(self):
+        for _ in range(4):
+            self.sensor._update_data(self.sensor.read())
+        self.buffer.flush()
+        stats = self.buffer.stats()
+        eq_(stats["flushes"], 1)
+        eq_(stats["records_written"], 4)
+        eq_(stats["max_queue_depth"], 4)
+        eq_(stats["queue_depth"], 0)
+        ok_(stats["last_flush_time"] > 0)
@@ -0,0 +1,142 @@
+"""Tests compression of the persistence path
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from datetime import datetime, timedelta
+from math import isnan
+from unittest.mock import patch
+
+from nose.tools import *
+
+from home_controller.tests import DatabaseTest
+from home_controller.sensors import SineWaveSensor, Sensor
+from home_controller.storage import Deadband, SwingingDoor, reconstruct
+
+START = datetime(2015, 1, 1)
+
+class Device(object):
+    pass
+
+def _offer_all(compressor, values, channel="value"):
+    device = Device()
+    records = []
+    for i, value in enumerate(values):
+        records.extend(compressor.offer(device, START + timedelta(seconds=i),
+                                        [(channel, value)]))
+    return device, [ (int((t - START).total_seconds()), v[0][1])
+                     for t, v in records ]
+
+class TestDeadband(object):
+    def test_absolute(self):
+        _, records = _offer_all(Deadband(absolute=0.5),
+                                [1.0, 1.2, 1.4, 1.6, 1.3, 0.4])
+        eq_(records, [(0, 1.0), (3, 1.6), (5, 0.4)])
+
+    def test_relative(self):
+        _, records = _offer_all(Deadband(relative=0.1),
+                                [10.0, 10.5, 11.5, 11.6])
+        eq_(records, [(0, 10.0), (2, 11.5)])
+
+    def test_channel_override(self):
+        compressor = Deadband(absolute=10, channels={"fine": {"absolute": 0.1}})
+        _, records = _offer_all(compressor, [1.0, 1.5], channel="fine")
+        eq_(len(records), 2)
+
+    def test_max_interval(self):
+        _, records = _offer_all(Deadband(absolute=1, max_interval=3),
+                                [1.0] * 7)
+        eq_([ t for t, _ in records ], [0, 3, 6])
+
+    def test_stats(self):
+        compressor = Deadband(absolute=1)
+        _offer_all(compressor, [1.0, 1.1, 1.2, 1.3])
+        eq_(compressor.stats(), { "offered": 4, "persisted": 1, "ratio": 4.0 })
+
+class TestSwingingDoor(object):
+    def test_straight_line_is_compressed(self):
+        device, records = _offer_all(SwingingDoor(0.1),
+                                     [ i * 2.0 for i in range(10) ])
+        eq_(records, [(0, 0.0)])
+        eq_(SwingingDoor(0.1).pending(device), None)
+
+    def test_corner_writes_held_point(self):
+        values = [0, 1, 2, 3, 4, 3, 2, 1]
+        compressor = SwingingDoor(0.1)
+        device, records = _offer_all(compressor, values)
+        eq_(records, [(0, 0), (4, 4)])
+        eq_(compressor.pending(device)[0], START + timedelta(seconds=7))
+
+    def test_step_at_max_interval_keeps_held_point(self):
+        compressor = SwingingDoor(0.5, max_interval=10)
+        device, records = _offer_all(compressor, [0.0] * 10 + [10.0])
+        eq_(records, [(0, 0.0), (9, 0.0), (10, 10.0)])
+        history = [ (START + timedelta(seconds=t), { "value": v })
+                    for t, v in records ]
+        grid, result = reconstruct(history, START,
+                                   START + timedelta(seconds=10), 1)
+        ok_(all(abs(v) <= 0.5 for v in result["value"]))
+
+    def test_reconstruction_within_deviation(self):
+        values = [ (i % 20) * 0.5 if i % 40 < 20 else 10 - (i % 20) * 0.5
+                   for i in range(80) ]
+        compressor = SwingingDoor(0.2)
+        device, records = _offer_all(compressor, values)
+        held = compressor.pending(device)
+        history = [ (START + timedelta(seconds=t), { "value": v })
+                    for t, v in records ]
+        history.append((held[0], dict(held[1])))
+        grid, result = reconstruct(history, START,
+                                   START + timedelta(seconds=80), 1)
+        eq_(len(grid), 80)
+        ok_(len(records) < 10)
+        for expected, actual in zip(values, result["value"]):
+            ok_(abs(expected - actual) <= 0.2 + 1e-9)
+
+class TestReconstruct(object):
+    def test_interpolates_grid(self):
+        history = [ (START, { "a": 0.0 }),
+                    (START + timedelta(seconds=4), { "a": 8.0 }) ]
+        grid, result = reconstruct(history, START,
+                                   START + timedelta(seconds=6), 1)
+        eq_(list(result["a"][:5]), [0.0, 2.0, 4.0, 6.0, 8.0])
+        ok_(isnan(result["a"][5]))
+
+class TestCompressedSensor(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.sensor = SineWaveSensor(sensor_name="compressed", period=1000)
+        self.sensor.compression = Deadband(absolute=5)
+
+    def test_small_changes_are_not_written(self):
+        for _ in range(5):
+            self.sensor._update_data(self.sensor.read())
+        eq_(self.sensor.data.count(), 1)
+        eq_(self.sensor.current_value["value"],
+            self.sensor._latest_data[0].value)
+
+    def test_flush_from_another_thread(self):
+        compression = self.sensor.compression = SwingingDoor(deviation=100)
+        for _ in range(3):
+            self.sensor.update().result(1)
+        held = compression.pending(self.sensor)
+        ok_(held is not None)
+
+        eq_(compression.flush(), 1)
+        eq_(compression.pending(self.sensor), None)
+        eq_(compression.persisted, 2)
+        eq_(list(self.sensor.history())[-1],
+            (held[0], dict(held[1])))
+
+    def test_failed_flush_keeps_records(self):
+        compression = self.sensor.compression = SwingingDoor(deviation=100)
+        for _ in range(2):
+            self.sensor._update_data(self.sensor.read())
+        held = compression.pending(self.sensor)
+
+        with patch.object(SineWaveSensor, "_insert_records",
+                          side_effect=IOError("disk full")):
+            assert_raises(IOError, compression.flush)
+        eq_(compression.pending(self.sensor), held)
+        eq_(compression.persisted, 1)
+        eq_(compression.flush(), 1)
@@ -0,0 +1,120 @@
+"""Tests the rollup tables
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from datetime import datetime, timedelta
+
+from nose.tools import *
+
+import home_controller.tests
+from home_controller.db import Base
+from home_controller.tests import DatabaseTest
+from home_controller.sensors import RandomValuesSensor, Sensor
+from home_controller.storage import Rollups, Rollup
+from home_controller.tools import VirtualClock, using_clock
+
+def setup_module():
+    Base.metadata.create_all(home_controller.tests.engine)
+
+class TestRollups(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.rollups = Rollups(tiers=((60, timedelta(hours=1)),
+                                      (3600, None)),
+                               raw_retention=timedelta(hours=1))
+        self.sensor = RandomValuesSensor(sensor_name="rollups")
+        self.session.add(self.sensor)
+        self.session.commit()
+        self.start = datetime(2015, 1, 1)
+
+    def _record(self, seconds, value, channel="value"):
+        self.rollups.record(self.sensor,
+                            self.start + timedelta(seconds=seconds),
+                            [(channel, value)])
+
+    def test_open_bucket_is_queryable(self):
+        for i, value in enumerate([1.0, 2.0, 6.0]):
+            self._record(i, value)
+        resolution, points = self.rollups.query(
+            self.sensor, "value", self.start,
+            self.start + timedelta(minutes=5))
+        eq_(resolution, 60)
+        eq_(len(points), 1)
+        eq_(points[0].count, 3)
+        eq_(points[0].mean, 3.0)
+        eq_((points[0].minimum, points[0].maximum), (1.0, 6.0))
+
+    def test_closed_buckets_are_written(self):
+        self._record(0, 1.0)
+        self._record(61, 3.0)
+        rows = self.session.query(Rollup).filter_by(
+            parent_id=self.sensor.id, resolution=60).all()
+        eq_(len(rows), 1)
+        eq_(rows[0].bucket, self.start)
+
+    def test_flush_merges_partial_buckets(self):
+        self._record(0, 1.0)
+        self.rollups.flush()
+        self._record(1, 3.0)
+        self.rollups.flush()
+        row = self.session.query(Rollup).filter_by(
+            parent_id=self.sensor.id, resolution=60).one()
+        eq_((row.count, row.mean), (2, 2.0))
+
+    def test_writers_merge_into_one_row(self):
+        other = Rollups(tiers=self.rollups.tiers)
+        self._record(0, 1.0)
+        other.record(self.sensor, self.start, [("value", 5.0)])
+        other.flush()
+        self.rollups.flush()
+        row = self.session.query(Rollup).filter_by(
+            parent_id=self.sensor.id, resolution=60).one()
+        eq_((row.count, row.minimum, row.maximum), (2, 1.0, 5.0))
+
+    def test_open_buckets_are_flushed_periodically(self):
+        with using_clock(VirtualClock(self.start)) as clock:
+            rollups = Rollups(tiers=self.rollups.tiers, flush_interval=60)
+            rollups.record(self.sensor, self.start, [("value", 1.0)])
+            eq_(self.session.query(Rollup).filter_by(
+                parent_id=self.sensor.id).count(), 0)
+            clock.advance(60)
+            rollups.record(self.sensor, self.start, [("value", 3.0)])
+        rows = self.session.query(Rollup).filter_by(
+            parent_id=self.sensor.id).all()
+        eq_(sorted((r.resolution, r.count) for r in rows),
+            [ (60, 2), (3600, 2) ])
+
+    def test_resolution_for_point_budget(self):
+        day = timedelta(days=1)
+        eq_(self.rollups.resolution_for(self.start, self.start + day, 1440),
+            60)
+        eq_(self.rollups.resolution_for(self.start, self.start + day, 100),
+            3600)
+        eq_(self.rollups.resolution_for(self.start, self.start + day * 30, 10),
+            3600)
+
+    def test_listener_records_updates(self):
+        self.rollups.attach()
+        try:
+            data = self.sensor.read()
+            self.sensor._update_data(data)
+        finally:
+            self.rollups.detach()
+        row = self.session.query(Rollup).filter_by(
+            parent_id=self.sensor.id, resolution=60,
+            channel="value_0").one()
+        eq_(row.total, data[0].value)
+
+    def test_prune(self):
+        self._record(0, 1.0)
+        self._record(3600, 1.0)
+        self.rollups.flush()
+        self.sensor._persist_data(self.start, self.sensor.read())
+
+        self.rollups.prune(now=self.start + timedelta(hours=1, minutes=30))
+        eq_(self.session.query(Rollup).filter_by(
+            parent_id=self.sensor.id, resolution=60).count(), 1)
+        eq_(self.session.query(Rollup).filter_by(
+            parent_id=self.sensor.id, resolution=3600).count(), 2)
+        eq_(self.sensor.data.count(), 0)
@@ -0,0 +1,134 @@
+"""Tests the wide data collection storage
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from datetime import datetime, timedelta
+
+from nose.tools import *
+from sqlalchemy import Column, Unicode, DateTime
+
+import home_controller.tests
+from home_controller.db import Base, Timestamps, UniqueId, latest_values
+from home_controller.tests import DatabaseTest
+from home_controller.sensors import RandomValuesSensor, Sensor
+from home_controller.storage import (
+    HasWideFloatDataCollection, FloatValue, migrate_to_wide
+)
+
+class WideDevice(Timestamps, UniqueId, HasWideFloatDataCollection, Base):
+    __tablename__ = "wide_devices"
+    data_table_name = "wide_device_data"
+    max_channels = 3
+    name = Column(Unicode, nullable=False)
+    last_update = Column(DateTime)
+
+    def __init__(self, name):
+        self.name = name
+
+def setup_module():
+    Base.metadata.create_all(home_controller.tests.engine)
+
+class TestWideStorage(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.device = WideDevice("wide")
+
+    def _values(self, *values):
+        return [ FloatValue(v, "ch_{}".format(i))
+                 for i, v in enumerate(values) ]
+
+    def test_update_stores_one_row(self):
+        self.device._update_data(self._values(1.0, 2.0, 3.0))
+        records = self.session.query(WideDevice.record_type). \
+            filter_by(parent_id=self.device.id).all()
+        eq_(len(records), 1)
+        eq_([ (v.name, v.value) for v in records[0].values ],
+            [ ("ch_0", 1.0), ("ch_1", 2.0), ("ch_2", 3.0) ])
+        ok_(records[0].timestamp is not None)
+
+    def test_layouts_are_shared(self):
+        for i in range(3):
+            self.device._update_data(self._values(i, i))
+        eq_(self.session.query(WideDevice.layout_type).
+            filter(WideDevice.layout_type.channels == ["ch_0", "ch_1"]).
+            count(), 1)
+
+    def test_data_relationship(self):
+        self.device._update_data(self._values(4.0))
+        eq_(self.device.data.count(), 1)
+        eq_(self.device.data[0].values[0].value, 4.0)
+
+    def test_current_value(self):
+        self.device._update_data(self._values(5.0, 6.0))
+        eq_({ v.name: v.value for v in self.device._latest_data },
+            { "ch_0": 5.0, "ch_1": 6.0 })
+
+    def test_history(self):
+        start = datetime(2015, 1, 1)
+        for i in range(3):
+            self.device._persist_data(start + timedelta(seconds=i),
+                                      self._values(i, i * 2))
+        history = list(self.device.history(start=start, channels=["ch_1"]))
+        eq_(history, [ (start + timedelta(seconds=i), { "ch_1": i * 2 })
+                       for i in range(3) ])
+
+    def test_rolled_back_layout_isnt_cached(self):
+        start = datetime(2015, 1, 1)
+        self.session.add(self.device)
+        self.session.commit()
+        WideDevice._insert_records(self.session.connection(), [
+            (self.device.id, start, [("rolled_back", 1.0)])])
+        self.session.rollback()
+
+        self.device._persist_data(start, [FloatValue(2.0, "rolled_back")])
+        record = self.session.query(WideDevice.record_type). \
+            filter_by(parent_id=self.device.id).one()
+        eq_([ (v.name, v.value) for v in record.values ],
+            [ ("rolled_back", 2.0) ])
+
+    def test_latest_records(self):
+        start = datetime(2015, 1, 1)
+        self.device._persist_data(start, self._values(1.0))
+        self.device._persist_data(start + timedelta(seconds=1),
+                                  self._values(2.0, 3.0))
+        latest_values.load(self.session.connection(), WideDevice)
+        eq_(latest_values.get(self.device).values,
+            { "ch_0": 2.0, "ch_1": 3.0 })
+
+    @raises(ValueError)
+    def test_too_many_channels(self):
+        self.device._update_data(self._values(1, 2, 3, 4))
+
+    def test_migrate(self):
+        sensor = RandomValuesSensor(sensor_name="eav")
+        for _ in range(3):
+            sensor._update_data(sensor.read())
+
+        source = self.session.query(Sensor.record_type).count()
+        connection = self.session.connection()
+        before = self.session.query(WideDevice.record_type).count()
+        eq_(migrate_to_wide(connection, "sensor_data", WideDevice,
+                            chunk_size=2), source)
+        eq_(self.session.query(WideDevice.record_type).count() - before,
+            source)
+
+        record = self.session.query(WideDevice.record_type). \
+            filter_by(parent_id=sensor.id). \
+            order_by(WideDevice.record_type.id.desc()).first()
+        eq_(len(record.values), 2)
+
+    def test_aggregate_across_layouts(self):
+        self.session.add(self.device)
+        self.session.commit()
+        start = datetime(2015, 1, 1)
+        WideDevice.bulk_ingest([
+            (self.device, start, { "ch_0": 1.0, "ch_1": 2.0 }),
+            (self.device, start + timedelta(seconds=30), { "ch_1": 4.0 }),
+            (self.device, start + timedelta(seconds=90), { "ch_1": 6.0 }),
+        ])
+        result = self.device.aggregate("ch_1", start,
+                                       start + timedelta(minutes=5), 60)
+        eq_(result.buckets.tolist(), [start, start + timedelta(minutes=1)])
+        eq_(result.values["mean"].tolist(), [3.0, 6.0])
+        eq_(result.values["count"].tolist(), [2, 1])
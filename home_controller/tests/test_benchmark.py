@@ -0,0 +1,30 @@
+"""Tests the update pipeline benchmark
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import random
+
+from nose.tools import *
+
+from home_controller.benchmark import make_devices, run_benchmark
+from home_controller.db import Session, session_factory
+
+def _periods(seed):
+    return [ d.period for d in make_devices(4, 0, random.Random(seed))
+             if hasattr(d, "period") ]
+
+def test_seed_is_reproducible():
+    eq_(_periods(0), _periods(0))
+    ok_(_periods(0) != _periods(1))
+
+def test_run_benchmark():
+    bind = session_factory.kw.get("bind")
+    # the in-memory DB shares one connection, so run on a single worker
+    results = run_benchmark(sensors=2, equipment=1, rate=20, duration=0.2,
+                            workers=1, db_path=":memory:")
+    eq_(results["errors"], 0)
+    ok_(results["completed"] > 0)
+    ok_(results["submitted"] >= results["completed"])
+    eq_(results["config"]["seed"], 0)
+    ok_(session_factory.kw.get("bind") is bind)
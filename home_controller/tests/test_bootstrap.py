@@ -0,0 +1,95 @@
+"""Tests loading the device inventory at startup
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from datetime import datetime
+
+from nose.tools import *
+
+from home_controller.bootstrap import Bootstrap
+from home_controller.db import latest_values
+from home_controller.tests import DatabaseTest
+from home_controller.sensors import RandomValuesSensor, SineWaveSensor, Sensor
+from home_controller.equipment import Equipment, BinaryEquipment
+
+class TestBootstrap(DatabaseTest):
+    def setup(self):
+        super().setup()
+        latest_values.clear()
+
+    def teardown(self):
+        latest_values.clear()
+        super().teardown()
+
+    def _add_devices(self, count):
+        for i in range(count):
+            sensor = RandomValuesSensor(sensor_name="boot {}".format(i))
+            self.session.add(sensor)
+            self.session.add(SineWaveSensor(sensor_name="wave {}".format(i)))
+            self.session.add(BinaryEquipment("state",
+                                             name="switch {}".format(i)))
+            self.session.flush()
+            sensor._persist_data(datetime.utcnow(), sensor.read(),
+                                 commit=False)
+            self.recorded = sensor.id
+        self.session.commit()
+
+    def _ids(self, devices):
+        return { d.id for d in devices }
+
+    def test_loads_all_devices_polymorphically(self):
+        self._add_devices(2)
+        devices = Bootstrap().run()
+        eq_(self._ids(devices[Sensor]),
+            { s.id for s in self.session.query(Sensor) })
+        eq_(self._ids(devices[Equipment]),
+            { e.id for e in self.session.query(Equipment) })
+        types = { type(d) for d in devices[Sensor] }
+        ok_({ RandomValuesSensor, SineWaveSensor } <= types)
+
+    def test_query_count_is_constant(self):
+        self._add_devices(1)
+        small = Bootstrap()
+        small.run()
+        self._add_devices(10)
+        large = Bootstrap()
+        large.run()
+        eq_(small.queries, large.queries)
+        eq_(large.queries, 4)
+
+    def test_skips_history_deferred_columns_and_executors(self):
+        self._add_devices(1)
+        self.session.expunge_all()
+        devices = Bootstrap().run(self.session)
+        for device in devices[Sensor] + devices[Equipment]:
+            state = vars(device)
+            ok_("attributes" not in state)
+            ok_("created_at" not in state)
+            ok_("data" not in state)
+            ok_("_execution_state" not in state)
+            ok_("name" in state)
+        ok_(devices[Sensor][0].created_at is not None)
+
+    def test_detached_devices_are_fully_loaded(self):
+        self._add_devices(1)
+        devices = Bootstrap().run()
+        for device in devices[Sensor] + devices[Equipment]:
+            state = vars(device)
+            ok_("data" not in state)
+            ok_("_execution_state" not in state)
+            ok_(device.created_at is not None)
+            device.attributes
+
+    def test_loads_latest_values(self):
+        self._add_devices(1)
+        devices = Bootstrap().run()
+        sensor, = [ s for s in devices[Sensor] if s.id == self.recorded ]
+        eq_(set(sensor.current_value), { "value_0", "value_1" })
+
+    def test_timings(self):
+        bootstrap = Bootstrap(load_latest=False)
+        bootstrap.run()
+        eq_(list(bootstrap.timings),
+            ["connect", "devices", "close", "total"])
+        ok_(bootstrap.timings["total"] >= bootstrap.timings["devices"])
@@ -0,0 +1,201 @@
+"""Tests shared data collection functionality
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import threading
+from concurrent.futures import TimeoutError
+from datetime import datetime, timedelta
+
+import numpy as np
+from nose.tools import *
+
+from home_controller.db import latest_values
+from home_controller.tests import DatabaseTest
+from home_controller.sensors import RandomValuesSensor, Sensor
+from home_controller.equipment import BinaryEquipment, Equipment
+from home_controller.tools import configure_pool, shutdown_pools
+
+class TestLatestValues(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.sensor = RandomValuesSensor(sensor_name="latest")
+        self.data = self.sensor.read()
+        self.sensor._update_data(self.data)
+        self.expected = { v.name: v.value for v in self.data }
+
+    def test_update_writes_registry(self):
+        latest = latest_values.get(self.sensor)
+        eq_(latest.values, self.expected)
+        eq_(latest.timestamp, self.sensor.last_update)
+
+    def test_queried_instance_has_current_value(self):
+        self.session.expunge_all()
+        sensor = self.session.query(Sensor).get(self.sensor.id)
+        ok_(sensor is not self.sensor)
+        eq_(sensor.current_value, self.expected)
+
+    def test_older_values_are_ignored(self):
+        latest_values.set(self.sensor, datetime(2000, 1, 1), [("value_0", -1)])
+        eq_(self.sensor.current_value, self.expected)
+
+    def test_snapshot(self):
+        snapshot = latest_values.snapshot("sensor_data")
+        eq_(snapshot[("sensor_data", self.sensor.id)].values, self.expected)
+        ok_(all(key[0] == "sensor_data" for key in snapshot))
+
+    def test_load(self):
+        older = self.sensor.last_update - timedelta(days=1)
+        self.sensor._persist_data(older, self.sensor.read())
+        latest_values.clear()
+        eq_(self.sensor.current_value, self.expected)
+
+        latest_values.load(self.session.connection(), Sensor)
+        eq_(self.sensor.current_value, self.expected)
+
+    def test_load_scalar_equipment(self):
+        equip = BinaryEquipment("state", "heater")
+        equip._update_data(equip.update_state(1))
+        latest_values.clear()
+        latest_values.load(self.session.connection(), Equipment)
+        eq_(equip.current_state, 1.0)
+
+class TestRecentValues(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.sensor = RandomValuesSensor(sensor_name="recent")
+
+    def test_disabled_by_default(self):
+        self.sensor._update_data(self.sensor.read())
+        eq_(self.sensor.recent("value_0"), None)
+
+    def test_update_fills_buffers(self):
+        self.sensor.recent_capacity = 3
+        readings = []
+        for _ in range(4):
+            data = self.sensor.read()
+            readings.append(data[1].value)
+            self.sensor._update_data(data)
+        buffer = self.sensor.recent("value_1")
+        eq_(len(buffer), 3)
+        eq_(list(buffer.window()[1]), readings[1:])
+
+class TestReplacedWorker(DatabaseTest):
+    def setup(self):
+        super().setup()
+        configure_pool("default", 1)
+        self.release = threading.Event()
+
+    def teardown(self):
+        self.release.set()
+        shutdown_pools()
+        super().teardown()
+
+    def test_sensors_persist_after_timeout(self):
+        good = RandomValuesSensor(sensor_name="good")
+        hung = RandomValuesSensor(sensor_name="hung")
+        good.update().result(1)
+        hung.update().result(1)
+
+        hung.read_timeout = 0.05
+        hung.read = lambda *args, **kwargs: self.release.wait()
+        assert_raises(TimeoutError, hung.update().result, 1)
+        good.update().result(1)
+        eq_(len(list(good.history())), 2)
+        eq_(self.session.query(Sensor.last_update).
+            filter_by(id=good.id).scalar(), good.last_update)
+
+class TestBulkIngest(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.sensors = [ RandomValuesSensor(sensor_name="bulk_{}".format(i))
+                         for i in range(3) ]
+        self.session.add_all(self.sensors)
+        self.session.commit()
+        self.start = datetime(2015, 3, 1)
+
+    def _readings(self, count):
+        for i in range(count):
+            sensor = self.sensors[i % 3]
+            yield (sensor if i % 2 else sensor.id,
+                   self.start + timedelta(seconds=i),
+                   { "a": float(i), "b": -float(i) })
+
+    def test_records_are_linked(self):
+        stats = Sensor.bulk_ingest(self._readings(30), chunk_size=7)
+        eq_(stats["records"], 30)
+        eq_(stats["values"], 60)
+        eq_(stats["devices"], 3)
+        ok_(stats["records_per_second"] > 0)
+
+        for n, sensor in enumerate(self.sensors):
+            history = list(sensor.history())
+            eq_(len(history), 10)
+            for timestamp, values in history:
+                i = int((timestamp - self.start).total_seconds())
+                eq_(i % 3, n)
+                eq_(values, { "a": float(i), "b": -float(i) })
+
+    def test_updates_latest_values(self):
+        Sensor.bulk_ingest(self._readings(6))
+        sensor = self.sensors[2]
+        eq_(sensor.current_value, { "a": 5.0, "b": -5.0 })
+        self.session.refresh(sensor)
+        eq_(sensor.last_update, self.start + timedelta(seconds=5))
+
+    def test_epoch_timestamps(self):
+        epoch = (self.start - datetime(1970, 1, 1)).total_seconds()
+        Sensor.bulk_ingest([ (self.sensors[0], epoch, { "a": 1.0 }) ])
+        eq_(list(self.sensors[0].history()), [ (self.start, { "a": 1.0 }) ])
+
+class TestAggregate(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.sensor = RandomValuesSensor(sensor_name="aggregated")
+        self.session.add(self.sensor)
+        self.session.commit()
+        self.start = datetime(2015, 3, 1)
+        # three hours of readings, one every 20 minutes
+        Sensor.bulk_ingest([ (self.sensor,
+                              self.start + timedelta(minutes=20 * i),
+                              { "a": float(i), "b": 1.0 })
+                             for i in range(9) ])
+
+    def test_hourly_buckets(self):
+        result = self.sensor.aggregate("a", self.start,
+                                       self.start + timedelta(hours=3),
+                                       timedelta(hours=1))
+        eq_(result.buckets.tolist(),
+            [ self.start + timedelta(hours=h) for h in range(3) ])
+        eq_(result.values["mean"].tolist(), [1.0, 4.0, 7.0])
+        eq_(result.values["min"].tolist(), [0.0, 3.0, 6.0])
+        eq_(result.values["max"].tolist(), [2.0, 5.0, 8.0])
+        eq_(result.values["count"].tolist(), [3, 3, 3])
+
+    def test_range_and_fns(self):
+        result = self.sensor.aggregate("a", self.start + timedelta(minutes=30),
+                                       self.start + timedelta(hours=2),
+                                       3600, fns=["sum", "count"])
+        eq_(list(result.values), ["sum", "count"])
+        eq_(result.values["sum"].tolist(), [2.0, 12.0])
+        eq_(result.values["count"].tolist(), [1, 3])
+
+    def test_single_bucket(self):
+        result = self.sensor.aggregate("b", self.start,
+                                       self.start + timedelta(days=1))
+        eq_(result.buckets.tolist(), [self.start])
+        eq_(result.values["count"].tolist(), [9])
+
+    def test_empty(self):
+        result = self.sensor.aggregate("missing", self.start,
+                                       self.start + timedelta(days=1), 60)
+        eq_(len(result.buckets), 0)
+        eq_(len(result.values["mean"]), 0)
+
+    @raises(ValueError)
+    def test_unknown_aggregate(self):
+        self.sensor.aggregate("a", self.start, self.start, fns=["median"])
+
+    @raises(ValueError)
+    def test_fractional_bucket(self):
+        self.sensor.aggregate("a", self.start, self.start, 0.5)
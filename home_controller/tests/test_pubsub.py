@@ -0,0 +1,84 @@
+"""Tests the change stream hub
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from datetime import datetime
+
+from nose.tools import *
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from home_controller.tests import DatabaseTest
+from home_controller.pubsub import ChangeHub, Change, LATEST_ONLY
+from home_controller.sensors import RandomValuesSensor, Sensor
+from home_controller.equipment import Equipment
+
+def _change(device_id, value, table="sensor_data"):
+    return Change((table, device_id), "Sensor", str(device_id),
+                  datetime.utcnow(), {"value": value})
+
+class TestChangeHub(object):
+    def setup(self):
+        self.hub = ChangeHub(batch_interval=0.01, io_loop=IOLoop.current())
+        self.batches = []
+
+    def _run(self, *changes):
+        async def publish():
+            for change, device_type in changes:
+                self.hub.publish(change, device_type)
+            await gen.sleep(0.05)
+        IOLoop.current().run_sync(publish)
+
+    def test_changes_are_batched(self):
+        self.hub.subscribe(self.batches.append)
+        self._run(*[ (_change(1, i), Sensor) for i in range(5) ])
+        eq_(len(self.batches), 1)
+        eq_([ c.values["value"] for c in self.batches[0] ], list(range(5)))
+
+    def test_drop_oldest(self):
+        sub = self.hub.subscribe(self.batches.append, max_queue=2)
+        self._run(*[ (_change(1, i), Sensor) for i in range(5) ])
+        eq_([ c.values["value"] for c in self.batches[0] ], [3, 4])
+        eq_(sub.dropped, 3)
+
+    def test_latest_only(self):
+        self.hub.subscribe(self.batches.append, policy=LATEST_ONLY)
+        self._run((_change(1, 0), Sensor), (_change(2, 0), Sensor),
+                  (_change(1, 1), Sensor))
+        eq_([ (c.key[1], c.values["value"]) for c in self.batches[0] ],
+            [(2, 0), (1, 1)])
+
+    def test_filters(self):
+        by_device, by_type = [], []
+        self.hub.subscribe(by_device.append, devices=[("sensor_data", 2)])
+        self.hub.subscribe(by_type.append, types=[Equipment])
+        self._run((_change(1, 0), Sensor), (_change(2, 0), Sensor),
+                  (_change(1, 0, "equipment_data"), Equipment))
+        eq_([ c.key for c in by_device[0] ], [("sensor_data", 2)])
+        eq_([ c.key for c in by_type[0] ], [("equipment_data", 1)])
+
+    def test_unsubscribe(self):
+        sub = self.hub.subscribe(self.batches.append)
+        sub.cancel()
+        self._run((_change(1, 0), Sensor))
+        eq_(self.batches, [])
+        eq_(self.hub.stats()["subscriptions"], 0)
+
+class TestChangeHubUpdates(DatabaseTest):
+    def test_sensor_updates_are_published(self):
+        sensor = RandomValuesSensor(sensor_name="live")
+        hub = ChangeHub(batch_interval=0.01)
+        batches = []
+
+        async def run():
+            hub.attach()
+            hub.subscribe(batches.append, types=[Sensor])
+            await sensor.update_async()
+            await gen.sleep(0.05)
+        try:
+            IOLoop.current().run_sync(run)
+        finally:
+            hub.detach()
+        eq_(len(batches), 1)
+        eq_(batches[0][0].values, sensor.current_value)
@@ -0,0 +1,109 @@
+"""Tests running devices on simulated time
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from datetime import datetime, timedelta
+from time import perf_counter
+
+from nose.tools import *
+
+from home_controller.tests import DatabaseTest
+from home_controller.control import ControlEngine, Thermostat
+from home_controller.equipment import BinaryEquipment
+from home_controller.sensors import RandomValuesSensor, Sensor
+from home_controller.simulation import Simulation
+from home_controller.tools import ThreadedExecutor, get_clock, VirtualClock
+
+class House(object):
+    """Heats up while the furnace is on and cools down while it's off
+    """
+    def __init__(self, furnace, temperature=18.0):
+        self.furnace = furnace
+        self.temperature = temperature
+
+    def step(self):
+        self.temperature += 0.4 if self.furnace.current_state else -0.2
+
+    def read(self, *args, **kwargs):
+        return [ Sensor.value_type(self.temperature, "temperature") ]
+
+class TestSimulation(DatabaseTest):
+    def setup(self):
+        super().setup()
+        self.start = datetime(2015, 1, 1)
+        self.engine = ControlEngine()
+        self.engine.attach()
+
+    def teardown(self):
+        self.engine.detach()
+        super().teardown()
+
+    def _house(self, name):
+        thermometer = RandomValuesSensor(sensor_name="{} thermometer".format(
+                                         name))
+        furnace = BinaryEquipment("state", "{} furnace".format(name))
+        furnace.min_on_time = furnace.min_off_time = 600
+        house = House(furnace)
+        thermometer.read = house.read
+        self.engine.add(Thermostat(thermometer, "temperature", furnace,
+                                   setpoint=20))
+        return house, thermometer, furnace
+
+    def _simulate_day(self, name):
+        house, thermometer, furnace = self._house(name)
+        with Simulation(self.start) as simulation:
+            simulation.add(house, 300, task=house.step)
+            simulation.add(thermometer, 300)
+            simulation.run(timedelta(days=1).total_seconds())
+        return thermometer, furnace
+
+    def test_day_runs_in_seconds(self):
+        started = perf_counter()
+        thermometer, furnace = self._simulate_day("simulated")
+        ok_(perf_counter() - started < 30)
+        eq_(thermometer.data.count(), 289)
+        history = list(furnace.history())
+        ok_(len(history) > 10, "The furnace should cycle")
+        ok_(all(b[0] - a[0] >= timedelta(seconds=600)
+                for a, b in zip(history, history[1:])),
+            "Minimum on/off times should hold in simulated time")
+        temperatures = [ v["temperature"] for _, v in thermometer.history() ]
+        ok_(all(17.5 < t < 21.5 for t in temperatures))
+        eq_(thermometer.last_update, self.start + timedelta(days=1))
+
+    def test_runs_are_deterministic(self):
+        first = self._simulate_day("first")
+        second = self._simulate_day("second")
+        eq_(list(first[1].history()), list(second[1].history()))
+        eq_(list(first[0].history()), list(second[0].history()))
+
+    def test_clock_and_pools_are_restored(self):
+        clock = get_clock()
+        with Simulation(self.start):
+            ok_(isinstance(get_clock(), VirtualClock))
+            eq_(ThreadedExecutor.executor_pool, "inline")
+        ok_(get_clock() is clock)
+        eq_(ThreadedExecutor.executor_pool, "default")
+
+    def test_replay(self):
+        recorded = RandomValuesSensor(sensor_name="recorded")
+        self.session.add(recorded)
+        self.session.commit()
+        times = [ self.start + timedelta(minutes=i) for i in range(60) ]
+        Sensor.bulk_ingest((recorded, t, { "temperature": 19.0 + i / 30 })
+                           for i, t in enumerate(times))
+
+        house, thermometer, furnace = self._house("replayed")
+        with Simulation(self.start) as simulation:
+            stats = simulation.replay({ recorded: thermometer })
+        eq_(stats["records"], 60)
+        eq_(stats["simulated_seconds"], 3540.0)
+        eq_([ t for t, _ in thermometer.history() ], times)
+        # on below 19.5, off above 20.5
+        eq_([ (t, v["state"]) for t, v in furnace.history() ],
+            [ (self.start, 1.0), (self.start + timedelta(minutes=46), 0.0) ])
+
+    @raises(RuntimeError)
+    def test_replay_requires_running_simulation(self):
+        Simulation(self.start).replay({})
@@ -0,0 +1,66 @@
+"""Tests the wall & virtual clocks
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from datetime import datetime, timedelta
+
+from nose.tools import *
+
+from home_controller.tools import (
+    Clock, VirtualClock, get_clock, set_clock, using_clock
+)
+
+class TestVirtualClock(object):
+    def setup(self):
+        self.start = datetime(2015, 1, 1)
+        self.clock = VirtualClock(self.start)
+
+    def test_time_only_moves_when_advanced(self):
+        eq_(self.clock.utcnow(), self.start)
+        self.clock.advance(90)
+        eq_(self.clock.utcnow(), self.start + timedelta(seconds=90))
+        eq_(self.clock.monotonic(), self.clock.time())
+
+    def test_timers_run_in_order(self):
+        calls = []
+        self.clock.call_later(20, calls.append, "b")
+        self.clock.call_later(10, calls.append, "a")
+        self.clock.call_later(10, lambda: calls.append(self.clock.utcnow()))
+        self.clock.advance(15)
+        eq_(calls, ["a", self.start + timedelta(seconds=10)])
+        eq_(self.clock.pending, 1)
+        self.clock.run_until(self.start + timedelta(seconds=20))
+        eq_(calls[-1], "b")
+
+    def test_timers_set_by_timers(self):
+        calls = []
+
+        def tick():
+            calls.append(self.clock.time())
+            self.clock.call_later(1, tick)
+        self.clock.call_later(1, tick)
+        self.clock.advance(5)
+        eq_(len(calls), 5)
+        eq_(self.clock.pending, 1)
+
+    def test_cancelled_timer(self):
+        calls = []
+        timer = self.clock.call_later(1, calls.append, 1)
+        timer.cancel()
+        self.clock.advance(2)
+        eq_(calls, [])
+        eq_(self.clock.next_timer(), None)
+
+    def test_using_clock(self):
+        with using_clock(self.clock):
+            ok_(get_clock() is self.clock)
+        ok_(isinstance(get_clock(), Clock))
+        ok_(not isinstance(get_clock(), VirtualClock))
+
+    def test_set_clock_returns_previous(self):
+        previous = set_clock(self.clock)
+        try:
+            ok_(set_clock(self.clock) is self.clock)
+        finally:
+            set_clock(previous)
@@ -0,0 +1,316 @@
+"""Tests the shared executor pools
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import CancelledError, TimeoutError
+from time import sleep, monotonic
+
+from nose.tools import *
+from tornado.ioloop import IOLoop
+
+from home_controller.tools import (
+    ThreadedExecutor, ExecutorPool, InlinePool, INLINE, CircuitOpenError,
+    configure_pool, get_pool, configure_process_pool, shutdown_pools,
+    VirtualClock, using_clock
+)
+
+class Device(ThreadedExecutor):
+    executor_pool = "test"
+
+class TestExecutorPool(object):
+    def setup(self):
+        configure_pool("test", 2)
+
+    def teardown(self):
+        shutdown_pools()
+
+    def test_thread_count_is_flat(self):
+        devices = [ Device() for _ in range(50) ]
+        threads = set()
+        futures = [ d.execute(threading.get_ident, threads.add)
+                    for d in devices ]
+        for f in futures:
+            f.result()
+        ok_(len(threads) <= 2, "Expected at most 2 worker threads, got "
+            "{}".format(len(threads)))
+
+    def test_device_calls_are_serialized(self):
+        device = Device()
+        active = []
+        overlaps = []
+
+        def work():
+            active.append(1)
+            if len(active) > 1:
+                overlaps.append(1)
+            sleep(0.005)
+            active.pop()
+
+        futures = [ device.execute(work, lambda _: None) for _ in range(10) ]
+        for f in futures:
+            f.result()
+        eq_(overlaps, [])
+
+    def test_device_is_pinned_to_one_executor(self):
+        device = Device()
+        ok_(device.executor is device.executor)
+
+    def test_shutdown_drains_queued_work(self):
+        device = Device()
+        results = []
+        for i in range(5):
+            device.execute(lambda i=i: (sleep(0.001), i)[1], results.append)
+        shutdown_pools(wait=True)
+        eq_(sorted(results), list(range(5)))
+
+    def test_pool_recreated_after_shutdown(self):
+        pool = get_pool("test")
+        shutdown_pools()
+        ok_(get_pool("test") is not pool)
+
+    @raises(RuntimeError)
+    def test_configure_running_pool(self):
+        get_pool("test")
+        configure_pool("test", 3)
+
+    @raises(ValueError)
+    def test_invalid_worker_count(self):
+        ExecutorPool("bad", 0)
+
+class TestExecuteAsync(object):
+    def teardown(self):
+        shutdown_pools()
+
+    def _run(self, coro_fxn):
+        return IOLoop.current().run_sync(coro_fxn)
+
+    def test_callback_runs_on_executor_thread(self):
+        device = Device()
+        callback_threads = []
+        cb = lambda _: callback_threads.append(threading.get_ident())
+
+        result = self._run(lambda: device.execute_async(lambda: 5, cb))
+        eq_(result, 5)
+        lane_thread = device.execute(threading.get_ident, cb).result(1)
+        eq_(callback_threads, [lane_thread, lane_thread])
+
+    def test_coroutine_runs_without_thread_hop(self):
+        device = Device()
+        callback_threads = []
+        cb = lambda _: callback_threads.append(threading.get_ident())
+
+        async def read():
+            return threading.get_ident()
+
+        result = self._run(lambda: device.execute_async(read, cb))
+        eq_(result, threading.get_ident())
+        lane_thread = device.execute(threading.get_ident, cb).result(1)
+        eq_(callback_threads, [lane_thread, lane_thread])
+
+    def test_coroutine_callback_failures_count(self):
+        device = Device()
+
+        async def read():
+            return 1
+
+        def fail(_):
+            raise IOError("write failed")
+
+        assert_raises(IOError, self._run,
+                      lambda: device.execute_async(read, fail))
+        eq_(device.execution_stats()["errors"], 1)
+
+    @raises(TypeError)
+    def test_execute_rejects_coroutines(self):
+        async def read():
+            pass
+        Device().execute(read, lambda _: None)
+
+class Flaky(Device):
+    read_timeout = 0.05
+    breaker_threshold = 2
+    breaker_reset = 0.05
+
+class TestDeadlines(object):
+    def setup(self):
+        configure_pool("test", 1)
+        self.release = threading.Event()
+
+    def teardown(self):
+        self.release.set()
+        shutdown_pools()
+
+    def test_hung_call_times_out(self):
+        device = Flaky()
+        called = []
+        future = device.execute(self.release.wait, called.append)
+        assert_raises(TimeoutError, future.result, 1)
+        eq_(device.execution_stats()["timeouts"], 1)
+        self.release.set()
+        sleep(0.01)
+        eq_(called, [], "Callback shouldn't run for a timed out call")
+
+    def test_lane_recovers_after_timeout(self):
+        device = Flaky()
+        other = Device()
+        device.execute(self.release.wait, lambda _: None)
+        eq_(other.execute(lambda: 3, lambda _: None).result(1), 3)
+        eq_(get_pool("test").stats()["replaced_workers"], 1)
+
+    def test_oldest_pending_call_is_dropped(self):
+        device = Device()
+        device.max_pending = 1
+        device.execute(self.release.wait, lambda _: None)
+        sleep(0.01)
+        stale = device.execute(lambda: 1, lambda _: None)
+        latest = device.execute(lambda: 2, lambda _: None)
+        self.release.set()
+        eq_(latest.result(1), 2)
+        ok_(stale.cancelled())
+        eq_(device.execution_stats()["dropped"], 1)
+
+    def test_stale_call_is_cancelled(self):
+        device = Device()
+        device.update_timeout = 0.01
+        device.execute(self.release.wait, lambda _: None)
+        stale = device.execute(lambda: 1, lambda _: None)
+        sleep(0.03)
+        self.release.set()
+        assert_raises(CancelledError, stale.result, 1)
+        eq_(device.execution_stats()["stale"], 1)
+
+    def test_shutdown_gives_up_on_hung_call(self):
+        device = Device()
+        device.execute(self.release.wait, lambda _: None)
+        started = monotonic()
+        shutdown_pools(timeout=0.1)
+        ok_(monotonic() - started < 1, "Shutdown should give up waiting")
+
+class TestCircuitBreaker(object):
+    def setup(self):
+        configure_pool("test", 1)
+        self.device = Flaky()
+
+    def teardown(self):
+        shutdown_pools()
+
+    def _fail(self, *args):
+        raise IOError("bus error")
+
+    def _trip(self):
+        for _ in range(2):
+            future = self.device.execute(self._fail, lambda _: None)
+            assert_raises(IOError, future.result, 1)
+
+    def test_breaker_opens(self):
+        self._trip()
+        eq_(self.device.execution_stats()["breaker"], "open")
+        assert_raises(CircuitOpenError, self.device.execute, lambda: 1,
+                      lambda _: None)
+        eq_(self.device.execution_stats()["rejected"], 1)
+
+    def test_callback_failures_count(self):
+        for _ in range(2):
+            future = self.device.execute(lambda: 1, self._fail)
+            assert_raises(IOError, future.result, 1)
+        stats = self.device.execution_stats()
+        eq_(stats["breaker"], "open")
+        eq_(stats["errors"], 2)
+
+    def test_breaker_closes_after_successful_trial(self):
+        self._trip()
+        sleep(0.06)
+        eq_(self.device.execute(lambda: 1, lambda _: None).result(1), 1)
+        eq_(self.device.execution_stats()["breaker"], "closed")
+
+    def test_failed_trial_backs_off(self):
+        self._trip()
+        sleep(0.06)
+        future = self.device.execute(self._fail, lambda _: None)
+        assert_raises(IOError, future.result, 1)
+        stats = self.device.execution_stats()
+        eq_(stats["breaker"], "open")
+        ok_(stats["open_for"] > 0.05, "Reset time should double")
+
+class InlineDevice(Flaky):
+    executor_pool = INLINE
+
+class TestInlinePool(object):
+    def setup(self):
+        self.device = InlineDevice()
+
+    def teardown(self):
+        shutdown_pools()
+
+    def test_calls_run_on_the_calling_thread(self):
+        results = []
+        future = self.device.execute(threading.get_ident, results.append)
+        ok_(future.done())
+        eq_(results, [threading.get_ident()])
+        ok_(isinstance(get_pool(INLINE), InlinePool))
+
+    def test_calls_from_callbacks_run_in_order(self):
+        order = []
+
+        def first(_):
+            order.append(1)
+            self.device.execute(lambda: 3, order.append)
+            order.append(2)
+        self.device.execute(lambda: None, first)
+        eq_(order, [1, 2, 3])
+
+    def test_breaker_runs_on_the_clock(self):
+        clock = VirtualClock()
+        with using_clock(clock):
+            for _ in range(2):
+                self.device.execute(self._fail, lambda _: None)
+            eq_(self.device.execution_stats()["breaker"], "open")
+            clock.advance(0.06)
+            eq_(self.device.execute(lambda: 1, lambda _: None).result(), 1)
+        eq_(self.device.execution_stats()["breaker"], "closed")
+
+    def _fail(self):
+        raise IOError("bus error")
+
+Value = namedtuple("Value", ["value", "name"])
+
+class ProcessDevice(Device):
+    process_pool = "test"
+    value_type = Value
+
+    def read(self, scale):
+        return [ Value(os.getpid() * scale, "pid") ]
+
+    def process_config(self):
+        return { "offset": 0.5 }
+
+    @staticmethod
+    def process_read(config, scale):
+        return { "pid": os.getpid() * scale, "offset": config["offset"] }
+
+class TestProcessPool(object):
+    def setup(self):
+        configure_pool("test", 1)
+        configure_process_pool("test", 1)
+
+    def teardown(self):
+        shutdown_pools()
+
+    def test_read_runs_in_another_process(self):
+        device = ProcessDevice()
+        results = []
+        values = device.execute(device.read, results.append, 2).result(30)
+        eq_(results, [values])
+        eq_([ v.name for v in values ], ["pid", "offset"])
+        ok_(values[0].value != os.getpid() * 2)
+        eq_(values[1].value, 0.5)
+        ok_(all(isinstance(v.value, float) for v in values))
+
+    @raises(TypeError)
+    def test_missing_process_function(self):
+        device = ProcessDevice()
+        device.execute(device.execution_stats, lambda _: None)
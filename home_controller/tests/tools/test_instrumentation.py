@@ -0,0 +1,81 @@
+"""Tests the timing histograms & metrics registry
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from nose.tools import *
+
+from home_controller.tools import (
+    ThreadedExecutor, Histogram, Metrics, metrics, configure_pool,
+    shutdown_pools
+)
+
+class Device(ThreadedExecutor):
+    executor_pool = "test"
+    name = "instrumented"
+
+class TestHistogram(object):
+    def test_percentiles(self):
+        h = Histogram(buckets=(1, 2, 5, 10))
+        for value in (0.5, 1.5, 1.5, 4, 20):
+            h.observe(value)
+        eq_(h.count, 5)
+        eq_(h.percentile(50), 2)
+        eq_(h.percentile(100), 20)
+        eq_(h.max, 20)
+        assert_almost_equal(h.mean, 27.5 / 5)
+
+    def test_empty(self):
+        eq_(Histogram().percentile(50), None)
+
+class TestMetrics(object):
+    def setup(self):
+        self.metrics = Metrics(buckets=(0.1, 1))
+
+    def test_summary_by_label(self):
+        self.metrics.observe("run", 0.05, device="a", device_class="Sensor")
+        self.metrics.observe("run", 0.5, device="b", device_class="Sensor")
+        self.metrics.observe("run", 0.5, device="c", device_class="Switch")
+        summary = self.metrics.summary("run", by="device_class")
+        eq_(summary["Sensor"]["count"], 2)
+        eq_(summary["Switch"]["count"], 1)
+        eq_(self.metrics.summary("run")[None]["count"], 3)
+
+    def test_disabled(self):
+        self.metrics.enabled = False
+        self.metrics.observe("run", 0.05)
+        self.metrics.increment("errors")
+        eq_(self.metrics.summary("run"), {})
+        eq_(self.metrics.counter("errors"), 0)
+
+    def test_prometheus(self):
+        self.metrics.observe("run", 0.05, device="a")
+        self.metrics.increment("errors", device="a")
+        text = self.metrics.to_prometheus()
+        ok_("# TYPE run histogram" in text)
+        ok_('run_bucket{device="a",le="0.1"} 1' in text)
+        ok_('run_bucket{device="a",le="+Inf"} 1' in text)
+        ok_('run_count{device="a"} 1' in text)
+        ok_('errors{device="a"} 1' in text)
+
+class TestExecutorMetrics(object):
+    def setup(self):
+        configure_pool("test", 1)
+        metrics.reset()
+
+    def teardown(self):
+        shutdown_pools()
+
+    def test_execute_is_timed(self):
+        Device().execute(lambda: 1, lambda v: None).result()
+        for name in ("executor_queue_wait_seconds", "executor_run_seconds",
+                     "executor_callback_seconds"):
+            eq_(metrics.summary(name, by="device")["instrumented"]["count"], 1)
+
+    def test_errors_are_counted(self):
+        def fail():
+            raise ValueError("broken")
+        future = Device().execute(fail, lambda v: None)
+        assert_raises(ValueError, future.result)
+        eq_(metrics.counter("executor_errors_total", device="instrumented",
+                            device_class="Device"), 1)
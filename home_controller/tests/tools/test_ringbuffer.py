@@ -0,0 +1,59 @@
+"""Tests the recent readings ring buffer
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+from nose.tools import *
+
+from home_controller.tools import RingBuffer
+
+class TestRingBuffer(object):
+    def setup(self):
+        self.buffer = RingBuffer(5)
+
+    def _fill(self, values, start=0):
+        for i, value in enumerate(values):
+            self.buffer.append(start + i, value)
+
+    def test_wraps_at_capacity(self):
+        self._fill(range(8))
+        eq_(len(self.buffer), 5)
+        times, values = self.buffer.window()
+        eq_(list(times), [3, 4, 5, 6, 7])
+        eq_(list(values), [3, 4, 5, 6, 7])
+        eq_(self.buffer.latest, (7, 7))
+
+    def test_duration_window(self):
+        self._fill([1, 2, 3, 4, 5])
+        eq_(list(self.buffer.window(duration=2)[1]), [3, 4, 5])
+        eq_(self.buffer.mean(duration=2), 4.0)
+
+    def test_stats(self):
+        self._fill([4, 1, 9, 2])
+        eq_(self.buffer.mean(), 4.0)
+        eq_(self.buffer.min(), 1.0)
+        eq_(self.buffer.max(), 9.0)
+
+    def test_slope(self):
+        self._fill([1, 3, 5, 7])
+        assert_almost_equal(self.buffer.slope(), 2.0)
+        self.buffer.clear()
+        self._fill([1])
+        eq_(self.buffer.slope(), None)
+
+    def test_ewma_matches_recursion(self):
+        values = [2.0, 4.0, 1.0, 7.0]
+        self._fill(values)
+        expected = values[0]
+        for value in values[1:]:
+            expected = 0.3 * value + 0.7 * expected
+        assert_almost_equal(self.buffer.ewma(0.3), expected)
+
+    def test_empty(self):
+        eq_(self.buffer.mean(), None)
+        eq_(self.buffer.ewma(0.5), None)
+        eq_(self.buffer.latest, None)
+
+    @raises(ValueError)
+    def test_invalid_capacity(self):
+        RingBuffer(0)
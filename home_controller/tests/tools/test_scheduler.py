@@ -0,0 +1,120 @@
+"""Tests the polling scheduler
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import asyncio
+from concurrent.futures import Future
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from nose.tools import *
+
+from home_controller.tools import PollingScheduler
+
+class Device(object):
+    def __init__(self, name, duration=0.0, log=None):
+        self.name = name
+        self.duration = duration
+        self.calls = 0
+        self.active = 0
+        self.max_active = 0
+        self.log = log
+
+    def update(self):
+        """Starts an update, returning its future like a threaded device
+        """
+        self.calls += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        if self.log is not None:
+            self.log.append(self.name)
+        future = asyncio.Future()
+        IOLoop.current().call_later(self.duration, self._finish, future)
+        return future
+
+    def _finish(self, future):
+        self.active -= 1
+        future.set_result(None)
+
+class CancelledDevice(Device):
+    def update(self):
+        """Returns an update future cancelled by the executor, e.g. as stale
+        """
+        self.calls += 1
+        future = Future()
+        future.cancel()
+        return future
+
+class TestPollingScheduler(object):
+    def setup(self):
+        self.loop = IOLoop.current()
+        self.scheduler = PollingScheduler(seed=1)
+
+    def teardown(self):
+        self.scheduler.stop()
+
+    def _run_for(self, seconds):
+        self.scheduler.start()
+        self.loop.run_sync(lambda: gen.sleep(seconds))
+
+    def test_polls_at_interval(self):
+        device = Device("fast")
+        self.scheduler.add(device, 0.05, phase=0)
+        self._run_for(0.22)
+        ok_(4 <= device.calls <= 5, "Expected 4-5 polls, got {}".format(
+            device.calls))
+
+    def test_slow_updates_are_not_stacked(self):
+        device = Device("slow", duration=0.12)
+        self.scheduler.add(device, 0.05, phase=0)
+        self._run_for(0.3)
+        eq_(device.max_active, 1)
+        stats = self.scheduler.stats()["devices"]["slow"]
+        ok_(stats["missed"] > 0)
+        eq_(stats["runs"], device.calls)
+
+    def test_priority_order(self):
+        log = []
+        for name, priority in (("low", 0), ("high", 5), ("mid", 1)):
+            self.scheduler.add(Device(name, log=log), 1.0, priority=priority,
+                               phase=0)
+        self._run_for(0.02)
+        eq_(log, ["high", "mid", "low"])
+
+    def test_phases_are_spread(self):
+        entries = [ self.scheduler.add(Device(str(i)), 1.0)
+                    for i in range(50) ]
+        phases = [ e.phase for e in entries ]
+        ok_(all(0 <= p < 1.0 for p in phases))
+        ok_(len(set(phases)) == 50)
+
+    def test_remove(self):
+        device = Device("removed")
+        self.scheduler.add(device, 0.02, phase=0)
+        self.scheduler.remove(device)
+        self._run_for(0.05)
+        eq_(device.calls, 0)
+        eq_(len(self.scheduler), 0)
+
+    def test_cancelled_updates_are_polled_again(self):
+        device = CancelledDevice("cancelled")
+        self.scheduler.add(device, 0.05, phase=0)
+        self._run_for(0.12)
+        ok_(device.calls >= 2, "Expected repeated polls, got {}".format(
+            device.calls))
+        stats = self.scheduler.stats()["devices"]["cancelled"]
+        eq_(stats["cancelled"], device.calls)
+        eq_((stats["errors"], stats["pending"]), (0, False))
+
+    def test_many_devices(self):
+        devices = [ Device(str(i)) for i in range(1000) ]
+        for device in devices:
+            self.scheduler.add(device, 0.1)
+        self._run_for(0.4)
+        ok_(all(d.calls >= 3 for d in devices))
+        ok_(self.scheduler.stats()["max_lateness"] < 0.1)
+
+    @raises(ValueError)
+    def test_invalid_interval(self):
+        self.scheduler.add(Device("bad"), 0)
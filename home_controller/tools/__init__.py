@@ -1 +1,9 @@
-from .execution import ThreadedExecutor
+from .execution import (
+    ThreadedExecutor, ExecutorPool, InlinePool, INLINE, CircuitOpenError,
+    configure_pool, get_pool, configure_process_pool, get_process_pool,
+    shutdown_pools, EXIT_TIMEOUT
+)
+from .clock import Clock, VirtualClock, get_clock, set_clock, using_clock
+from .ringbuffer import RingBuffer
+from .scheduler import PollingScheduler, ScheduledTask
+from .instrumentation import Histogram, Metrics, metrics
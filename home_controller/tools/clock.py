@@ -0,0 +1,149 @@
+"""Pluggable clock, so that devices can be run on simulated time
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import heapq
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import count
+
+EPOCH = datetime(1970, 1, 1)
+
+class Clock(object):
+    """The wall clock. Code that stamps readings or waits on time should go
+    through `get_clock()` rather than `time` & `datetime`, so that it can be
+    run on a `VirtualClock`.
+    """
+    def time(self):
+        """Seconds since the epoch
+        """
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def utcnow(self):
+        return datetime.utcnow()
+
+    def call_later(self, delay, fxn, *args):
+        """Runs `fxn(*args)` after `delay` seconds, on a timer thread.
+        Returns a handle with a `cancel` method.
+        """
+        timer = threading.Timer(delay, fxn, args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+class _VirtualTimer(object):
+    __slots__ = ("when", "fxn", "args", "cancelled")
+
+    def __init__(self, when, fxn, args):
+        self.when = when
+        self.fxn = fxn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class VirtualClock(Clock):
+    """A clock that only moves when told to. Timers set with `call_later` are
+    run, in order, by `advance` & `run_until` as simulated time passes them,
+    on the thread advancing the clock.
+
+    Usage::
+
+        clock = VirtualClock(datetime(2015, 1, 1))
+        with using_clock(clock):
+            equipment.set(1.0)
+            clock.advance(3600)
+    """
+    def __init__(self, start=None):
+        """
+        :param start: Starting time as a naive UTC datetime. Defaults to the
+                      current time.
+        """
+        if start is None:
+            start = datetime.utcnow()
+        self._now = (start - EPOCH).total_seconds()
+        self._timers = []
+        self._sequence = count()
+        self._lock = threading.RLock()
+
+    def time(self):
+        return self._now
+
+    def monotonic(self):
+        return self._now
+
+    def utcnow(self):
+        return EPOCH + timedelta(seconds=self._now)
+
+    @property
+    def pending(self):
+        """Number of timers waiting to run
+        """
+        with self._lock:
+            return sum(1 for _, _, t in self._timers if not t.cancelled)
+
+    def call_later(self, delay, fxn, *args):
+        timer = _VirtualTimer(self._now + max(delay, 0.0), fxn, args)
+        with self._lock:
+            heapq.heappush(self._timers, (timer.when, next(self._sequence),
+                                          timer))
+        return timer
+
+    def next_timer(self):
+        """Returns the time of the next timer due, or None
+        """
+        with self._lock:
+            while self._timers and self._timers[0][2].cancelled:
+                heapq.heappop(self._timers)
+            return self._timers[0][0] if self._timers else None
+
+    def run_until(self, when):
+        """Moves the clock forward to `when` (seconds since the epoch or a
+        datetime), running every timer due on the way. Timers set by those
+        timers are run too if they're due by `when`.
+        """
+        if isinstance(when, datetime):
+            when = (when - EPOCH).total_seconds()
+        while True:
+            with self._lock:
+                due = self.next_timer()
+                if due is None or due > when:
+                    self._now = max(self._now, when)
+                    return
+                _, _, timer = heapq.heappop(self._timers)
+                self._now = max(self._now, timer.when)
+            timer.fxn(*timer.args)
+
+    def advance(self, seconds):
+        self.run_until(self._now + seconds)
+
+_clock = Clock()
+
+def get_clock():
+    """Returns the process-wide clock
+    """
+    return _clock
+
+def set_clock(clock):
+    """Replaces the process-wide clock. Returns the previous one.
+    """
+    global _clock
+    previous, _clock = _clock, clock
+    return previous
+
+@contextmanager
+def using_clock(clock):
+    """Context manager running its block on `clock`
+    """
+    previous = set_clock(clock)
+    try:
+        yield clock
+    finally:
+        set_clock(previous)
@@ -3,20 +3,735 @@
 
 # Ben Peters (bencpeters@gmail.com)
 
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import atexit
+import heapq
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError, ProcessPoolExecutor
+from functools import partial, wraps
+from inspect import iscoroutinefunction
+from itertools import count
+from time import perf_counter, monotonic
+from weakref import WeakKeyDictionary, ref
+
+import numpy as np
+
+from home_controller.log import logger
+from .clock import get_clock
+from .instrumentation import metrics, device_labels
+
+DEFAULT_POOL = "default"
+DEFAULT_POOL_WORKERS = 4
+#: Seconds to wait at interpreter exit for queued work to drain
+EXIT_TIMEOUT = 10.0
+#: Name of the pool that runs calls inline, on the submitting thread
+INLINE = "inline"
+
+#: Holds the pool whose worker is the current thread, if any
+_worker = threading.local()
+
+class CircuitOpenError(RuntimeError):
+    """Raised when work is submitted for a device whose circuit breaker is
+    open
+    """
+
+class _Call(object):
+    """A function call queued on a lane, and the future its result (or
+    exception) is delivered to
+    """
+    def __init__(self, fxn, args, kwargs, cb=None, timeout=None,
+                 on_start=None, on_done=None):
+        self.fxn = fxn
+        self.args = args
+        self.kwargs = kwargs
+        self.cb = cb
+        self.timeout = timeout
+        self.on_start = on_start
+        self.on_done = on_done
+        self.future = Future()
+        self.submitted = monotonic()
+        self.deadline = None
+        self._finished = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Marks the call as running. Returns False if it should be skipped
+        """
+        if self.on_start is not None:
+            if not self.on_start(self):
+                return False
+        elif not self.future.set_running_or_notify_cancel():
+            return False
+        if self.timeout is not None:
+            self.deadline = monotonic() + self.timeout
+        return True
+
+    def _finish(self):
+        """Claims the right to complete the call, which is lost if it has
+        already timed out
+        """
+        with self._lock:
+            if self._finished:
+                return False
+            self._finished = True
+            return True
+
+    def run(self):
+        try:
+            values = self.fxn(*self.args, **self.kwargs)
+        except BaseException as e:
+            if self._finish():
+                self._done(e)
+                self.future.set_exception(e)
+            return
+        if not self._finish():
+            return
+        # a failing callback (e.g. persistence) counts as a failed call
+        try:
+            if self.cb is not None:
+                self.cb(values)
+        except BaseException as e:
+            self._done(e)
+            self.future.set_exception(e)
+        else:
+            self._done(None)
+            self.future.set_result(values)
+
+    def expire(self):
+        """Fails the call with a TimeoutError if it's still running. Its
+        result (and callback) are discarded if it ever does return.
+
+        :returns: True if the call was expired
+        """
+        if not self._finish():
+            return False
+        error = TimeoutError("{} timed out after {}s".format(
+            getattr(self.fxn, "__name__", self.fxn), self.timeout))
+        self._done(error)
+        self.future.set_exception(error)
+        return True
+
+    def _done(self, error):
+        if self.on_done is not None:
+            self.on_done(self, error)
+
+class _Lane(object):
+    """A worker thread running queued calls one at a time, in order.
+
+    If a call hangs past its timeout the worker is abandoned and a new one
+    takes over the rest of the queue. Workers are daemon threads so that a
+    hung driver can't block interpreter exit; `shutdown_pools` is run at exit
+    to drain queued work instead, for up to `EXIT_TIMEOUT` seconds.
+
+    Once the lane is shut down its worker exits when the queue is empty. Calls
+    queued by the pool's own workers while it drains (e.g. from callbacks)
+    start the worker again.
+    """
+    inline = False
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.replacements = 0
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._shutdown = False
+        self._stopped = False
+        self._thread = None
+        self._start_worker()
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    def submit(self, fxn, *args, **kwargs):
+        """Queues `fxn(*args, **kwargs)` and returns a concurrent `Future`
+        """
+        return self.submit_call(_Call(fxn, args, kwargs)).future
+
+    def submit_call(self, call):
+        with self._condition:
+            if not self.pool._accepting():
+                raise RuntimeError("Executor pool {} has been shut down".format(
+                                   self.pool.name))
+            self._queue.append(call)
+            if self._stopped:
+                self._stopped = False
+                self.pool._restarted()
+                self._start_worker()
+            self._condition.notify()
+        return call
+
+    def discard(self, call):
+        """Removes `call` from the queue if it hasn't been started
+        """
+        with self._condition:
+            try:
+                self._queue.remove(call)
+            except ValueError:
+                pass
+
+    def replace_worker(self):
+        """Abandons the current worker thread and starts a new one
+        """
+        with self._condition:
+            self._generation += 1
+            self.replacements += 1
+            self._start_worker()
+
+    def shutdown(self, wait=True, deadline=None):
+        """Stops the worker once the queue is empty. If `wait` is True, blocks
+        until it has stopped or the `deadline` (a `monotonic` time) passes.
+        Returns False if the deadline passed first.
+        """
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        while wait:
+            thread = self._thread
+            thread.join(0.05)
+            # a hung worker may be replaced while we wait for it
+            if not thread.is_alive() and thread is self._thread:
+                break
+            if deadline is not None and monotonic() >= deadline:
+                return False
+        return True
+
+    def _start_worker(self):
+        self._thread = threading.Thread(
+            target=self._work, args=(self._generation,),
+            name="{}-{}".format(self.pool.name, self.index), daemon=True)
+        self._thread.start()
+
+    def _work(self, generation):
+        _worker.pool = self.pool
+        while True:
+            with self._condition:
+                while generation == self._generation and not self._queue \
+                        and not self._shutdown:
+                    self._condition.wait()
+                if generation != self._generation:
+                    return
+                if not self._queue:
+                    self._stopped = True
+                    return
+                call = self._queue.popleft()
+            if not call.start():
+                continue
+            if call.timeout is not None:
+                self.pool._watch(self, call)
+            call.run()
+
+class ExecutorPool(object):
+    """A fixed number of single-threaded worker lanes shared by many devices.
+
+    Each device is pinned to one lane the first time it submits work, so a
+    device's calls are always run in order, one at a time, on the same thread,
+    while the total thread count stays at `workers` no matter how many devices
+    use the pool. A lane whose worker is abandoned after a timeout gets a new
+    thread, so the devices sharing it carry on with a new DB session.
+    """
+    def __init__(self, name, workers=DEFAULT_POOL_WORKERS):
+        if workers < 1:
+            raise ValueError("workers ({}) must be at least 1".format(workers))
+
+        self.name = name
+        self.workers = workers
+        self._lanes = [ _Lane(self, i) for i in range(workers) ]
+        self._assignments = WeakKeyDictionary()
+        self._next_lane = count()
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._restarts = 0
+        self._deadlines = []
+        self._sequence = count()
+        self._watch_condition = threading.Condition()
+        self._watchdog = None
+
+    @property
+    def device_count(self):
+        return len(self._assignments)
+
+    def executor_for(self, device):
+        """Returns the single-threaded lane `device` is pinned to
+        """
+        with self._lock:
+            if not self._accepting():
+                raise RuntimeError("Executor pool {} has been shut down".format(
+                                   self.name))
+            lane = self._assignments.get(device)
+            if lane is None:
+                lane = next(self._next_lane) % self.workers
+                self._assignments[device] = lane
+        return self._lanes[lane]
+
+    def submit(self, device, fxn, *args, **kwargs):
+        return self.executor_for(device).submit(fxn, *args, **kwargs)
+
+    def share_lane(self, device, other):
+        """Pins `device` to the same lane as `other`, so their calls are run in
+        order on one thread.
+
+        :raises ValueError: If `device` is already pinned to another lane,
+                            since its objects belong to that thread's session
+        """
+        self.executor_for(other)
+        with self._lock:
+            lane = self._assignments[other]
+            if self._assignments.setdefault(device, lane) != lane:
+                raise ValueError("{} is already running on another lane of "
+                                 "pool {}".format(device, self.name))
+
+    def shutdown(self, wait=True, timeout=None):
+        """Stops accepting work, other than from this pool's own workers. If
+        `wait` is True, blocks until all queued work has been run, including
+        the work it queues in turn, or until `timeout` seconds have passed.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._lock:
+            self._shutdown = True
+        for lane in self._lanes:
+            lane.shutdown(wait=False)
+        while wait:
+            with self._lock:
+                restarts = self._restarts
+            drained = [ lane.shutdown(True, deadline) for lane in self._lanes ]
+            if not all(drained):
+                logger.warning("Gave up waiting for executor pool {} to "
+                               "drain after {:.1f}s".format(self.name, timeout))
+                break
+            # a lane may have been restarted by another while we waited
+            with self._lock:
+                if self._restarts == restarts:
+                    break
+        with self._watch_condition:
+            self._watch_condition.notify()
+
+    def _accepting(self):
+        return not self._shutdown or getattr(_worker, "pool", None) is self
+
+    def _restarted(self):
+        with self._lock:
+            self._restarts += 1
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "workers": self.workers,
+            "devices": self.device_count,
+            "queue_depth": [ lane.queue_depth for lane in self._lanes ],
+            "replaced_workers": sum(lane.replacements for lane in self._lanes),
+        }
+
+    def _watch(self, lane, call):
+        """Expires `call` if it's still running at its deadline. Only a weak
+        reference is kept, so finished calls (and their results) are freed
+        straight away rather than at their deadline.
+        """
+        with self._watch_condition:
+            heapq.heappush(self._deadlines, (call.deadline,
+                                             next(self._sequence), lane,
+                                             ref(call)))
+            if self._watchdog is None:
+                self._watchdog = threading.Thread(
+                    target=self._watch_deadlines,
+                    name="{}-watchdog".format(self.name), daemon=True)
+                self._watchdog.start()
+            self._watch_condition.notify()
+
+    def _watch_deadlines(self):
+        while True:
+            with self._watch_condition:
+                if not self._deadlines:
+                    if self._shutdown:
+                        self._watchdog = None
+                        return
+                    self._watch_condition.wait()
+                    continue
+                deadline, _, lane, call = self._deadlines[0]
+                now = monotonic()
+                if deadline > now:
+                    self._watch_condition.wait(deadline - now)
+                    continue
+                heapq.heappop(self._deadlines)
+                call = call()
+            if call is not None and call.expire():
+                logger.warning("{} timed out on lane {} of pool {}, replacing "
+                               "its worker".format(
+                                   getattr(call.fxn, "__name__", call.fxn),
+                                   lane.index, self.name))
+                lane.replace_worker()
+
+class _InlineLane(object):
+    """Queues calls per submitting thread, to be run on that thread by
+    `drain` rather than on a worker
+    """
+    inline = True
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.index = 0
+        self.replacements = 0
+        self._local = threading.local()
+        self._shutdown = False
+
+    @property
+    def _queue(self):
+        queue = getattr(self._local, "queue", None)
+        if queue is None:
+            queue = self._local.queue = deque()
+        return queue
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    def submit(self, fxn, *args, **kwargs):
+        """Runs `fxn(*args, **kwargs)` and returns a completed `Future`
+        """
+        call = self.submit_call(_Call(fxn, args, kwargs))
+        self.drain()
+        return call.future
+
+    def submit_call(self, call):
+        if self._shutdown:
+            raise RuntimeError("Executor pool {} has been shut down".format(
+                               self.pool.name))
+        self._queue.append(call)
+        return call
+
+    def discard(self, call):
+        try:
+            self._queue.remove(call)
+        except ValueError:
+            pass
+
+    def drain(self):
+        """Runs the calls this thread has queued, in order. Calls queued while
+        draining (e.g. from callbacks) are left to the outer `drain`, so that
+        they run after the current call, as they would on a worker.
+        """
+        if getattr(self._local, "draining", False):
+            return
+        queue = self._queue
+        self._local.draining = True
+        try:
+            while queue:
+                call = queue.popleft()
+                if call.start():
+                    call.run()
+        finally:
+            self._local.draining = False
+
+    def shutdown(self, wait=True):
+        self._shutdown = True
+        if wait:
+            self.drain()
+
+class InlinePool(object):
+    """Stands in for an `ExecutorPool`, running each call on the thread that
+    submits it before `execute` returns, so that a simulation is
+    deterministic. Calls still go through each device's queue bound & breaker.
+    `read_timeout` isn't enforced, since nothing could interrupt a hung call.
+    Calls submitted from within a call are run once it returns, so a call
+    mustn't wait on the result of another.
+
+    Select it by setting `executor_pool = INLINE` on `ThreadedExecutor` (or on
+    the device classes to simulate).
+    """
+    workers = 0
+
+    def __init__(self, name=INLINE):
+        self.name = name
+        self._lane = _InlineLane(self)
+        self._assignments = WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def device_count(self):
+        return len(self._assignments)
+
+    def executor_for(self, device):
+        with self._lock:
+            if self._lane._shutdown:
+                raise RuntimeError("Executor pool {} has been shut down".format(
+                                   self.name))
+            self._assignments[device] = 0
+        return self._lane
+
+    def submit(self, device, fxn, *args, **kwargs):
+        return self.executor_for(device).submit(fxn, *args, **kwargs)
+
+    def share_lane(self, device, other):
+        self.executor_for(device)
+        self.executor_for(other)
+
+    def shutdown(self, wait=True, timeout=None):
+        """Runs the calls queued on this thread. There's nothing to wait on
+        elsewhere, so `timeout` is ignored.
+        """
+        self._lane.shutdown(wait=wait)
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "workers": self.workers,
+            "devices": self.device_count,
+            "queue_depth": [ self._lane.queue_depth ],
+            "replaced_workers": 0,
+        }
+
+_pools = {}
+_pool_sizes = {}
+_pools_lock = threading.Lock()
+
+def configure_pool(name, workers):
+    """Sets the number of workers used for pool `name`. Must be called before
+    the pool is first used.
+    """
+    with _pools_lock:
+        if name in _pools:
+            raise RuntimeError("Executor pool {} is already running".format(
+                               name))
+        _pool_sizes[name] = workers
+
+def get_pool(name=DEFAULT_POOL):
+    """Returns the process-wide executor pool `name`, creating it if needed.
+    The pool named `INLINE` is an `InlinePool`. A pool's workers always get
+    their own pool, even while it's shutting down.
+    """
+    pool = getattr(_worker, "pool", None)
+    if pool is not None and pool.name == name:
+        return pool
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None and name == INLINE:
+            pool = _pools[name] = InlinePool(name)
+        elif pool is None:
+            pool = ExecutorPool(name,
+                                _pool_sizes.get(name, DEFAULT_POOL_WORKERS))
+            _pools[name] = pool
+        return pool
+
+_process_pools = {}
+_process_pool_sizes = {}
+
+def configure_process_pool(name, workers):
+    """Sets the number of worker processes used for process pool `name`. Must
+    be called before the pool is first used.
+    """
+    with _pools_lock:
+        if name in _process_pools:
+            raise RuntimeError("Process pool {} is already running".format(
+                               name))
+        _process_pool_sizes[name] = workers
+
+def get_process_pool(name):
+    """Returns the process-wide `ProcessPoolExecutor` `name`, creating it if
+    needed. Workers are spawned rather than forked, since the parent has
+    threads (and DB connections) that a fork would copy mid-use.
+    """
+    with _pools_lock:
+        pool = _process_pools.get(name)
+        if pool is None:
+            pool = ProcessPoolExecutor(
+                _process_pool_sizes.get(name, DEFAULT_POOL_WORKERS),
+                mp_context=multiprocessing.get_context("spawn"))
+            _process_pools[name] = pool
+        return pool
+
+def shutdown_pools(wait=True, timeout=None):
+    """Shuts down every executor pool. If `wait` is True, queued work is
+    drained first, along with the work it queues (e.g. equipment commands
+    coalesced behind a running one); other work is rejected meanwhile. Pools
+    are recreated on next use once they've shut down.
+
+    :param timeout: Seconds to wait for the thread pools to drain, or None to
+                    wait for as long as it takes (e.g. behind a hung driver
+                    without a `read_timeout`)
+    """
+    deadline = None if timeout is None else monotonic() + timeout
+    with _pools_lock:
+        pools = list(_pools.items())
+    for _, pool in pools:
+        pool.shutdown(wait, None if deadline is None else
+                      max(deadline - monotonic(), 0))
+    with _pools_lock:
+        for name, pool in pools:
+            if _pools.get(name) is pool:
+                del _pools[name]
+        process_pools = list(_process_pools.values())
+        _process_pools.clear()
+    for pool in process_pools:
+        pool.shutdown(wait=wait)
+
+@atexit.register
+def _shutdown_at_exit():
+    shutdown_pools(timeout=EXIT_TIMEOUT)
+
+def _run_packed(fxn, config, args, kwargs):
+    """Runs `fxn` in a worker process and packs the {name: value} dict it
+    returns into a tuple of names and a float64 array, which is much cheaper
+    to send back than value objects
+    """
+    values = fxn(config, *args, **kwargs)
+    names = tuple(values)
+    return names, np.fromiter((values[name] for name in names),
+                              dtype=np.float64, count=len(names))
+
+class _ExecutionState(object):
+    """A device's queued calls and circuit breaker state
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = deque()
+        self.lane = None
+        self.breaker = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.open_until = None
+        self.trial = None
+        self.timeouts = 0
+        self.errors = 0
+        self.dropped = 0
+        self.stale = 0
+        self.rejected = 0
+
+_state_lock = threading.Lock()
 
 class ThreadedExecutor(object):
     """Mixin to execute a specified function in a separate thread.
+
+    Work is run on the shared pool named by `executor_pool`, so device classes
+    (or individual devices on the same bus) can be given their own pool.
+
+    Drivers that hold the GIL for long stretches (e.g. signal processing) can
+    run in a process pool instead by setting `process_pool`. Calls of a
+    method like `read` are then sent to the class's `process_read` static
+    method, called as `process_read(self.process_config(), *args)` in a
+    worker process. It returns a {name: value} dict, which comes back as a
+    packed array and is rebuilt into value objects before the callback runs,
+    so persistence is unchanged. The call still queues on this object's
+    thread lane, so ordering, timeouts & the breaker apply as usual.
+
+    A device's calls can be bounded so that one misbehaving driver can't hold
+    up the rest: `read_timeout` fails calls that run too long, `update_timeout`
+    drops calls that waited too long to start, `max_pending` caps the calls
+    waiting to start, and a circuit breaker rejects calls for a while after
+    `breaker_threshold` consecutive failures.
     """
+    executor_pool = DEFAULT_POOL
+    #: Name of the process pool to run driver functions in, or None to run
+    #: them in threads
+    process_pool = None
+    #: Seconds a call may run before it fails with a TimeoutError. The thread
+    #: running it is abandoned & replaced, since it can't be interrupted.
+    read_timeout = None
+    #: Seconds a call may wait to start before it's cancelled as stale
+    update_timeout = None
+    #: Calls allowed to wait to start. The oldest waiting call is cancelled to
+    #: make room for a new one, so newer requests supersede stale ones.
+    max_pending = None
+    #: Consecutive failures (errors or timeouts) that open the breaker. None
+    #: disables the breaker.
+    breaker_threshold = 5
+    #: Seconds the breaker stays open before a trial call is let through.
+    #: Doubles each time the trial fails, up to `breaker_max_reset`.
+    breaker_reset = 30.0
+    breaker_max_reset = 600.0
+
     def __init__(self):
         super(ThreadedExecutor, self).__init__()
-        self._executor = None
 
     @property
     def executor(self):
-        if self._executor is None:
-            self._executor = ThreadPoolExecutor(1)
-        return self._executor
+        return get_pool(self.executor_pool).executor_for(self)
+
+    def process_config(self):
+        """Inherit this method to return the (picklable) settings that the
+        `process_*` driver functions need
+        """
+        return {}
+
+    def _in_process(self, fxn):
+        """Returns a function running the process pool counterpart of method
+        `fxn` and rebuilding its values
+        """
+        name = getattr(fxn, "__name__", None)
+        target = getattr(type(self), "process_{}".format(name), None)
+        if getattr(fxn, "__self__", None) is not self or target is None:
+            raise TypeError("{} has no process_{} to run in a process "
+                            "pool".format(type(self).__name__, name))
+        pool = get_process_pool(self.process_pool)
+        config = self.process_config()
+
+        @wraps(fxn)
+        def run(*args, **kwargs):
+            future = pool.submit(_run_packed, target, config, args, kwargs)
+            try:
+                names, values = future.result(self.read_timeout)
+            except TimeoutError:
+                future.cancel()
+                raise
+            return self._unpack_values(names, values)
+        return run
+
+    def _unpack_values(self, names, values):
+        """Rebuilds value objects from a packed process pool result
+        """
+        data = [ self.value_type(float(value), name)
+                 for name, value in zip(names, values) ]
+        if len(data) == 1 and getattr(self, "scalar_data", False):
+            return data[0]
+        return data
+
+    @property
+    def _execution(self):
+        state = getattr(self, "_execution_state", None)
+        if state is None:
+            with _state_lock:
+                state = getattr(self, "_execution_state", None)
+                if state is None:
+                    state = self._execution_state = _ExecutionState()
+        return state
+
+    def execution_stats(self):
+        """Returns this device's breaker state & failure counts
+        """
+        state = self._execution
+        with state.lock:
+            open_for = 0.0
+            if state.breaker == state.OPEN:
+                open_for = max(0.0, state.open_until - get_clock().monotonic())
+            return {
+                "breaker": state.breaker,
+                "open_for": open_for,
+                "consecutive_failures": state.failures,
+                "trips": state.trips,
+                "timeouts": state.timeouts,
+                "errors": state.errors,
+                "dropped": state.dropped,
+                "stale": state.stale,
+                "rejected": state.rejected,
+                "pending": len(state.queued),
+            }
+
+    def reset_breaker(self):
+        """Closes the circuit breaker, e.g. after the device has been fixed
+        """
+        state = self._execution
+        with state.lock:
+            state.breaker = state.CLOSED
+            state.failures = 0
+            state.trips = 0
+            state.trial = None
 
     def execute(self, fxn, cb, *args, **kwargs):
         """Execute the exec_function in the threaded executor. Unless running
@@ -29,14 +744,208 @@ class ThreadedExecutor(object):
                    sole argument.
         :param run_sync: Boolean flag to run function synchronously. Defaults to
                          False.
+        :returns: A concurrent `Future` for the function's return value. It is
+                  cancelled if the call is dropped from the queue, and fails
+                  with a TimeoutError after `read_timeout`.
+        :raises CircuitOpenError: If the circuit breaker is open
+
+        The callback is run on the executor thread straight after the
+        function, so this object's callbacks always run on the same thread (and
+        its thread-local DB session) and never concurrently.
         """
-        future = self.executor.submit(fxn, *args, **kwargs)
+        if iscoroutinefunction(fxn):
+            raise TypeError("{} is a coroutine function, use execute_async "
+                            "instead".format(fxn.__name__))
+
+        labels = device_labels(self)
+        future = self._submit(fxn, args, kwargs, partial(
+            self._timed_callback, cb, labels=labels), labels).future
 
         if 'run_sync' in kwargs and kwargs['run_sync']:
-            values = future.result()
-            cb(values)
-        else:
-            cb_wrapper = lambda f: cb(f.result())
-            future.add_done_callback(cb_wrapper)
+            future.result()
 
         return future
+
+    async def execute_async(self, fxn, cb, *args, **kwargs):
+        """Awaitable version of `execute`, to be run on the IOLoop.
+
+        Coroutine functions are awaited directly on the loop. Regular functions
+        are run on this object's executor. Either way `cb` is run on this
+        object's executor, as for `execute`, and the function's return value
+        is returned on the loop once it has finished.
+        """
+        labels = device_labels(self)
+        cb = partial(self._timed_callback, cb, labels=labels)
+        if iscoroutinefunction(fxn):
+            return await self._await_coroutine(fxn, args, kwargs, cb, labels)
+        call = self._submit(fxn, args, kwargs, cb, labels)
+        return await asyncio.wrap_future(call.future)
+
+    async def _await_coroutine(self, fxn, args, kwargs, cb, labels):
+        state = self._execution
+        token = object()
+        with state.lock:
+            self._admit(state, token, labels)
+        started = perf_counter()
+        try:
+            try:
+                values = await asyncio.wait_for(fxn(*args, **kwargs),
+                                                self.read_timeout)
+            except Exception:
+                metrics.increment("executor_errors_total", **labels)
+                raise
+            metrics.observe("executor_run_seconds", perf_counter() - started,
+                            **labels)
+            await asyncio.wrap_future(self.executor.submit(cb, values))
+        except asyncio.CancelledError:
+            with state.lock:
+                if state.trial is token:
+                    state.trial = None
+            raise
+        except Exception as e:
+            self._call_done(state, labels, token, e)
+            raise
+        self._call_done(state, labels, token, None)
+        return values
+
+    def _submit(self, fxn, args, kwargs, cb, labels):
+        """Queues a call of `fxn` on this object's lane, applying the queue
+        bound & breaker
+        """
+        state = self._execution
+        lane = self.executor
+        if self.process_pool is not None:
+            fxn = self._in_process(fxn)
+        call = _Call(self._timed(fxn, labels), args, kwargs, cb=cb,
+                     timeout=self.read_timeout,
+                     on_start=partial(self._start_call, state, labels),
+                     on_done=partial(self._call_done, state, labels))
+        with state.lock:
+            self._admit(state, call, labels)
+            state.lane = lane
+            if self.max_pending is not None:
+                while state.queued and len(state.queued) >= self.max_pending:
+                    self._drop(state, lane, state.queued.popleft(), labels)
+            lane.submit_call(call)
+            state.queued.append(call)
+        if lane.inline:
+            # outside the lock, which starting the call takes
+            lane.drain()
+        return call
+
+    def _admit(self, state, call, labels):
+        """Raises CircuitOpenError unless the breaker lets `call` through. Must
+        be called holding `state.lock`.
+        """
+        if state.breaker == state.OPEN and \
+                get_clock().monotonic() >= state.open_until:
+            state.breaker = state.HALF_OPEN
+        if state.breaker == state.CLOSED:
+            return
+        if state.breaker == state.HALF_OPEN and state.trial is None:
+            state.trial = call
+            return
+        state.rejected += 1
+        metrics.increment("executor_rejected_total", **labels)
+        raise CircuitOpenError("Circuit breaker for {} is open".format(
+                               labels["device"]))
+
+    def _drop(self, state, lane, call, labels):
+        if call.future.cancel():
+            lane.discard(call)
+            state.dropped += 1
+            metrics.increment("executor_dropped_total", **labels)
+            if state.trial is call:
+                state.trial = None
+
+    def _start_call(self, state, labels, call):
+        with state.lock:
+            try:
+                state.queued.remove(call)
+            except ValueError:
+                pass
+            if self.update_timeout is not None and \
+                    monotonic() - call.submitted > self.update_timeout and \
+                    call.future.cancel():
+                state.stale += 1
+                metrics.increment("executor_stale_total", **labels)
+                if state.trial is call:
+                    state.trial = None
+                return False
+            return call.future.set_running_or_notify_cancel()
+
+    def _call_done(self, state, labels, call, error):
+        """Updates the breaker with the outcome of the driver function
+        """
+        with state.lock:
+            if state.trial is call:
+                state.trial = None
+            if error is None:
+                if state.breaker != state.CLOSED:
+                    self.log.info("Circuit breaker for {} closed".format(
+                                  labels["device"]))
+                state.breaker = state.CLOSED
+                state.failures = 0
+                state.trips = 0
+                return
+
+            state.failures += 1
+            if isinstance(error, TimeoutError):
+                state.timeouts += 1
+                metrics.increment("executor_timeouts_total", **labels)
+            else:
+                state.errors += 1
+            if self.breaker_threshold is None or (
+                    state.breaker != state.HALF_OPEN and
+                    state.failures < self.breaker_threshold):
+                return
+
+            reset = min(self.breaker_reset * 2 ** state.trips,
+                        self.breaker_max_reset)
+            state.trips += 1
+            state.breaker = state.OPEN
+            state.open_until = get_clock().monotonic() + reset
+            while state.queued:
+                self._drop(state, state.lane, state.queued.popleft(), labels)
+            metrics.increment("executor_breaker_trips_total", **labels)
+        self.log.warning("Circuit breaker for {} opened for {}s after {} "
+                         "failures: {}".format(labels["device"], reset,
+                                               state.failures, error))
+
+    @property
+    def log(self):
+        return logger
+
+    @staticmethod
+    def _timed(fxn, labels):
+        """Wraps `fxn` to record the time it spent queued (from now until it
+        is called) and running
+        """
+        submitted = perf_counter()
+
+        @wraps(fxn)
+        def timed(*args, **kwargs):
+            started = perf_counter()
+            metrics.observe("executor_queue_wait_seconds", started - submitted,
+                            **labels)
+            try:
+                return fxn(*args, **kwargs)
+            except Exception:
+                metrics.increment("executor_errors_total", **labels)
+                raise
+            finally:
+                metrics.observe("executor_run_seconds",
+                                perf_counter() - started, **labels)
+        return timed
+
+    @staticmethod
+    def _timed_callback(cb, values, labels):
+        started = perf_counter()
+        try:
+            cb(values)
+        except Exception:
+            metrics.increment("executor_callback_errors_total", **labels)
+            raise
+        finally:
+            metrics.observe("executor_callback_seconds",
+                            perf_counter() - started, **labels)
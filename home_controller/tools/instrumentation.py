@@ -0,0 +1,195 @@
+"""Low overhead timing histograms & counters
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import threading
+from bisect import bisect_left
+
+#: Histogram bucket upper bounds, in seconds: 50us to 60s
+DEFAULT_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+class Histogram(object):
+    """Fixed bucket histogram. Observing a value is a bisect & a few integer
+    updates, so it's cheap enough to leave on for every call.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def merge(self, other):
+        with self._lock:
+            for i, count in enumerate(other.counts):
+                self.counts[i] += count
+            self.count += other.count
+            self.sum += other.sum
+            self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        """Returns the upper bound of the bucket holding the `q`th percentile
+        (0-100), or the largest value seen for the overflow bucket
+        """
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.mean,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+        }
+
+class Metrics(object):
+    """Registry of histograms & counters, keyed by metric name and a tuple of
+    (label, value) pairs.
+
+    Usage::
+
+        metrics.observe("executor_run_seconds", 0.002, device="attic",
+                        device_class="SineWaveSensor")
+        metrics.summary("executor_run_seconds", by="device_class")
+        print(metrics.to_prometheus())
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.enabled = True
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(
+                    key, Histogram(self.buckets))
+        return histogram
+
+    def observe(self, name, value, **labels):
+        if self.enabled:
+            self.histogram(name, **labels).observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def counter(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def summary(self, name, by=None):
+        """Returns {label value: histogram stats} for metric `name`, merging
+        the histograms that share the value of label `by` (or all of them if
+        `by` is None, keyed by None)
+        """
+        merged = {}
+        for (metric, labels), histogram in list(self._histograms.items()):
+            if metric != name:
+                continue
+            group = dict(labels).get(by) if by is not None else None
+            merged.setdefault(group, Histogram(self.buckets)).merge(histogram)
+        return { group: h.stats() for group, h in merged.items() }
+
+    def snapshot(self):
+        """Returns every metric as plain data
+        """
+        return {
+            "histograms": [ { "name": name, "labels": dict(labels),
+                              "stats": h.stats() }
+                            for (name, labels), h
+                            in sorted(self._histograms.items()) ],
+            "counters": [ { "name": name, "labels": dict(labels),
+                            "value": value }
+                          for (name, labels), value
+                          in sorted(self._counters.items()) ],
+        }
+
+    def to_prometheus(self):
+        """Returns every metric in the Prometheus text exposition format
+        """
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(
+                k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                for k, v in pairs) + "}"
+
+        lines = []
+        typed = set()
+        for (name, labels), h in sorted(self._histograms.items()):
+            if name not in typed:
+                lines.append("# TYPE {} histogram".format(name))
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), h.counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    name, format_labels(labels, [("le", bound)]), cumulative))
+            lines.append("{}_sum{} {}".format(name, format_labels(labels),
+                                              h.sum))
+            lines.append("{}_count{} {}".format(name, format_labels(labels),
+                                                h.count))
+        for (name, labels), value in sorted(self._counters.items()):
+            if name not in typed:
+                lines.append("# TYPE {} counter".format(name))
+                typed.add(name)
+            lines.append("{}{} {}".format(name, format_labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+#: Process-wide metrics registry used by the executor & persistence paths
+metrics = Metrics()
+
+def device_labels(device):
+    """Standard labels for metrics about `device`.
+
+    The labels are cached on the device the first time, and the name is read
+    without going through the ORM, so this never loads expired attributes
+    from the DB (possibly on the wrong thread's session).
+    """
+    labels = vars(device).get("_metric_labels")
+    if labels is None:
+        name = vars(device).get("name", getattr(type(device), "name", None))
+        labels = device._metric_labels = {
+            "device": name if isinstance(name, str) else str(id(device)),
+            "device_class": type(device).__name__,
+        }
+    return labels
@@ -0,0 +1,112 @@
+"""Fixed-size in-memory buffers of recent readings
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import threading
+
+import numpy as np
+
+class RingBuffer(object):
+    """Fixed capacity ring buffer of (timestamp, value) samples backed by
+    preallocated NumPy arrays. Once full, each new sample overwrites the
+    oldest, so memory use never grows.
+
+    Timestamps are seconds since the epoch and are expected to be appended in
+    increasing order. The windowed statistics all take an optional `duration`
+    (in seconds) that limits them to the samples within `duration` of the
+    newest sample, and return None when there are no samples.
+    """
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("capacity ({}) must be at least 1".format(
+                             capacity))
+        self.capacity = capacity
+        self._times = np.empty(capacity, dtype=np.float64)
+        self._values = np.empty(capacity, dtype=np.float64)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def append(self, timestamp, value):
+        with self._lock:
+            i = self._count % self.capacity
+            self._times[i] = timestamp
+            self._values[i] = value
+            self._count += 1
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+
+    def _ordered(self, array):
+        if self._count <= self.capacity:
+            return array[:self._count].copy()
+        i = self._count % self.capacity
+        return np.concatenate((array[i:], array[:i]))
+
+    def window(self, duration=None):
+        """Returns (timestamps, values) arrays, oldest first
+        """
+        with self._lock:
+            times = self._ordered(self._times)
+            values = self._ordered(self._values)
+        if duration is not None and len(times):
+            start = np.searchsorted(times, times[-1] - duration, side="left")
+            times, values = times[start:], values[start:]
+        return times, values
+
+    @property
+    def latest(self):
+        """(timestamp, value) of the newest sample, or None
+        """
+        with self._lock:
+            if not self._count:
+                return None
+            i = (self._count - 1) % self.capacity
+            return self._times[i], self._values[i]
+
+    def mean(self, duration=None):
+        _, values = self.window(duration)
+        return float(values.mean()) if len(values) else None
+
+    def min(self, duration=None):
+        _, values = self.window(duration)
+        return float(values.min()) if len(values) else None
+
+    def max(self, duration=None):
+        _, values = self.window(duration)
+        return float(values.max()) if len(values) else None
+
+    def slope(self, duration=None):
+        """Least squares rate of change, in value units per second. Returns
+        None with fewer than two samples.
+        """
+        times, values = self.window(duration)
+        if len(values) < 2:
+            return None
+        times = times - times.mean()
+        denominator = np.dot(times, times)
+        if denominator == 0:
+            return None
+        return float(np.dot(times, values - values.mean()) / denominator)
+
+    def ewma(self, alpha, duration=None):
+        """Exponentially weighted moving average, seeded with the oldest sample
+        in the window.
+
+        :param alpha: Smoothing factor in (0, 1]; higher weights recent
+                      samples more heavily
+        """
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha ({}) must be in (0, 1]".format(alpha))
+        _, values = self.window(duration)
+        n = len(values)
+        if not n:
+            return None
+        weights = alpha * (1 - alpha) ** np.arange(n - 1, -1, -1,
+                                                   dtype=np.float64)
+        weights[0] = (1 - alpha) ** (n - 1)
+        return float(np.dot(weights, values))
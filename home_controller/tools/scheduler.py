@@ -0,0 +1,232 @@
+"""Cooperative polling of many devices on the IOLoop
+"""
+
+# Ben Peters (bencpeters@gmail.com)
+
+import asyncio
+import heapq
+import random
+from itertools import count
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from home_controller.log import logger
+
+def _update_task(device):
+    """Returns a coroutine function that starts `device.update` on its
+    executor and waits for it to finish
+    """
+    async def update():
+        future = device.update()
+        if future is not None:
+            await asyncio.wrap_future(future)
+    return update
+
+class ScheduledTask(object):
+    """Schedule & statistics for one polled device
+    """
+    def __init__(self, device, interval, priority, task, phase):
+        self.device = device
+        self.interval = interval
+        self.priority = priority
+        self.task = task
+        self.phase = phase
+        self.next_due = None
+        self.pending = False
+        self.active = True
+        self.runs = 0
+        self.errors = 0
+        self.missed = 0
+        self.cancelled = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+
+    @property
+    def mean_lateness(self):
+        return self.total_lateness / self.runs if self.runs else 0.0
+
+    def stats(self):
+        return {
+            "interval": self.interval,
+            "priority": self.priority,
+            "runs": self.runs,
+            "errors": self.errors,
+            "missed": self.missed,
+            "cancelled": self.cancelled,
+            "pending": self.pending,
+            "last_lateness": self.last_lateness,
+            "mean_lateness": self.mean_lateness,
+            "max_lateness": self.max_lateness,
+        }
+
+class PollingScheduler(object):
+    """Polls devices at fixed intervals from a single IOLoop timer.
+
+    Each device's first poll is placed at a random phase within its interval,
+    so devices with the same interval don't all fire at once. Later polls stay
+    on that phase grid rather than drifting. A tick that comes due while the
+    device's previous update is still running is skipped (and counted as
+    missed), as are ticks that were already in the past. Devices due at the
+    same time are started in order of decreasing `priority`.
+
+    Usage::
+
+        scheduler = PollingScheduler()
+        scheduler.add(thermostat_sensor, 1.0, priority=10)
+        scheduler.add(outdoor_sensor, 30.0)
+        scheduler.start()
+    """
+    def __init__(self, io_loop=None, seed=None):
+        """
+        :param io_loop: IOLoop to run on. Defaults to the current IOLoop when
+                        `start` is called.
+        :param seed: Seed for the phase jitter
+        """
+        self.io_loop = io_loop
+        self._random = random.Random(seed)
+        self._tasks = {}
+        self._heap = []
+        self._sequence = count()
+        self._timeout = None
+        self._running = False
+
+    @property
+    def log(self):
+        return logger
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def add(self, device, interval, priority=0, task=None, phase=None):
+        """Polls `device` every `interval` seconds.
+
+        :param priority: Devices with higher priority start first when due at
+                         the same time
+        :param task: Coroutine function to run on each tick. Defaults to
+                     running `device.update` on the device's executor, and
+                     waiting for the future it returns.
+        :param phase: Delay before the first poll. Defaults to a random delay
+                      within `interval`.
+        :returns: The `ScheduledTask`
+        """
+        if interval <= 0:
+            raise ValueError("interval ({}) must be greater than 0".format(
+                             interval))
+        self.remove(device)
+        if phase is None:
+            phase = self._random.uniform(0, interval)
+        entry = ScheduledTask(device, interval, priority,
+                              task if task is not None
+                              else _update_task(device),
+                              phase)
+        self._tasks[id(device)] = entry
+        if self._running:
+            self._push(entry, self.io_loop.time() + phase)
+            self._reschedule()
+        return entry
+
+    def remove(self, device):
+        entry = self._tasks.pop(id(device), None)
+        if entry is not None:
+            entry.active = False
+
+    def start(self):
+        if self._running:
+            return
+        if self.io_loop is None:
+            self.io_loop = IOLoop.current()
+        self._running = True
+        now = self.io_loop.time()
+        for entry in self._tasks.values():
+            self._push(entry, now + entry.phase)
+        self._reschedule()
+
+    def stop(self):
+        self._running = False
+        self._heap = []
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+    def stats(self):
+        """Returns per-device statistics, keyed by device name, and totals
+        """
+        tasks = list(self._tasks.values())
+        return {
+            "devices": { getattr(t.device, "name", id(t.device)): t.stats()
+                         for t in tasks },
+            "runs": sum(t.runs for t in tasks),
+            "missed": sum(t.missed for t in tasks),
+            "cancelled": sum(t.cancelled for t in tasks),
+            "errors": sum(t.errors for t in tasks),
+            "max_lateness": max([ t.max_lateness for t in tasks ] or [0.0]),
+        }
+
+    def _push(self, entry, due):
+        entry.next_due = due
+        heapq.heappush(self._heap, (due, next(self._sequence), entry))
+
+    def _reschedule(self):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        if self._running and self._heap:
+            self._timeout = self.io_loop.call_at(self._heap[0][0], self._tick)
+
+    def _tick(self):
+        self._timeout = None
+        now = self.io_loop.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due_time, _, entry = heapq.heappop(self._heap)
+            if entry.active and entry.next_due == due_time:
+                due.append((due_time, entry))
+
+        due.sort(key=lambda d: -d[1].priority)
+        for due_time, entry in due:
+            if entry.pending:
+                entry.missed += 1
+            else:
+                self._launch(entry, now - due_time)
+
+            next_due = due_time + entry.interval
+            if next_due <= now:
+                skipped = int((now - next_due) // entry.interval) + 1
+                entry.missed += skipped
+                next_due += skipped * entry.interval
+            self._push(entry, next_due)
+
+        self._reschedule()
+
+    def _launch(self, entry, lateness):
+        entry.pending = True
+        entry.runs += 1
+        entry.last_lateness = lateness
+        entry.total_lateness += lateness
+        entry.max_lateness = max(entry.max_lateness, lateness)
+        try:
+            future = gen.convert_yielded(entry.task())
+        except Exception as e:
+            self._finish(entry, e)
+            return
+        self.io_loop.add_future(future, lambda f: self._done(entry, f))
+
+    def _done(self, entry, future):
+        """Finishes a poll whose task has completed. Updates cancelled by the
+        device's executor (dropped, stale or rejected by its breaker) are
+        counted, but aren't errors.
+        """
+        if future.cancelled():
+            entry.cancelled += 1
+            self._finish(entry, None)
+        else:
+            self._finish(entry, future.exception())
+
+    def _finish(self, entry, error):
+        entry.pending = False
+        if error is not None:
+            entry.errors += 1
+            self.log.error("Error polling {}: {}".format(
+                getattr(entry.device, "name", entry.device), error))